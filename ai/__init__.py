@@ -1,22 +1,35 @@
-from datetime import datetime
+from ai.sessions import MemorySessionStore
+from datetime import date, datetime
 from dateutil.parser import parse
 from flask import current_app
+from forks import PerProcess
 from google.api_core.exceptions import InvalidArgument
 from google.protobuf.struct_pb2 import Struct
 from google.protobuf import json_format
+from history.utils import century_range, decade_range
+from metrics import NullMetrics
+from resilience import NullBreaker
+from itertools import count
+from threading import Lock
 import dialogflow
-import uuid
+import re
 
-# api.ai session ids per user.
-SESSION_IDS = {}
+WORD_REGEXP = re.compile(r'\w+')
 
 
 class Action:
     def __init__(self, query_result):
         self.name = query_result.action
         self.date = None
+        self.year = None
+        self.year_range = None
+        self.query = None
         fulfillment = query_result.fulfillment_text
         self.fulfillment = fulfillment if fulfillment else None
+        if self.name == 'lookup':
+            # Free-text question about an event or a person, e.g. "when was Lincoln born".
+            query = query_result.parameters['query'] if 'query' in query_result.parameters else None
+            self.query = query if query else query_result.query_text
         if self.name == 'history':
             date_param = query_result.parameters['date'] if 'date' in query_result.parameters else None
             # `date_param` should be a `Struct` of parsed date parameters.
@@ -26,14 +39,32 @@ class Action:
                 self.name = None
                 current_app.logger.error('The date parameters were parsed incorrectly: %s' % date_param)
 
+    @classmethod
+    def history(cls, params):
+        '''Makes the `history` action from the date parameters, e.g. from the local rules.'''
+        action = cls.__new__(cls)
+        action.name = 'history'
+        action.fulfillment = None
+        action.query = None
+        action.make_date(params)
+        return action
+
     def make_date(self, params):
         self.year = None
+        self.year_range = None
         day = params.get('day')
         self.date = parse(day) if day else None
         years_ago = params.get('years_ago')
         year_exact = params.get('year_exact')
-        if (year_exact or years_ago) and not day:
+        decade = params.get('decade')
+        century = params.get('century')
+        if (year_exact or years_ago or decade or century) and not day:
             self.date = datetime.today()
+        if decade or century:
+            # E.g. 1940 for "the 1940s" or 17 for "the 17th century".
+            bc = bool(params.get('bc'))
+            self.year_range = decade_range(int(decade), bc) if decade else century_range(int(century), bc)
+            return
         if years_ago:
             self.year = self.date.year - years_ago
         if year_exact:
@@ -44,24 +75,115 @@ class Action:
             self.year = ("%dBC" if params.get('bc') else "%d") % self.year
 
 
+class ClientPool:
+    '''Long-lived Dialogflow sessions clients, used round-robin.
+
+    The gRPC channels must not be shared with the forked processes, so the clients are created per process.
+    '''
+
+    def __init__(self, size=1, keepalive_ms=30000):
+        assert size > 0
+        self.size = size
+        self.keepalive_ms = keepalive_ms
+        self._clients = PerProcess(lambda: [None] * self.size)
+        self._counter = count()
+        self._lock = Lock()
+
+    def get(self):
+        clients = self._clients.get()
+        i = next(self._counter) % self.size
+        if clients[i] is None:
+            with self._lock:
+                if clients[i] is None:
+                    clients[i] = dialogflow.SessionsClient(transport=self._transport)
+        return clients[i]
+
+    def _transport(self, credentials, default_class, address):
+        options = {
+            'grpc.max_send_message_length': -1,
+            'grpc.max_receive_message_length': -1,
+            'grpc.keepalive_time_ms': self.keepalive_ms,
+        }
+        return default_class(channel=default_class.create_channel(address=address, credentials=credentials,
+                                                                  options=options.items()))
+
+
 class BotAI:
     '''Wrapper for api.ai which can understand questions about history'''
 
-    def extract_action(self, recipient_id, message):
-        query_result = self._query(recipient_id, message)
+    def __init__(self, clients=None, rules=None, cache=None, sessions=None, metrics=None, breaker=None):
+        self.clients = clients if clients is not None else ClientPool()
+        # Dialogflow session ids per user.
+        self.sessions = sessions if sessions is not None else MemorySessionStore()
+        # Optional `ai.rules.RuleParser` which understands the common date questions without Dialogflow.
+        self.rules = rules
+        # Optional `history.cache.Cache` of the query results which do not depend on the session.
+        self.cache = cache
+        # Optional `metrics.Metrics` which times the parsing and the Dialogflow queries.
+        self.metrics = metrics if metrics is not None else NullMetrics()
+        # Optional `resilience.CircuitBreaker` of Dialogflow.
+        self.breaker = breaker if breaker is not None else NullBreaker()
+
+    def extract_action(self, recipient_id, message, deadline=None):
+        '''Understands the message, the optional `resilience.Deadline` bounds the Dialogflow query.
+
+        When Dialogflow fails, the expired cached result of the same text of the day is used if there is one.
+        '''
+        with self.metrics.track('extract_action'):
+            return self._extract_action(recipient_id, message, deadline)
+
+    def _extract_action(self, recipient_id, message, deadline=None):
+        if self.rules is not None:
+            params = self.rules.parse(message)
+            if params is not None:
+                if current_app:
+                    current_app.logger.debug('Local rules parsed: %s' % params)
+                return Action.history(params)
+        if self.cache is not None:
+            # Relative dates are resolved by Dialogflow, so the results are only reused on the same day.
+            key = (normalize(message), current_app.config['DIALOGFLOW_LANGUAGE_CODE'], date.today())
+            query_result = self.cache.lookup(key)
+            if query_result is not None:
+                return Action(query_result)
+        try:
+            query_result = self._query(recipient_id, message, deadline)
+        except Exception:
+            stale = self.cache.peek(key) if self.cache is not None else None
+            if stale is None:
+                raise
+            return Action(stale)
         # Check if the app context is available.
         if current_app:
             current_app.logger.debug('Dialogflow query: %s' % query_result)
+        if self.cache is not None and is_context_free(query_result.query_result):
+            self.cache.set(key, query_result.query_result)
         return Action(query_result.query_result)
 
-    def _query(self, recipient_id, message):
-        session_client = dialogflow.SessionsClient()
+    def _query(self, recipient_id, message, deadline=None):
+        session_client = self.clients.get()
         session = session_client.session_path(
-            current_app.config['DIALOGFLOW_PROJECT_ID'], SESSION_IDS.setdefault(recipient_id, str(uuid.uuid1())))
+            current_app.config['DIALOGFLOW_PROJECT_ID'], self.sessions.get(recipient_id))
         text_input = dialogflow.types.TextInput(
             text=message, language_code=current_app.config['DIALOGFLOW_LANGUAGE_CODE'])
         query_input = dialogflow.types.QueryInput(text=text_input)
+        timeout = current_app.config.get('DIALOGFLOW_TIMEOUT')
+        if deadline is not None:
+            timeout = deadline.timeout(timeout)
         try:
-            return session_client.detect_intent(session=session, query_input=query_input)
+            # The invalid queries are answered by a healthy Dialogflow.
+            with self.metrics.track('dialogflow'), self.breaker.protect((InvalidArgument,), deadline):
+                return session_client.detect_intent(session=session, query_input=query_input, timeout=timeout)
         except InvalidArgument:
             raise
+
+
+def normalize(message):
+    '''Normalizes the message text for the cache key, e.g. "Today in history?" to "today in history".'''
+    return ' '.join(WORD_REGEXP.findall(message.lower()))
+
+
+def is_context_free(query_result):
+    '''Checks that the query result does not depend on the session contexts and does not change them.'''
+    if query_result.intent.input_context_names or not query_result.all_required_params_present:
+        return False
+    return not any(not context.name.endswith('/__system_counters__') for context in query_result.output_contexts)
@@ -0,0 +1,119 @@
+'''Local rule-based parser for the common date questions, which bypasses the Dialogflow round trip.'''
+from datetime import date, timedelta
+from threading import Lock
+import re
+
+
+TOKEN_REGEXP = re.compile(r'[a-z]+|\d+')
+MONTHS = {
+    'january': 1, 'jan': 1, 'february': 2, 'feb': 2, 'march': 3, 'mar': 3, 'april': 4, 'apr': 4, 'may': 5,
+    'june': 6, 'jun': 6, 'july': 7, 'jul': 7, 'august': 8, 'aug': 8, 'september': 9, 'sep': 9, 'sept': 9,
+    'october': 10, 'oct': 10, 'november': 11, 'nov': 11, 'december': 12, 'dec': 12,
+}
+RELATIVE_DAYS = {'today': 0, 'yesterday': -1, 'tomorrow': 1}
+BC = ('bc', 'bce')
+# Words which do not change the meaning of a date question.
+FILLER = frozenset((
+    'a', 'about', 'ad', 'and', 'any', 'anything', 'at', 'ce', 'day', 'did', 'events', 'happen', 'happened',
+    'history', 'in', 'interesting', 'is', 'me', 'nd', 'of', 'on', 'rd', 'show', 'st', 'tell', 'th', 'that', 'the',
+    'there', 'this', 'was', 'what', 'whats', 'year',
+))
+
+
+def parse(message, today=None):
+    '''Parses the message into the Dialogflow date parameters of the `history` action.
+
+    Returns `None` if the message is not a plain date question.
+    '''
+    today = date.today() if today is None else today
+    message = message.lower().replace("'", '').replace('this day', 'today')
+    tokens = [token for token in TOKEN_REGEXP.findall(message) if token not in FILLER]
+    if not tokens:
+        return None
+    day, tokens = _parse_day(tokens, today)
+    params = _parse_year(tokens, day)
+    if params is None:
+        return None
+    if day is not None and 'day' not in params:
+        params['day'] = day.isoformat()
+    return params if params else None
+
+
+def _parse_day(tokens, today):
+    '''Consumes the leading or the trailing day of the tokens, returns the date (or `None`) and the rest.'''
+    for size in (1, 2):
+        day = _to_day(tokens[:size], today)
+        if day is not None:
+            return day, tokens[size:]
+    for size in (1, 2):
+        day = _to_day(tokens[-size:], today) if len(tokens) > size else None
+        if day is not None:
+            return day, tokens[:-size]
+    return None, tokens
+
+
+def _to_day(tokens, today):
+    '''Converts e.g. `['today']`, `['may', '27']` or `['27', 'may']` to the date, returns `None` otherwise.'''
+    if len(tokens) == 1 and tokens[0] in RELATIVE_DAYS:
+        return today + timedelta(days=RELATIVE_DAYS[tokens[0]])
+    if len(tokens) != 2:
+        return None
+    if tokens[0] in MONTHS and tokens[1].isdigit():
+        month, day = MONTHS[tokens[0]], int(tokens[1])
+    elif tokens[0].isdigit() and tokens[1] in MONTHS:
+        month, day = MONTHS[tokens[1]], int(tokens[0])
+    else:
+        return None
+    try:
+        return date(today.year, month, day)
+    except ValueError:
+        return None
+
+
+def _parse_year(tokens, day):
+    '''Parses the remaining tokens into the year parameters, returns `None` if they are not understood.'''
+    if not tokens:
+        return {}
+    if not tokens[0].isdigit() or not 0 < int(tokens[0]):
+        return None
+    number, rest = int(tokens[0]), tokens[1:]
+    if rest == ['years', 'ago'] or rest == ['year', 'ago'] or rest == ['ago']:
+        return {'years_ago': number}
+    if rest == ['s'] and number % 10 == 0:
+        return {'decade': number}
+    if rest and rest[0] in ('century', 'centuries') and rest[1:] in ([], ['bc'], ['bce']):
+        return {'century': number, 'bc': 'BC'} if rest[1:] else {'century': number}
+    if rest and rest[0] in BC and len(rest) == 1:
+        return {'year_exact': number, 'bc': 'BC'}
+    if not rest:
+        if day is not None and 1000 <= number:
+            # Dialogflow resolves a full date with the year into the day itself.
+            try:
+                return {'day': day.replace(year=number).isoformat()}
+            except ValueError:
+                return None
+        return {'year_exact': number}
+    return None
+
+
+class RuleParser:
+    '''Counts how many messages are understood locally.'''
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self._lock = Lock()
+
+    def parse(self, message, today=None):
+        params = parse(message, today)
+        with self._lock:
+            if params is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return params
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
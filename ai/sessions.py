@@ -0,0 +1,137 @@
+'''Stores of the Dialogflow session ids per user.'''
+from collections import OrderedDict
+from threading import local, Lock
+import json
+import os
+import sqlite3
+import time
+import uuid
+
+
+class MemorySessionStore:
+    '''In-process store which evicts the least recently used and the idle sessions.'''
+
+    def __init__(self, maxsize=100000, idle_timeout=3600, clock=time.monotonic):
+        assert maxsize > 0
+        self.maxsize = maxsize
+        self.idle_timeout = idle_timeout
+        self.clock = clock
+        self.evictions = 0
+        self._sessions = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, user_id):
+        '''Returns the session id of the user, starts a new session if there is none or it was idle for too long.'''
+        now = self.clock()
+        with self._lock:
+            session = self._sessions.pop(user_id, None)
+            if session is not None and now - session[1] >= self.idle_timeout:
+                self.evictions += 1
+                session = None
+            session_id = session[0] if session is not None else str(uuid.uuid4())
+            self._sessions[user_id] = (session_id, now)
+            while len(self._sessions) > self.maxsize:
+                self._sessions.popitem(last=False)
+                self.evictions += 1
+            return session_id
+
+    def __len__(self):
+        return len(self._sessions)
+
+    @property
+    def stats(self):
+        return {'size': len(self), 'evictions': self.evictions}
+
+
+class SQLiteSessionStore:
+    '''SQLite store which can be shared by the gunicorn workers on the same host.
+
+    The idle sessions are pruned every `prune_every` calls or at least every `prune_interval` seconds, so that they
+    don't linger while the traffic is low, then the store is trimmed to `maxsize` sessions. The store also keeps the
+    paging positions of the users (see `history.pagination.Pager`), pruned the same way.
+    '''
+
+    def __init__(self, path, maxsize=100000, idle_timeout=3600, prune_every=1000, prune_interval=60,
+                 clock=time.time):
+        self.path = path
+        self.maxsize = maxsize
+        self.idle_timeout = idle_timeout
+        self.prune_every = prune_every
+        self.prune_interval = prune_interval
+        self.clock = clock
+        self.evictions = 0
+        self._calls = 0
+        self._pruned_at = clock()
+        # The connections can't be shared by the threads or the forked processes.
+        self._local = local()
+        with self._connection() as connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS sessions '
+                               '(user_id TEXT PRIMARY KEY, session_id TEXT NOT NULL, last_seen REAL NOT NULL)')
+            connection.execute('CREATE INDEX IF NOT EXISTS sessions_last_seen ON sessions (last_seen)')
+            connection.execute('CREATE TABLE IF NOT EXISTS cursors '
+                               '(user_id TEXT PRIMARY KEY, key TEXT NOT NULL, position INTEGER NOT NULL, '
+                               'updated_at REAL NOT NULL)')
+
+    def get(self, user_id):
+        '''Returns the session id of the user, starts a new session if there is none or it was idle for too long.'''
+        now = self.clock()
+        connection = self._connection()
+        with connection:
+            connection.execute('BEGIN IMMEDIATE')
+            connection.execute('INSERT OR IGNORE INTO sessions VALUES (?, ?, ?)', (user_id, str(uuid.uuid4()), now))
+            expired = connection.execute('UPDATE sessions SET session_id = ? WHERE user_id = ? AND last_seen <= ?',
+                                         (str(uuid.uuid4()), user_id, now - self.idle_timeout)).rowcount
+            connection.execute('UPDATE sessions SET last_seen = ? WHERE user_id = ?', (now, user_id))
+            session_id, = connection.execute('SELECT session_id FROM sessions WHERE user_id = ?',
+                                             (user_id,)).fetchone()
+        self.evictions += expired
+        self._calls += 1
+        if self._calls % self.prune_every == 0 or now - self._pruned_at >= self.prune_interval:
+            self.prune()
+        return session_id
+
+    def get_cursor(self, user_id):
+        '''Returns the `(key, position, updated_at)` paging position of the user, or `None`.'''
+        row = self._connection().execute('SELECT key, position, updated_at FROM cursors WHERE user_id = ?',
+                                         (user_id,)).fetchone()
+        return (json.loads(row[0]),) + row[1:] if row is not None else None
+
+    def set_cursor(self, user_id, key, position, updated_at):
+        connection = self._connection()
+        with connection:
+            connection.execute('INSERT OR REPLACE INTO cursors VALUES (?, ?, ?, ?)',
+                               (user_id, json.dumps(key), position, updated_at))
+
+    def delete_cursor(self, user_id):
+        connection = self._connection()
+        with connection:
+            connection.execute('DELETE FROM cursors WHERE user_id = ?', (user_id,))
+
+    def prune(self):
+        '''Removes the idle sessions and the least recently used ones above `maxsize`, and the idle positions.'''
+        self._pruned_at = now = self.clock()
+        connection = self._connection()
+        with connection:
+            connection.execute('BEGIN IMMEDIATE')
+            removed = connection.execute('DELETE FROM sessions WHERE last_seen <= ?',
+                                         (now - self.idle_timeout,)).rowcount
+            removed += connection.execute('DELETE FROM sessions WHERE user_id IN (SELECT user_id FROM sessions '
+                                          'ORDER BY last_seen DESC LIMIT -1 OFFSET ?)', (self.maxsize,)).rowcount
+            connection.execute('DELETE FROM cursors WHERE updated_at <= ?', (now - self.idle_timeout,))
+            connection.execute('DELETE FROM cursors WHERE user_id IN (SELECT user_id FROM cursors '
+                               'ORDER BY updated_at DESC LIMIT -1 OFFSET ?)', (self.maxsize,))
+        self.evictions += removed
+
+    def _connection(self):
+        if getattr(self._local, 'pid', None) != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            self._local.connection, self._local.pid = connection, os.getpid()
+        return self._local.connection
+
+    def __len__(self):
+        return self._connection().execute('SELECT COUNT(*) FROM sessions').fetchone()[0]
+
+    @property
+    def stats(self):
+        return {'size': len(self), 'evictions': self.evictions}
@@ -1,11 +1,25 @@
-from ai import BotAI, Action
+from ai import BotAI, Action, ClientPool
+from ai.rules import RuleParser, parse
+from ai.sessions import MemorySessionStore, SQLiteSessionStore
+from history.cache import Cache
 from app import app
-from datetime import date
+from datetime import date, datetime
+from google.api_core.exceptions import InvalidArgument, ServiceUnavailable
 from google.protobuf.struct_pb2 import Struct
+from json import load
+from resilience import CircuitBreaker, CircuitOpenError, Deadline
 from unittest.mock import Mock, patch
+import multiprocessing
+import os
+import tempfile
 import unittest
 
 
+CURRENT_DIR = os.path.dirname(os.path.realpath(__file__))
+with(open(os.path.join(CURRENT_DIR, 'fixtures', 'intents.json'))) as intents:
+    INTENTS = load(intents)
+
+
 _parameters = Struct()
 _parameters.update({
     'date': {
@@ -30,6 +44,19 @@ no_action.action = None
 no_action.fulfillment_text = "Hello world"
 
 
+def query_result(output_contexts=(), input_context_names=()):
+    r = Mock()
+    r.action = 'history'
+    r.parameters = valid_response.parameters
+    r.fulfillment_text = ''
+    r.all_required_params_present = True
+    r.output_contexts = [Mock() for _ in output_contexts]
+    for context, name in zip(r.output_contexts, output_contexts):
+        context.name = name
+    r.intent.input_context_names = list(input_context_names)
+    return r
+
+
 class TestAction(unittest.TestCase):
     '''Test action extraction from api.ai response'''
 
@@ -139,6 +166,67 @@ class TestAction(unittest.TestCase):
         self.assertEqual(action.date.month, date.today().month)
         self.assertEqual(action.date.day, date.today().day)
 
+    def test_date_with_decade_parsed(self):
+        parameters = Struct()
+        parameters.update({
+            'date': {
+                "decade": 1940,
+            }})
+        r = Mock()
+        r.action = 'history'
+        r.parameters = parameters
+        action = Action(r)
+        self.assertIsNone(action.year)
+        self.assertEqual(action.year_range, (1940, 1949))
+        self.assertEqual(action.date.day, date.today().day)
+
+    def test_day_with_century_parsed(self):
+        parameters = Struct()
+        parameters.update({
+            'date': {
+                "day": "2017-03-20",
+                "century": 17
+            }})
+        r = Mock()
+        r.action = 'history'
+        r.parameters = parameters
+        action = Action(r)
+        self.assertIsNone(action.year)
+        self.assertEqual(action.year_range, (1601, 1700))
+        self.assertEqual(action.date.month, 3)
+
+    def test_date_with_century_bc_parsed(self):
+        parameters = Struct()
+        parameters.update({
+            'date': {
+                "century": 1,
+                "bc": "BC"
+            }})
+        r = Mock()
+        r.action = 'history'
+        r.parameters = parameters
+        action = Action(r)
+        self.assertEqual(action.year_range, (-100, -1))
+
+    def test_lookup_query_parsed(self):
+        parameters = Struct()
+        parameters.update({'query': 'Lincoln'})
+        r = Mock()
+        r.action = 'lookup'
+        r.parameters = parameters
+        r.fulfillment_text = ''
+        action = Action(r)
+        self.assertEqual(action.query, 'Lincoln')
+        self.assertIsNone(action.fulfillment)
+
+    def test_lookup_query_text(self):
+        r = Mock()
+        r.action = 'lookup'
+        r.parameters = Struct()
+        r.fulfillment_text = ''
+        r.query_text = 'When was Lincoln born?'
+        self.assertEqual(Action(r).query, 'When was Lincoln born?')
+
 
 class TestResponse(unittest.TestCase):
     '''Test parsing of api.ai response'''
@@ -184,5 +272,264 @@ class TestResponse(unittest.TestCase):
         self.assertIsNotNone(res.fulfillment)
 
 
+class TestClientPool(unittest.TestCase):
+    '''Test reusing the Dialogflow clients'''
+
+    def setUp(self):
+        patcher = patch('dialogflow.SessionsClient', side_effect=lambda **kwargs: Mock())
+        self.client_class = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_client_reused(self):
+        pool = ClientPool()
+        self.assertIs(pool.get(), pool.get())
+        self.assertEqual(self.client_class.call_count, 1)
+
+    def test_round_robin(self):
+        pool = ClientPool(size=2)
+        clients = [pool.get() for _ in range(4)]
+        self.assertIsNot(clients[0], clients[1])
+        self.assertEqual(clients[:2], clients[2:])
+
+    @patch('forks.os.getpid')
+    def test_client_recreated_after_fork(self, getpid):
+        pool = ClientPool()
+        getpid.return_value = 1
+        parent = pool.get()
+        getpid.return_value = 2
+        self.assertIsNot(parent, pool.get())
+
+    def test_detect_intent_deadline(self):
+        pool = ClientPool()
+        client = pool.get()
+        client.detect_intent.return_value.query_result = no_action
+        with app.app_context():
+            BotAI(pool).extract_action('1', 'Hello')
+        self.assertEqual(client.detect_intent.call_args[1]['timeout'], app.config['DIALOGFLOW_TIMEOUT'])
+
+
+class TestRules(unittest.TestCase):
+    '''Test the local rules against the date parameters Dialogflow resolves for the corpus'''
+
+    def setUp(self):
+        self.today = datetime.strptime(INTENTS['today'], '%Y-%m-%d')
+        patcher = patch('ai.datetime', Mock(wraps=datetime, today=Mock(return_value=self.today)))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def as_tuple(self, action):
+        return action.name, action.date.month, action.date.day, action.year, action.year_range
+
+    def test_corpus(self):
+        for example in INTENTS['corpus']:
+            with self.subTest(text=example['text']):
+                params = parse(example['text'], self.today.date())
+                if example['parameters'] is None:
+                    self.assertIsNone(params)
+                else:
+                    self.assertEqual(self.as_tuple(Action.history(example['parameters'])),
+                                     self.as_tuple(Action.history(params)))
+
+    def test_hit_rate(self):
+        rules = RuleParser()
+        rules.parse('today')
+        rules.parse('hi')
+        self.assertEqual(rules.hit_rate, 0.5)
+
+    @patch('dialogflow.SessionsClient')
+    def test_bypasses_dialogflow(self, client_class):
+        with app.app_context():
+            action = BotAI(rules=RuleParser()).extract_action('1', 'May 27 1945')
+        self.assertEqual((action.name, action.year), ('history', '1945'))
+        client_class.assert_not_called()
+
+    def test_falls_back_to_dialogflow(self):
+        pool = Mock()
+        pool.get.return_value.detect_intent.return_value.query_result = no_action
+        with app.app_context():
+            action = BotAI(pool, RuleParser()).extract_action('1', 'Hello')
+        self.assertEqual(action.fulfillment, 'Hello world')
+
+
+class TestQueryCache(unittest.TestCase):
+    '''Test caching the context-free Dialogflow query results'''
+
+    def setUp(self):
+        self.pool = Mock()
+        self.detect_intent = self.pool.get.return_value.detect_intent
+        self.detect_intent.return_value.query_result = query_result()
+        self.bot = BotAI(self.pool, cache=Cache(maxsize=10, ttl=60, stale_ttl=0))
+
+    def extract_action(self, message):
+        with app.app_context():
+            return self.bot.extract_action('1', message)
+
+    def test_cached(self):
+        self.extract_action('Today in history?')
+        action = self.extract_action('today  in HISTORY')
+        self.assertEqual(self.detect_intent.call_count, 1)
+        self.assertEqual(action.date.day, 30)
+
+    def test_system_contexts_cached(self):
+        self.detect_intent.return_value.query_result = query_result(
+            output_contexts=['projects/p/agent/sessions/s/contexts/__system_counters__'])
+        self.extract_action('today')
+        self.extract_action('today')
+        self.assertEqual(self.detect_intent.call_count, 1)
+
+    def test_output_contexts_not_cached(self):
+        self.detect_intent.return_value.query_result = query_result(
+            output_contexts=['projects/p/agent/sessions/s/contexts/history-followup'])
+        self.extract_action('today')
+        self.extract_action('today')
+        self.assertEqual(self.detect_intent.call_count, 2)
+
+    def test_input_contexts_not_cached(self):
+        self.detect_intent.return_value.query_result = query_result(input_context_names=['history-followup'])
+        self.extract_action('and the next one?')
+        self.extract_action('and the next one?')
+        self.assertEqual(self.detect_intent.call_count, 2)
+
+    @patch('ai.date')
+    def test_not_reused_next_day(self, today):
+        today.today.return_value = date(2020, 3, 20)
+        self.extract_action('yesterday')
+        today.today.return_value = date(2020, 3, 21)
+        self.extract_action('yesterday')
+        self.assertEqual(self.detect_intent.call_count, 2)
+
+
+class TestDegraded(unittest.TestCase):
+    '''Test the deadline, the circuit breaker and the stale results when Dialogflow fails'''
+
+    def setUp(self):
+        self.now = 0
+        self.pool = Mock()
+        self.detect_intent = self.pool.get.return_value.detect_intent
+        self.detect_intent.return_value.query_result = query_result()
+        self.breaker = CircuitBreaker('dialogflow', threshold=2)
+        self.bot = BotAI(self.pool, cache=Cache(maxsize=10, ttl=60, stale_ttl=0, clock=lambda: self.now),
+                         breaker=self.breaker)
+
+    def extract_action(self, message, deadline=None):
+        with app.app_context():
+            return self.bot.extract_action('1', message, deadline)
+
+    def test_stale_result_when_dialogflow_fails(self):
+        self.extract_action('today')
+        self.now = 100
+        self.detect_intent.side_effect = ServiceUnavailable('down')
+        self.assertEqual(self.extract_action('today').date.day, 30)
+        self.assertEqual(self.detect_intent.call_count, 2)
+
+    def test_error_without_cached_result(self):
+        self.detect_intent.side_effect = ServiceUnavailable('down')
+        with self.assertRaises(ServiceUnavailable):
+            self.extract_action('today')
+
+    def test_deadline_bounds_timeout(self):
+        self.extract_action('today', Deadline(1))
+        self.assertLessEqual(self.detect_intent.call_args[1]['timeout'], 1)
+
+    def test_circuit_opens(self):
+        self.detect_intent.side_effect = ServiceUnavailable('down')
+        for _ in range(2):
+            with self.assertRaises(ServiceUnavailable):
+                self.extract_action('today')
+        with self.assertRaises(CircuitOpenError):
+            self.extract_action('today')
+        self.assertEqual(self.detect_intent.call_count, 2)
+
+    def test_invalid_argument_does_not_open_circuit(self):
+        self.detect_intent.side_effect = InvalidArgument('too long')
+        for _ in range(3):
+            with self.assertRaises(InvalidArgument):
+                self.extract_action('today')
+        self.assertEqual(self.breaker.stats['state'], CircuitBreaker.CLOSED)
+
+
+class TestMemorySessionStore(unittest.TestCase):
+    '''Test the in-process session store'''
+
+    def setUp(self):
+        self.now = 0
+        self.sessions = self.make_store()
+
+    def make_store(self):
+        return MemorySessionStore(maxsize=2, idle_timeout=10, clock=lambda: self.now)
+
+    def test_same_session(self):
+        self.assertEqual(self.sessions.get('a'), self.sessions.get('a'))
+
+    def test_different_users(self):
+        self.assertNotEqual(self.sessions.get('a'), self.sessions.get('b'))
+
+    def test_idle_session_evicted(self):
+        session_id = self.sessions.get('a')
+        self.now = 10
+        self.assertNotEqual(session_id, self.sessions.get('a'))
+        self.assertEqual(self.sessions.stats['evictions'], 1)
+
+    def test_active_session_kept(self):
+        session_id = self.sessions.get('a')
+        self.now = 9
+        self.sessions.get('a')
+        self.now = 18
+        self.assertEqual(session_id, self.sessions.get('a'))
+
+    def test_bounded(self):
+        for user in ('a', 'b', 'c'):
+            self.sessions.get(user)
+        self.assertEqual(self.sessions.stats, {'size': 2, 'evictions': 1})
+
+
+class TestSQLiteSessionStore(TestMemorySessionStore):
+    '''Test the SQLite session store shared by the workers'''
+
+    def make_store(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.path = os.path.join(tmp.name, 'sessions.db')
+        return SQLiteSessionStore(self.path, maxsize=2, idle_timeout=10, prune_every=1, clock=lambda: self.now)
+
+    def test_shared_across_processes(self):
+        session_id = self.sessions.get('a')
+        result = multiprocessing.get_context('fork').Queue()
+        process = multiprocessing.get_context('fork').Process(target=lambda: result.put(self.sessions.get('a')))
+        process.start()
+        process.join(5)
+        self.assertEqual(session_id, result.get(timeout=5))
+
+    def test_shared_across_stores(self):
+        other = SQLiteSessionStore(self.path, clock=lambda: self.now)
+        self.assertEqual(self.sessions.get('a'), other.get('a'))
+
+    def test_pruned_after_interval(self):
+        sessions = SQLiteSessionStore(self.path, idle_timeout=10, prune_every=1000, prune_interval=60,
+                                      clock=lambda: self.now)
+        sessions.get('a')
+        self.now = 55
+        sessions.get('b')
+        self.assertEqual(2, len(sessions))
+        self.now = 60
+        sessions.get('b')
+        self.assertEqual(1, len(sessions))
+        self.assertEqual(1, sessions.stats['evictions'])
+
+    def test_cursor(self):
+        self.sessions.set_cursor('a', [5, 27, None], 3, 1)
+        self.assertEqual(([5, 27, None], 3, 1), SQLiteSessionStore(self.path).get_cursor('a'))
+        self.sessions.delete_cursor('a')
+        self.assertIsNone(self.sessions.get_cursor('a'))
+
+    def test_idle_cursor_pruned(self):
+        self.sessions.set_cursor('a', [5, 27, None], 3, 0)
+        self.sessions.set_cursor('b', [5, 27, None], 3, 5)
+        self.now = 10
+        self.sessions.prune()
+        self.assertIsNone(self.sessions.get_cursor('a'))
+        self.assertIsNotNone(self.sessions.get_cursor('b'))
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,10 +1,27 @@
-from ai import BotAI
+from ai import BotAI, ClientPool
+from ai.rules import RuleParser
+from ai.sessions import MemorySessionStore, SQLiteSessionStore
+from concurrent.futures import wait
 from flask import Flask, request
 from flask_restful import abort, reqparse, Resource, Api
 from history import API as History_API
+from history.cache import Cache
+from history.index import Index
+from history.pagination import Pager
+from history.snapshot import SnapshotAPI
+from history.store import LocalAPI
+from history.warmup import Warmer
+from history.utils import add_ellipsis
 from messengerbot import MessengerClient, messages
+from metrics import Metrics as Metrics_Registry
+from recorder import Recorder
+from resilience import CircuitBreaker, Deadline
+from sender import Sender
+from workers import Dispatcher
+import atexit
 import logging
 import os
+import time
 
 
 app = Flask(__name__)
@@ -19,25 +36,197 @@ app.config.update(
     VERIFY_TOKEN=_verify_token,
     ACCESS_TOKEN=_access_token,
     DIALOGFLOW_PROJECT_ID='chronologist-mvqppm',
-    DIALOGFLOW_LANGUAGE_CODE='en'
+    DIALOGFLOW_LANGUAGE_CODE='en',
+    DIALOGFLOW_TIMEOUT=float(os.environ.get('CHRONOLOGIST_DIALOGFLOW_TIMEOUT', 5)),
+    DIALOGFLOW_CHANNELS=int(os.environ.get('CHRONOLOGIST_DIALOGFLOW_CHANNELS', 1)),
+    DIALOGFLOW_KEEPALIVE_MS=int(os.environ.get('CHRONOLOGIST_DIALOGFLOW_KEEPALIVE_MS', 30000)),
+    LOCAL_RULES=eval(os.environ.get('CHRONOLOGIST_LOCAL_RULES', 'True')),
+    DIALOGFLOW_CACHE_SIZE=int(os.environ.get('CHRONOLOGIST_DIALOGFLOW_CACHE_SIZE', 0)),
+    DIALOGFLOW_CACHE_TTL=int(os.environ.get('CHRONOLOGIST_DIALOGFLOW_CACHE_TTL', 3600)),
+    SESSION_STORE_PATH=os.environ.get('CHRONOLOGIST_SESSION_STORE_PATH'),
+    SESSION_STORE_SIZE=int(os.environ.get('CHRONOLOGIST_SESSION_STORE_SIZE', 100000)),
+    SESSION_IDLE_TIMEOUT=int(os.environ.get('CHRONOLOGIST_SESSION_IDLE_TIMEOUT', 3600)),
+    SESSION_PRUNE_INTERVAL=float(os.environ.get('CHRONOLOGIST_SESSION_PRUNE_INTERVAL', 60)),
+    HISTORY_BASE_URL=os.environ.get('CHRONOLOGIST_HISTORY_BASE_URL', 'http://history.muffinlabs.com'),
+    HISTORY_STORE=os.environ.get('CHRONOLOGIST_HISTORY_STORE'),
+    HISTORY_SNAPSHOT=os.environ.get('CHRONOLOGIST_HISTORY_SNAPSHOT'),
+    HISTORY_FALLBACK_SNAPSHOT=os.environ.get('CHRONOLOGIST_HISTORY_FALLBACK_SNAPSHOT'),
+    HISTORY_SNAPSHOT_CHECK_INTERVAL=int(os.environ.get('CHRONOLOGIST_HISTORY_SNAPSHOT_CHECK_INTERVAL', 10)),
+    HISTORY_INDEX=os.environ.get('CHRONOLOGIST_HISTORY_INDEX'),
+    HISTORY_CACHE_SIZE=int(os.environ.get('CHRONOLOGIST_HISTORY_CACHE_SIZE', 64)),
+    HISTORY_CACHE_TTL=int(os.environ.get('CHRONOLOGIST_HISTORY_CACHE_TTL', 3600)),
+    HISTORY_CACHE_STALE_TTL=int(os.environ.get('CHRONOLOGIST_HISTORY_CACHE_STALE_TTL', 86400)),
+    HISTORY_POOL_SIZE=int(os.environ.get('CHRONOLOGIST_HISTORY_POOL_SIZE', 10)),
+    HISTORY_CONNECT_TIMEOUT=float(os.environ.get('CHRONOLOGIST_HISTORY_CONNECT_TIMEOUT', 3.05)),
+    HISTORY_READ_TIMEOUT=float(os.environ.get('CHRONOLOGIST_HISTORY_READ_TIMEOUT', 10)),
+    HISTORY_RETRIES=int(os.environ.get('CHRONOLOGIST_HISTORY_RETRIES', 2)),
+    HISTORY_BACKOFF_FACTOR=float(os.environ.get('CHRONOLOGIST_HISTORY_BACKOFF_FACTOR', 0.3)),
+    HISTORY_WARMUP_INTERVAL=int(os.environ.get('CHRONOLOGIST_HISTORY_WARMUP_INTERVAL', 0)),
+    HISTORY_WARMUP_WAIT=eval(os.environ.get('CHRONOLOGIST_HISTORY_WARMUP_WAIT', 'False')),
+    HISTORY_PAGE_SIZE=int(os.environ.get('CHRONOLOGIST_HISTORY_PAGE_SIZE', 3)),
+    REPLY_BUDGET=float(os.environ.get('CHRONOLOGIST_REPLY_BUDGET', 8)),
+    REPLY_SEND_BUDGET=float(os.environ.get('CHRONOLOGIST_REPLY_SEND_BUDGET', 2)),
+    CIRCUIT_BREAKER_THRESHOLD=int(os.environ.get('CHRONOLOGIST_CIRCUIT_BREAKER_THRESHOLD', 5)),
+    CIRCUIT_BREAKER_RESET_TIMEOUT=float(os.environ.get('CHRONOLOGIST_CIRCUIT_BREAKER_RESET_TIMEOUT', 30)),
+    MORE_COMMANDS=('more', 'next', 'show more', 'tell me more'),
+    WEBHOOK_WORKERS=int(os.environ.get('CHRONOLOGIST_WEBHOOK_WORKERS', 0)),
+    WEBHOOK_WORKER_MODE=os.environ.get('CHRONOLOGIST_WEBHOOK_WORKER_MODE', 'thread'),
+    WEBHOOK_QUEUE_SIZE=int(os.environ.get('CHRONOLOGIST_WEBHOOK_QUEUE_SIZE', 1000)),
+    WEBHOOK_SUBMIT_TIMEOUT=float(os.environ.get('CHRONOLOGIST_WEBHOOK_SUBMIT_TIMEOUT', 1)),
+    MESSENGER_SEND_WORKERS=int(os.environ.get('CHRONOLOGIST_MESSENGER_SEND_WORKERS', 8)),
+    MESSENGER_POOL_SIZE=int(os.environ.get('CHRONOLOGIST_MESSENGER_POOL_SIZE', 10)),
+    MESSENGER_GRAPH_API_URL=os.environ.get('CHRONOLOGIST_MESSENGER_GRAPH_API_URL'),
+    METRICS_DIR=os.environ.get('CHRONOLOGIST_METRICS_DIR'),
+    METRICS_FLUSH_INTERVAL=float(os.environ.get('CHRONOLOGIST_METRICS_FLUSH_INTERVAL', 5)),
+    RECORD_PATH=os.environ.get('CHRONOLOGIST_RECORD_PATH'),
+    RECORD_SALT=os.environ.get('CHRONOLOGIST_RECORD_SALT')
 )
 api = Api(app)
-history_api = History_API()
+# The metrics of the gunicorn workers are shared through the files in `METRICS_DIR`.
+metrics = Metrics_Registry(directory=app.config['METRICS_DIR'], flush_interval=app.config['METRICS_FLUSH_INTERVAL'])
+# The upstreams fail fast after repeated failures, until they recover.
+breakers = {name: CircuitBreaker(name, app.config['CIRCUIT_BREAKER_THRESHOLD'],
+                                 app.config['CIRCUIT_BREAKER_RESET_TIMEOUT'])
+            for name in ('dialogflow', 'history', 'messenger')}
+history_cache = None
+if app.config['HISTORY_SNAPSHOT']:
+    # The pages of the snapshot are shared by all the workers.
+    history_api = SnapshotAPI(app.config['HISTORY_SNAPSHOT'], app.config['HISTORY_SNAPSHOT_CHECK_INTERVAL'], metrics)
+elif app.config['HISTORY_STORE']:
+    history_api = LocalAPI(app.config['HISTORY_STORE'], metrics, app.config['HISTORY_CACHE_TTL'])
+    history_cache = history_api.cache
+else:
+    history_cache = Cache(app.config['HISTORY_CACHE_SIZE'], app.config['HISTORY_CACHE_TTL'],
+                          app.config['HISTORY_CACHE_STALE_TTL']) if app.config['HISTORY_CACHE_SIZE'] > 0 else None
+    history_api = History_API(app.config['HISTORY_BASE_URL'], history_cache, app.config['HISTORY_POOL_SIZE'],
+                              app.config['HISTORY_CONNECT_TIMEOUT'], app.config['HISTORY_READ_TIMEOUT'],
+                              app.config['HISTORY_RETRIES'], app.config['HISTORY_BACKOFF_FACTOR'], metrics,
+                              breakers['history'],
+                              SnapshotAPI(app.config['HISTORY_FALLBACK_SNAPSHOT'],
+                                          app.config['HISTORY_SNAPSHOT_CHECK_INTERVAL'], metrics)
+                              if app.config['HISTORY_FALLBACK_SNAPSHOT'] else None)
+# The upcoming dates are kept in the history cache, with `preload_app` the workers inherit the warm cache.
+history_warmer = Warmer(history_api, app.config['HISTORY_WARMUP_INTERVAL'], app.logger, metrics) \
+    if history_cache is not None and app.config['HISTORY_WARMUP_INTERVAL'] > 0 else None
+# The Dialogflow clients are shared by all the requests of the worker process.
+dialogflow_cache = Cache(app.config['DIALOGFLOW_CACHE_SIZE'], app.config['DIALOGFLOW_CACHE_TTL'], 0) \
+    if app.config['DIALOGFLOW_CACHE_SIZE'] > 0 else None
+if app.config['SESSION_STORE_PATH']:
+    # Shared by all the workers, so that the user keeps the same Dialogflow session.
+    sessions = SQLiteSessionStore(app.config['SESSION_STORE_PATH'], app.config['SESSION_STORE_SIZE'],
+                                  app.config['SESSION_IDLE_TIMEOUT'],
+                                  prune_interval=app.config['SESSION_PRUNE_INTERVAL'])
+else:
+    sessions = MemorySessionStore(app.config['SESSION_STORE_SIZE'], app.config['SESSION_IDLE_TIMEOUT'])
+bot_ai = BotAI(ClientPool(app.config['DIALOGFLOW_CHANNELS'], app.config['DIALOGFLOW_KEEPALIVE_MS']),
+               RuleParser() if app.config['LOCAL_RULES'] else None, dialogflow_cache, sessions, metrics,
+               breakers['dialogflow'])
+history_index = Index.load(app.config['HISTORY_INDEX']) if app.config['HISTORY_INDEX'] else None
+
+
+def load_page_results(month, day, year_range=None, deadline=None):
+    '''Loads the paged results again, e.g. in another worker than the one which served the previous page.'''
+    results = history_api.date(month, day, deadline=deadline)
+    return results.search_range(*year_range) if year_range else results
+
+
+# With the shared session store the next page can be served by any worker.
+history_pager = Pager(app.config['HISTORY_PAGE_SIZE'], clock=time.time, store=sessions, loader=load_page_results) \
+    if app.config['SESSION_STORE_PATH'] else Pager(app.config['HISTORY_PAGE_SIZE'])
 messenger = MessengerClient(access_token=app.config['ACCESS_TOKEN'])
+sender = Sender(messenger, app.config['MESSENGER_SEND_WORKERS'], app.config['MESSENGER_POOL_SIZE'],
+                graph_api_url=app.config['MESSENGER_GRAPH_API_URL'], metrics=metrics, breaker=breakers['messenger'])
 # Logging.
 gunicorn_error_logger = logging.getLogger('gunicorn.error')
 app.logger.handlers.extend(gunicorn_error_logger.handlers)
 app.logger.setLevel(logging.DEBUG if app.config['DEBUG'] else logging.INFO)
 
 
+def new_deadline():
+    '''Starts the time budget of the reply to a message.'''
+    return Deadline(app.config['REPLY_BUDGET']) if app.config['REPLY_BUDGET'] > 0 else None
+
+
+def handle_message(recipient_id, text):
+    '''Replies to the incoming message.'''
+    deadline = new_deadline()
+    with app.app_context():
+        sender.send_all(Bot()._build_messages(recipient_id, text, deadline=deadline), deadline)
+
+
+# Without the workers the messages are handled before the webhook returns.
+dispatcher = Dispatcher(handle_message, app.config['WEBHOOK_WORKERS'], app.config['WEBHOOK_QUEUE_SIZE'],
+                        app.config['WEBHOOK_WORKER_MODE'], app.logger, app.config['WEBHOOK_SUBMIT_TIMEOUT']) \
+    if app.config['WEBHOOK_WORKERS'] > 0 else None
+if dispatcher is not None:
+    if dispatcher.mode == 'process':
+        # Forked before the app starts any threads, see `gunicorn_conf` for the preloaded app.
+        dispatcher.start()
+    atexit.register(dispatcher.shutdown)
+# The incoming webhooks are only recorded on demand, e.g. to replay the traffic locally.
+recorder = Recorder(app.config['RECORD_PATH'], app.config['RECORD_SALT']) if app.config['RECORD_PATH'] else None
+if recorder is not None:
+    atexit.register(recorder.close)
+
+
+def collect_metrics():
+    '''Yields the counters and the gauges which the components keep themselves.'''
+    for name, cache in (('history', history_cache), ('dialogflow', dialogflow_cache)):
+        if cache is not None:
+            stats = cache.stats
+            for result in ('hits', 'stale_hits', 'misses'):
+                yield 'counter', 'cache_requests_total', {'cache': name, 'result': result}, stats[result]
+            yield 'counter', 'cache_evictions_total', {'cache': name}, stats['evictions']
+            yield 'gauge', 'cache_size', {'cache': name}, stats['size']
+    if bot_ai.rules is not None:
+        yield 'counter', 'local_rules_total', {'result': 'hit'}, bot_ai.rules.hits
+        yield 'counter', 'local_rules_total', {'result': 'miss'}, bot_ai.rules.misses
+    stats = sessions.stats
+    # The SQLite store is shared by the workers, each of them reports its whole size.
+    yield 'shared_gauge' if isinstance(sessions, SQLiteSessionStore) else 'gauge', 'session_store_size', {}, \
+        stats['size']
+    yield 'counter', 'session_evictions_total', {}, stats['evictions']
+    stats = sender.stats
+    yield 'counter', 'messenger_sent_total', {}, stats['sent']
+    yield 'counter', 'messenger_errors_total', {}, stats['errors']
+    if dispatcher is not None:
+        yield 'gauge', 'webhook_queue_pending', {}, dispatcher.pending
+    stats = history_api.flights.stats
+    yield 'counter', 'history_fetches_total', {'result': 'called'}, stats['calls']
+    yield 'counter', 'history_fetches_total', {'result': 'coalesced'}, stats['coalesced']
+    for name, breaker in breakers.items():
+        stats = breaker.stats
+        yield 'gauge', 'circuit_open', {'upstream': name}, int(stats['state'] != CircuitBreaker.CLOSED)
+        yield 'counter', 'circuit_opened_total', {'upstream': name}, stats['opened']
+        yield 'counter', 'circuit_rejected_total', {'upstream': name}, stats['rejected']
+    for source, count in history_api.fallbacks.items():
+        yield 'counter', 'history_fallbacks_total', {'source': source}, count
+    if history_warmer is not None:
+        stats = history_warmer.stats
+        yield 'counter', 'warmup_runs_total', {}, stats['runs']
+        yield 'counter', 'warmup_errors_total', {}, stats['errors']
+        if stats['last_duration'] is not None:
+            yield 'gauge', 'warmup_last_duration_seconds', {}, stats['last_duration']
+
+
+metrics.register(collect_metrics)
+if history_warmer is not None:
+    history_warmer.start(app.config['HISTORY_WARMUP_WAIT'])
+
+
 class FacebookOG(Resource):
     def get(self):
         return "OK!", 200
 
 
+class Metrics(Resource):
+    def get(self):
+        return app.response_class(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
 class Bot(Resource):
     def __init__(self):
-        self.bot_ai = BotAI()
+        self.bot_ai = bot_ai
 
     def get(self):
         parser = reqparse.RequestParser()
@@ -50,46 +239,139 @@ class Bot(Resource):
         abort(401, message='Invalid verify token')
 
     def post(self):
-        events = request.json['entry'][0]['messaging']
+        with metrics.track('webhook'):
+            return self._post()
+
+    def _post(self):
         app.logger.debug('POST request: %s' % request.json)
-        for event in events:
-            if (event.get('message') and event['message'].get('text')):
-                rqsts = self._build_messages(event['sender']['id'], event['message']['text'])
-                for rqst in rqsts:
-                    messenger.send(rqst)
+        if recorder is not None:
+            recorder.record(request.json)
+        # The futures of the replies, and the last one per sender, so that the replies to a sender keep the order.
+        futures, last = [], {}
+        # The history looked up for the batch, so that every date is only fetched once.
+        lookups = {}
+        # Facebook may batch several entries under load.
+        for entry in request.json.get('entry', []):
+            for event in entry.get('messaging', []):
+                if (event.get('message') and event['message'].get('text')):
+                    sender_id, text = event['sender']['id'], event['message']['text']
+                    metrics.inc('webhook_messages_total')
+                    # The events of the same sender are handled by the same worker, so their order is kept.
+                    if dispatcher is not None:
+                        if not dispatcher.submit(sender_id, sender_id, text):
+                            # Answering here could overtake the earlier messages of the sender in the queue.
+                            app.logger.warning('The queue is full, dropped the message of %s', sender_id)
+                            metrics.inc('webhook_dropped_total')
+                    else:
+                        # Every message is answered within its own budget, the replies are sent while the next
+                        # messages are handled.
+                        deadline = new_deadline()
+                        rqsts = self._build_messages(sender_id, text, lookups, deadline)
+                        last[sender_id] = sender.submit(rqsts, deadline, last.get(sender_id))
+                        futures.append((sender_id, last[sender_id]))
+        wait([future for _, future in futures])
+        for sender_id, future in futures:
+            # Failing the webhook would make Facebook redeliver the whole batch, also to the other senders. The
+            # failed sends are counted by the sender.
+            if future.exception() is not None:
+                app.logger.error('Could not send the reply to %s', sender_id, exc_info=future.exception())
         return 200
 
-    def _fetch_history(self, date, year=None):
+    def _fetch_history(self, recipient_id, date, year=None, year_range=None, lookups=None, deadline=None):
         '''Fetches the history and prepares the response.'''
-        items = []
-        for item in history_api.date(date.month, date.day, year):
-            items.append(messages.Message(text=str(item)))
-        if not items:
-            items.append(messages.Message(text='Nothing special found in history for this date'))
-        return items
+        with metrics.track('fetch_history'):
+            return self._fetch_history_messages(recipient_id, date, year, year_range, lookups, deadline)
+
+    def _date(self, month, day, lookups=None, deadline=None):
+        '''Fetches the history of the date once per batch.'''
+        lookups = {} if lookups is None else lookups
+        if (month, day) not in lookups:
+            lookups[(month, day)] = history_api.date(month, day, deadline=deadline)
+        return lookups[(month, day)]
+
+    def _fetch_history_messages(self, recipient_id, date, year, year_range, lookups, deadline=None):
+        results = self._date(date.month, date.day, lookups, deadline)
+        if year_range:
+            results = results.search_range(*year_range)
+        elif year:
+            results = results.search(year)
+        with metrics.track('render'):
+            if year:
+                history_pager.reset(recipient_id)
+                texts = [str(item) for item in results]
+            else:
+                # Only the first page is rendered, the rest is served by the "more" command.
+                texts = history_pager.first(recipient_id, results, (date.month, date.day, year_range))
+        if not texts:
+            texts = ['Nothing special found in history for this date']
+        return [messages.Message(text=text) for text in texts]
+
+    def _fetch_more(self, recipient_id, deadline=None):
+        '''Prepares the next page of the previously fetched history.'''
+        texts = history_pager.next(recipient_id, deadline)
+        if not texts:
+            texts = ['Nothing more found in history, ask me about another date']
+        return [messages.Message(text=text) for text in texts]
 
-    def _build_messages(self, recipient_id, incoming):
-        '''Constructs the response message according to the incoming message. Returns the messenger request.'''
+    def _lookup(self, query, lookups=None, deadline=None):
+        '''Looks up the entries matching the free-text query in the full-text index.'''
+        texts = []
+        hits = history_index.search(query, app.config['HISTORY_PAGE_SIZE']) if history_index is not None else []
+        for hit in hits:
+            results = self._date(hit.month, hit.day, lookups, deadline)
+            entry = history_index.resolve(hit, results)
+            # The index may be built from a different version of the data than the history API serves.
+            if entry is None:
+                app.logger.warning('The indexed entry %s is not in the history, the index may need a rebuild', hit)
+                continue
+            texts.append(add_ellipsis('{date}: {entry}'.format(date=results.date, entry=entry), 320))
+        if not texts:
+            texts = ['Nothing found in history for this question']
+        return [messages.Message(text=text) for text in texts]
+
+    def _build_messages(self, recipient_id, incoming, lookups=None, deadline=None):
+        '''Constructs the response message according to the incoming message. Returns the messenger request.
+
+        When the upstreams fail or the time budget runs out, the user is asked to try later.
+        '''
         recipient = messages.Recipient(recipient_id=recipient_id)
-        action = self.bot_ai.extract_action(recipient_id, incoming)
+        # Some of the budget is kept for sending the reply.
+        budget = deadline.reserve(app.config['REPLY_SEND_BUDGET']) if deadline is not None else None
+        try:
+            if incoming.strip().lower() in app.config['MORE_COMMANDS']:
+                app.logger.info('Parsed action: more')
+                # The results may have to be fetched again in another worker.
+                items = self._fetch_more(recipient_id, budget)
+            else:
+                items = self._answer(recipient_id, incoming, lookups, budget)
+        except Exception:
+            app.logger.exception('Could not answer the message, asking to try later')
+            metrics.inc('degraded_replies_total')
+            items = [messages.Message(text='Sorry, I can\'t look into the history right now, please try again later')]
+        return [messages.MessageRequest(recipient, item) for item in items]
+
+    def _answer(self, recipient_id, incoming, lookups, deadline):
+        '''Prepares the reply items, raises if the upstreams fail.'''
+        action = self.bot_ai.extract_action(recipient_id, incoming, deadline)
 
         if action.fulfillment:
             app.logger.info('Parsed action: fulfillment')
             items = [messages.Message(text=action.fulfillment)]
         elif action.name == 'history':
-            app.logger.info('Parsed action: history, date: %s, year: %s', action.date.strftime('%-d %B %Y'),
-                            action.year)
-            items = self._fetch_history(action.date, action.year)
-            if not action.year:
-                items = items[:3]
+            app.logger.info('Parsed action: history, date: %s, year: %s, year range: %s',
+                            action.date.strftime('%-d %B %Y'), action.year, action.year_range)
+            items = self._fetch_history(recipient_id, action.date, action.year, action.year_range, lookups, deadline)
+        elif action.name == 'lookup':
+            app.logger.info('Parsed action: lookup, query: %s', action.query)
+            items = self._lookup(action.query, lookups, deadline)
         else:
             app.logger.warning('Could not parse the action')
             items = []
-
-        return [messages.MessageRequest(recipient, item) for item in items]
+        return items
 
 
 api.add_resource(FacebookOG, '/')
+api.add_resource(Metrics, '/metrics')
 api.add_resource(Bot, '/bot')
 
 
@@ -0,0 +1 @@
+'''Benchmarks of the bot, see `python -m benchmarks.webhook --help`.'''
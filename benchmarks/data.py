@@ -0,0 +1,39 @@
+'''Synthetic history payloads in the format of http://history.muffinlabs.com/.'''
+from calendar import month_name
+from json import load
+import os
+import random
+
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), 'history', 'fixtures')
+with open(os.path.join(FIXTURES_DIR, 'data.json')) as data:
+    SAMPLE = load(data)
+with open(os.path.join(FIXTURES_DIR, 'corrupted.json')) as corrupted:
+    CORRUPTED = [entry for entry in load(corrupted)['data']['Deaths'] if entry['text'] is None]
+
+
+def synthetic_day(month=5, day=27, entries=300, duplicates=1, corrupted=0, seed=0):
+    '''Builds a day payload with the number of entries per category.
+
+    Every year repeats `duplicates` times and `corrupted` unsearchable rows (like in `fixtures/corrupted.json`)
+    are mixed in.
+    '''
+    rng = random.Random(seed)
+    categories = {}
+    for category, samples in SAMPLE['data'].items():
+        years = sorted(rng.sample(range(-500, 2020), entries // duplicates + 1))
+        rows = []
+        for year in years:
+            for _ in range(duplicates):
+                sample = rng.choice(samples)
+                rows.append({
+                    'year': '%d BC' % -year if year < 0 else str(year),
+                    'text': sample['text'],
+                    'links': [dict(link) for link in sample['links']],
+                })
+        rows = rows[:entries]
+        for _ in range(corrupted):
+            rows.insert(rng.randrange(len(rows) + 1), dict(rng.choice(CORRUPTED)))
+        categories[category] = rows
+    name = '{month} {day}'.format(month=month_name[month], day=day)
+    return {'date': name, 'url': 'https://wikipedia.org/wiki/' + name.replace(' ', '_'), 'data': categories}
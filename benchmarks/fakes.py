@@ -0,0 +1,120 @@
+'''Local stand-ins with configurable latency for the history upstream, the Graph API and Dialogflow.
+
+The HTTP stand-ins are also used by the tests, which subclass them to serve the fixtures or to fail.
+'''
+from google.protobuf.struct_pb2 import Struct
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from json import dumps, loads
+from threading import Lock, Thread
+import dialogflow
+import re
+import time
+
+from ai.rules import parse
+from benchmarks.data import synthetic_day
+
+
+class FakeHandler(BaseHTTPRequestHandler):
+    '''Base handler which waits for `latency` seconds before every response and counts the connections and requests.'''
+
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        with self.server.lock:
+            self.server.connections += 1
+        super().setup()
+
+    def respond(self, status, data):
+        time.sleep(self.server.latency)
+        with self.server.lock:
+            self.server.requests += 1
+        body = dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeHistory(FakeHandler):
+    '''Serves the synthetic day payloads at `/date/{month}/{day}`.'''
+
+    PATH_REGEXP = re.compile(r'^/date/(\d{1,2})/(\d{1,2})$')
+
+    def do_GET(self):
+        match = self.PATH_REGEXP.match(self.path)
+        if not match:
+            self.respond(404, {'error': 'Not found'})
+            return
+        self.respond(200, self.day(int(match.group(1)), int(match.group(2))))
+
+    def day(self, month, day):
+        return synthetic_day(month, day, self.server.entries, seed=month * 100 + day)
+
+
+class FakeGraph(FakeHandler):
+    '''Accepts the messages at `/messages` and records them in `received`.'''
+
+    def do_POST(self):
+        rqst = loads(self.rfile.read(int(self.headers['Content-Length'])))
+        with self.server.lock:
+            self.server.received.append(rqst)
+        self.respond(*self.reply(rqst))
+
+    def reply(self, rqst):
+        '''Returns the status and the payload of the response to the message.'''
+        return 200, {'recipient_id': rqst['recipient']['id'], 'message_id': 'mid'}
+
+
+def start(handler, latency=0, **attributes):
+    '''Starts the fake server in a background thread, returns the server and its URL.'''
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    server.daemon_threads = True
+    server.latency = latency
+    server.connections = 0
+    server.requests = 0
+    server.received = []
+    server.lock = Lock()
+    for name, value in attributes.items():
+        setattr(server, name, value)
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server, 'http://127.0.0.1:%d' % server.server_port
+
+
+class FakeSessionsClient:
+    '''Resolves the messages like Dialogflow would, using the local rules, after waiting for `latency` seconds.'''
+
+    def __init__(self, latency=0):
+        self.latency = latency
+        self.requests = 0
+
+    def session_path(self, project, session):
+        return 'projects/{project}/agent/sessions/{session}'.format(project=project, session=session)
+
+    def detect_intent(self, session, query_input, timeout=None, **kwargs):
+        time.sleep(self.latency)
+        self.requests += 1
+        params = parse(query_input.text.text)
+        if params is None:
+            query_result = dialogflow.types.QueryResult(query_text=query_input.text.text,
+                                                        fulfillment_text='Ask me about a date')
+        else:
+            parameters = Struct()
+            parameters.update({'date': params})
+            query_result = dialogflow.types.QueryResult(query_text=query_input.text.text, action='history',
+                                                        parameters=parameters, all_required_params_present=True)
+        return dialogflow.types.DetectIntentResponse(query_result=query_result)
+
+
+class FakeClientPool:
+    '''Drop-in replacement of `ai.ClientPool`.'''
+
+    def __init__(self, latency=0):
+        self.client = FakeSessionsClient(latency)
+
+    def get(self):
+        return self.client
@@ -0,0 +1,8 @@
+'''gunicorn settings of the benchmark, the stages are timed per worker and dumped when it exits.'''
+accesslog = None
+preload_app = False
+
+
+def worker_exit(server, worker):
+    from benchmarks.wsgi import dump_stages
+    dump_stages()
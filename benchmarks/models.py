@@ -0,0 +1,213 @@
+'''Microbenchmarks of `history.models` and `history.utils`, the CPU hot path of every reply.
+
+The timings are compared with a run of the base revision on the same machine, or with the stored baselines. A case
+slower than the base by more than the threshold plus the measured noise is a regression and the exit status is 1:
+
+    python -m benchmarks.models --base main
+    python -m benchmarks.models
+    python -m benchmarks.models --save  # in a commit of its own, after an intended change or on a new machine
+
+The median of the measurements counts, normalized by a pure Python calibration loop, so that the stored baselines
+roughly hold on other machines. They can't tell a small regression from the noise of another machine or another
+day, only the comparison with the base revision can gate a change.
+'''
+from json import dump, dumps, load
+from statistics import median
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import timeit
+
+from benchmarks.data import synthetic_day
+from history import utils
+from history.models import Results
+from history.utils import loads
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+BASELINES = os.path.join(ROOT, 'benchmarks', 'baselines', 'models.json')
+# The measured noise is multiplied by this factor and added to the threshold.
+NOISE_FACTOR = 3
+ENTRIES = 3000
+DUPLICATES = 5
+CORRUPTED = 50
+
+
+def calibration():
+    total = 0
+    for i in range(10000):
+        total += i * i
+    return total
+
+
+def cases():
+    '''Returns the `(name, function, number)` cases, the function is called `number` times per measurement.'''
+    data = synthetic_day(entries=ENTRIES, duplicates=DUPLICATES, corrupted=CORRUPTED)
+    raw = dumps(data).encode('utf-8')
+    results = Results(data)
+    years = [entry.year for entry in results.events[::DUPLICATES]][:200]
+    texts = [(entry.year, entry.text) for entry in results.events[:300]]
+
+    def search():
+        for year in years:
+            results.search(year)
+
+    def negative_index():
+        for i in range(1, 1001):
+            results.events[-i]
+            results[-i]
+
+    def slice_():
+        for i in range(0, ENTRIES, 100):
+            results.events[i:i + 100]
+        results[ENTRIES - 50:ENTRIES + 50]
+
+    def iterate():
+        for entry in results:
+            entry.year
+            entry.text
+
+    def render():
+        # Every round renders from scratch instead of serving the memoized texts.
+        utils.invalidate_templates()
+        for entry in results:
+            str(entry)
+
+    def render_memoized():
+        for entry in results:
+            str(entry)
+
+    def templates():
+        for year, text in texts:
+            utils.event_template(year, text)
+            utils.birth_template(year, text)
+            utils.death_template(year, text)
+
+    return [
+        ('calibration', calibration, 100),
+        ('construct', lambda: len(Results(data)), 5),
+        ('parse_first_events', lambda: Results(loads(raw)).events[:3], 5),
+        ('search', search, 20),
+        ('search_range', lambda: results.century(19), 100),
+        ('negative_index', negative_index, 20),
+        ('slice', slice_, 50),
+        ('iterate', iterate, 10),
+        ('render', render, 5),
+        ('render_memoized', render_memoized, 10),
+        ('templates', templates, 10),
+    ]
+
+
+def measure(repeat=5, scale=1.0):
+    '''Returns the times per call of every measurement of every case, in seconds.'''
+    timings = {}
+    for name, func, number in cases():
+        number = max(1, int(number * scale))
+        timings[name] = [total / number for total in timeit.repeat(func, number=number, repeat=repeat)]
+    return timings
+
+
+def summarize(timing):
+    '''Returns the median and the relative median absolute deviation of the measurements, or of a stored number.'''
+    if not isinstance(timing, list):
+        return timing, 0
+    middle = median(timing)
+    return middle, median(abs(value - middle) for value in timing) / middle if middle else 0
+
+
+def compare(timings, baselines, threshold, noise_factor=NOISE_FACTOR):
+    '''Returns the `(name, ratio)` regressions, the ratio of the normalized timing to the normalized baseline.
+
+    The timings and the baselines are the measurements or single numbers, the noise of the measurements of the case
+    and of the calibration on both sides widens the threshold.
+    '''
+    regressions = []
+    calibration, calibration_noise = summarize(timings['calibration'])
+    base_calibration, base_calibration_noise = summarize(baselines['calibration'])
+    for name, timing in timings.items():
+        if name == 'calibration' or name not in baselines:
+            continue
+        (timing, noise), (baseline, base_noise) = summarize(timing), summarize(baselines[name])
+        ratio = (timing / calibration) / (baseline / base_calibration)
+        noise += calibration_noise + base_noise + base_calibration_noise
+        if ratio > 1 + threshold + noise_factor * noise:
+            regressions.append((name, ratio))
+    return regressions
+
+
+def measure_process(tree, repeat=5):
+    '''Measures the tree in a new process with this benchmark code, returns the median time per call of every case.'''
+    with tempfile.TemporaryDirectory() as tmp:
+        output = os.path.join(tmp, 'timings.json')
+        # The modules of the tree are imported, e.g. the ones of the base revision.
+        subprocess.run([sys.executable, os.path.realpath(__file__), '--repeat', str(repeat), '--output', output],
+                       cwd=tree, env=dict(os.environ, PYTHONPATH=tree), check=True)
+        with open(output) as f:
+            return {name: median(timing) for name, timing in load(f).items()}
+
+
+def measure_rounds(repeat=5, rounds=5, base=None):
+    '''Measures this tree, and the base git revision if it is set, in `rounds` processes each, one after another.
+
+    Returns the timings of both, the medians of the rounds per case, so that their spread is the noise of the
+    machine. The base revision is checked out in a temporary worktree and has to include `benchmarks.data` and the
+    functions the cases call.
+    '''
+    timings, base_timings = {}, {}
+    trees = [(ROOT, timings)]
+    with tempfile.TemporaryDirectory() as tmp:
+        if base is not None:
+            worktree = os.path.join(tmp, 'base')
+            subprocess.run(['git', 'worktree', 'add', '--detach', worktree, base], cwd=ROOT, check=True,
+                           stdout=subprocess.DEVNULL)
+            trees.insert(0, (worktree, base_timings))
+        try:
+            for _ in range(rounds):
+                for tree, results in trees:
+                    for name, timing in measure_process(tree, repeat).items():
+                        results.setdefault(name, []).append(timing)
+        finally:
+            if base is not None:
+                subprocess.run(['git', 'worktree', 'remove', '--force', worktree], cwd=ROOT, check=True)
+    return timings, base_timings
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the history models and detect the regressions.')
+    parser.add_argument('--base', help='the git revision to compare with, measured on this machine')
+    parser.add_argument('--baselines', default=BASELINES, help='the baselines JSON file, used without --base')
+    parser.add_argument('--save', action='store_true', help='store the medians as the new baselines')
+    parser.add_argument('--threshold', type=float, default=0.25, help='allowed slowdown, 0.25 is 25%%')
+    parser.add_argument('--repeat', type=int, default=5, help='measurements per case and process')
+    parser.add_argument('--rounds', type=int, default=5, help='measured processes per revision')
+    parser.add_argument('--output', help='measure in this process and write the measurements to the JSON file')
+    args = parser.parse_args(argv)
+    if args.output:
+        with open(args.output, 'w') as f:
+            dump(measure(args.repeat), f)
+        return 0
+    timings, baselines = measure_rounds(args.repeat, args.rounds, args.base)
+    if args.save:
+        os.makedirs(os.path.dirname(os.path.abspath(args.baselines)), exist_ok=True)
+        with open(args.baselines, 'w') as f:
+            dump({name: summarize(timing)[0] for name, timing in timings.items()}, f, indent=2, sort_keys=True)
+            f.write('\n')
+    if not args.base and os.path.exists(args.baselines):
+        with open(args.baselines) as f:
+            baselines = load(f)
+    for name, timing in timings.items():
+        timing, noise = summarize(timing)
+        baseline = summarize(baselines[name])[0] if name in baselines else None
+        print('{name:<20} {timing:10.3f} ms ±{noise:3.0%} {baseline}'.format(
+            name=name, timing=timing * 1000, noise=noise,
+            baseline='(base {:.3f} ms)'.format(baseline * 1000) if baseline else '(no base)'))
+    regressions = compare(timings, baselines, args.threshold) if baselines else []
+    for name, ratio in regressions:
+        print('REGRESSION {name}: {ratio:.2f}x the base'.format(name=name, ratio=ratio))
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
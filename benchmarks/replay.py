@@ -0,0 +1,41 @@
+'''Replays the webhooks recorded with `CHRONOLOGIST_RECORD_PATH`.
+
+The webhooks are posted at their original pace, `--speed` times faster, or with `--max` as fast as `--concurrency`
+allows. Without `--url` the app is served locally against the fakes of the upstreams, like in `benchmarks.webhook`:
+
+    python -m benchmarks.replay recorded.jsonl --speed 10 --workers 4 --output replay.json
+'''
+import argparse
+
+from benchmarks.webhook import add_arguments, benchmark, make_report, post_all, write_report
+from recorder import load
+
+
+def schedule(path, speed=1.0):
+    '''Yields the `(offset, payload)` webhooks of the recording, without offsets if the speed is `None`.'''
+    first = None
+    for recorded_at, payload in load(path):
+        if first is None:
+            first = recorded_at
+        yield (recorded_at - first) / speed if speed is not None else None, payload
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Replay the recorded webhooks.')
+    parser.add_argument('path', help='the recorded JSONL file')
+    pace = parser.add_mutually_exclusive_group()
+    pace.add_argument('--speed', type=float, default=1.0, help='replay N times faster than recorded')
+    pace.add_argument('--max', action='store_true', help='replay as fast as possible')
+    parser.add_argument('--url', help='the running app, e.g. http://127.0.0.1:5000, served locally if not set')
+    add_arguments(parser)
+    args = parser.parse_args(argv)
+    webhooks = schedule(args.path, None if args.max else args.speed)
+    if args.url:
+        report = make_report(args, *post_all(args.url.rstrip('/'), webhooks, args.concurrency))
+    else:
+        report = benchmark(args, webhooks)
+    write_report(report, args.output)
+
+
+if __name__ == '__main__':
+    main()
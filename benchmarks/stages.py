@@ -0,0 +1,76 @@
+'''Per-stage timing of the webhook handling for the benchmarks.'''
+from collections import defaultdict
+from functools import wraps
+from json import dump, load
+from threading import Lock
+import time
+
+from sender import percentile
+
+
+class Stages:
+    '''Thread-safe collection of the stage durations, in seconds.'''
+
+    def __init__(self, samples=None):
+        self._samples = defaultdict(list, samples or {})
+        self._lock = Lock()
+
+    def timed(self, name, func):
+        '''Wraps the function so that its duration is added to the stage.'''
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.add(name, time.perf_counter() - started)
+        return wrapper
+
+    def add(self, name, duration):
+        with self._lock:
+            self._samples[name].append(duration)
+
+    def summary(self):
+        with self._lock:
+            samples = {name: sorted(durations) for name, durations in self._samples.items()}
+        return {name: {
+            'count': len(durations),
+            'mean': sum(durations) / len(durations),
+            'p50': percentile(durations, 50),
+            'p99': percentile(durations, 99),
+            'max': durations[-1],
+        } for name, durations in samples.items() if durations}
+
+    def dump(self, path):
+        with self._lock, open(path, 'w') as f:
+            dump(self._samples, f)
+
+    @classmethod
+    def merge(cls, paths):
+        stages = cls()
+        for path in paths:
+            with open(path) as f:
+                for name, durations in load(f).items():
+                    stages._samples[name].extend(durations)
+        return stages
+
+
+def instrument(app_module, stages, dialogflow_latency=None):
+    '''Times the stages of the already imported `app` module, optionally replaces Dialogflow with the fake.'''
+    from benchmarks.fakes import FakeClientPool
+    from sender import Sender
+
+    bot_ai = app_module.bot_ai
+    if dialogflow_latency is not None:
+        bot_ai.clients = FakeClientPool(dialogflow_latency)
+        client = bot_ai.clients.client
+        client.detect_intent = stages.timed('dialogflow', client.detect_intent)
+    bot_ai.extract_action = stages.timed('extract_action', bot_ai.extract_action)
+    history_api = app_module.history_api
+    history_api._day = stages.timed('history_fetch', history_api._day)
+    app_module.Bot._fetch_history = stages.timed('fetch_history', app_module.Bot._fetch_history)
+    app_module.Bot.post = stages.timed('handle', app_module.Bot.post)
+    if app_module.dispatcher is not None:
+        # The timings of the process workers stay in their processes.
+        app_module.dispatcher.handler = stages.timed('background_handle', app_module.dispatcher.handler)
+    Sender.send = stages.timed('send', Sender.send)
@@ -0,0 +1,253 @@
+'''End-to-end benchmark of the `/bot` webhook.
+
+The history upstream and the Graph API are replaced with local HTTP fakes, Dialogflow with a fake client, all with
+a configurable latency. The webhook is served in-process or by gunicorn with `--workers N` and driven with
+realistic payloads at a fixed rate:
+
+    python -m benchmarks.webhook --rate 50 --duration 30 --workers 4 --output run.json
+'''
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from threading import BoundedSemaphore, local, Thread
+import argparse
+import json
+import os
+import random
+import requests
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks import fakes
+from benchmarks.stages import Stages, instrument
+from sender import percentile
+
+
+# The mix of the incoming messages, the history questions dominate.
+TEXTS = (
+    (30, 'What happened today?'),
+    (20, 'May 27'),
+    (10, 'tell me about 3 March'),
+    (10, 'what happened on 9 May 1945'),
+    (10, 'July 20 in the 1960s'),
+    (5, 'What happened in the 19th century on this day'),
+    (5, '100 years ago today'),
+    (5, 'more'),
+    (5, 'Hi'),
+)
+
+
+def webhook(rng, batch_size, senders):
+    '''Builds the webhook payload with `batch_size` messages of random senders.'''
+    weights, texts = zip(*TEXTS)
+    now = int(time.time() * 1000)
+    return {'object': 'page', 'entry': [{
+        'id': 'page',
+        'time': now,
+        'messaging': [{
+            'sender': {'id': str(rng.randrange(senders))},
+            'recipient': {'id': 'page'},
+            'timestamp': now,
+            'message': {'mid': 'mid.%d' % rng.getrandbits(32), 'text': rng.choices(texts, weights)[0]},
+        } for _ in range(batch_size)],
+    }]}
+
+
+def serve_in_process(dialogflow_latency):
+    '''Serves the instrumented app in this process, returns its URL, the stages and a function to stop it.'''
+    from werkzeug.serving import make_server
+    import app as chronologist
+
+    stages = Stages()
+    instrument(chronologist, stages, dialogflow_latency)
+    server = make_server('127.0.0.1', 0, chronologist.app, threaded=True)
+    Thread(target=server.serve_forever, daemon=True).start()
+    return 'http://127.0.0.1:%d' % server.server_port, lambda: stages, server.shutdown
+
+
+def serve_gunicorn(workers, threads, dialogflow_latency, port):
+    '''Starts gunicorn with the instrumented app, returns its URL, the stages and a function to stop it.'''
+    stages_dir = tempfile.mkdtemp(prefix='chronologist-bench-')
+    if not port:
+        with socket.socket() as s:
+            s.bind(('127.0.0.1', 0))
+            port = s.getsockname()[1]
+    env = dict(os.environ, BENCH_DIALOGFLOW_LATENCY=str(dialogflow_latency), BENCH_STAGES_DIR=stages_dir)
+    process = subprocess.Popen([sys.executable, '-m', 'gunicorn', '--workers', str(workers), '--threads', str(threads),
+                                '--bind', '127.0.0.1:%d' % port, '--config', 'python:benchmarks.gunicorn_conf',
+                                'benchmarks.wsgi:app'], env=env)
+    url = 'http://127.0.0.1:%d' % port
+    deadline = time.monotonic() + 30
+    while True:
+        try:
+            requests.get(url + '/', timeout=1)
+            break
+        except requests.RequestException:
+            if process.poll() is not None or time.monotonic() > deadline:
+                process.kill()
+                raise RuntimeError('gunicorn did not start')
+            time.sleep(0.1)
+
+    def stop():
+        process.terminate()
+        process.wait(30)
+
+    def stages():
+        paths = [os.path.join(stages_dir, name) for name in os.listdir(stages_dir)]
+        return Stages.merge(paths)
+
+    return url, stages, stop
+
+
+def post_all(url, schedule, concurrency):
+    '''Posts the `(offset, payload)` webhooks at their offsets in seconds from the start (open loop).
+
+    Returns the latencies, the errors and the elapsed time. The latency is measured from the scheduled time, so the
+    queueing in the client counts too. The webhooks with the `None` offset are posted as fast as possible and their
+    latency is measured from the time they are actually posted.
+    '''
+    sessions = local()
+    latencies, errors = [], []
+
+    def post(scheduled, payload):
+        if not hasattr(sessions, 'session'):
+            sessions.session = requests.Session()
+        if scheduled is None:
+            scheduled = time.monotonic()
+        try:
+            response = sessions.session.post(url + '/bot', json=payload, timeout=30)
+            if response.status_code != 200:
+                errors.append(response.status_code)
+                return
+        except requests.RequestException as e:
+            errors.append(type(e).__name__)
+            return
+        latencies.append(time.monotonic() - scheduled)
+
+    with ThreadPoolExecutor(concurrency) as executor:
+        started = time.monotonic()
+        in_flight = BoundedSemaphore(concurrency)
+        for offset, payload in schedule:
+            scheduled = None
+            if offset is not None:
+                scheduled = started + offset
+                delay = scheduled - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+            else:
+                # Do not queue more than the workers can take, the queued time is not measured.
+                in_flight.acquire()
+            future = executor.submit(post, scheduled, payload)
+            if offset is None:
+                future.add_done_callback(lambda _: in_flight.release())
+    elapsed = time.monotonic() - started
+    return latencies, errors, elapsed
+
+
+def generate(rate, duration, batch_size, senders, seed=0):
+    '''Yields the `(offset, payload)` webhooks at `rate` per second.'''
+    rng = random.Random(seed)
+    for i in range(int(rate * duration)):
+        yield i / rate, webhook(rng, batch_size, senders)
+
+
+def drain(server, timeout):
+    '''Waits for the background workers to send the replies, until no new message arrives for a while.'''
+    deadline = time.monotonic() + timeout
+    previous = -1
+    while server.requests != previous and time.monotonic() < deadline:
+        previous = server.requests
+        time.sleep(0.5)
+
+
+def summary(latencies):
+    latencies = sorted(latencies)
+    if not latencies:
+        return {}
+    return {
+        'mean': sum(latencies) / len(latencies),
+        'p50': percentile(latencies, 50),
+        'p90': percentile(latencies, 90),
+        'p99': percentile(latencies, 99),
+        'max': latencies[-1],
+    }
+
+
+def benchmark(args, schedule):
+    '''Serves the app against the fakes and posts the scheduled webhooks, returns the report.'''
+    history, history_url = fakes.start(fakes.FakeHistory, args.history_latency, entries=args.entries)
+    graph, graph_url = fakes.start(fakes.FakeGraph, args.graph_latency)
+    # The app reads its config on import.
+    os.environ.update(CHRONOLOGIST_HISTORY_BASE_URL=history_url, CHRONOLOGIST_MESSENGER_GRAPH_API_URL=graph_url,
+                      CHRONOLOGIST_ACCESS_TOKEN='bench')
+    if args.workers:
+        url, stages, stop = serve_gunicorn(args.workers, args.threads, args.dialogflow_latency, args.port)
+    else:
+        url, stages, stop = serve_in_process(args.dialogflow_latency)
+    try:
+        latencies, errors, elapsed = post_all(url, schedule, args.concurrency)
+        if args.drain:
+            drain(graph, args.drain)
+    finally:
+        stop()
+    history.shutdown()
+    graph.shutdown()
+    report = make_report(args, latencies, errors, elapsed)
+    report.update(stages=stages().summary(), upstream={'history': history.requests, 'graph': graph.requests})
+    return report
+
+
+def make_report(args, latencies, errors, elapsed):
+    return {
+        'started': datetime.utcnow().isoformat() + 'Z',
+        'config': vars(args),
+        'requests': len(latencies) + len(errors),
+        'errors': len(errors),
+        'throughput': len(latencies) / elapsed if elapsed else None,
+        'latency': summary(latencies),
+    }
+
+
+def run(args):
+    return benchmark(args, generate(args.rate, args.duration, args.batch_size, args.senders, args.seed))
+
+
+def add_arguments(parser):
+    '''Adds the options of the served app and of the fakes.'''
+    parser.add_argument('--workers', type=int, default=0, help='gunicorn workers, 0 to serve in-process')
+    parser.add_argument('--threads', type=int, default=1, help='threads per gunicorn worker')
+    parser.add_argument('--port', type=int, default=0, help='the gunicorn port, a free one by default')
+    parser.add_argument('--concurrency', type=int, default=64, help='max webhooks in flight')
+    parser.add_argument('--entries', type=int, default=300, help='history entries per category of a day')
+    parser.add_argument('--dialogflow-latency', type=float, default=0.15, help='seconds')
+    parser.add_argument('--history-latency', type=float, default=0.3, help='seconds')
+    parser.add_argument('--graph-latency', type=float, default=0.1, help='seconds')
+    parser.add_argument('--drain', type=float, default=0, help='seconds to wait for the background replies')
+    parser.add_argument('--output', help='the JSON report, printed if not set')
+
+
+def write_report(report, output=None):
+    if output:
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the /bot webhook against local fakes of the upstreams.')
+    add_arguments(parser)
+    parser.add_argument('--rate', type=float, default=20, help='webhooks per second')
+    parser.add_argument('--duration', type=float, default=10, help='seconds')
+    parser.add_argument('--batch-size', type=int, default=1, help='messages per webhook')
+    parser.add_argument('--senders', type=int, default=1000, help='distinct users')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+    write_report(run(args), args.output)
+
+
+if __name__ == '__main__':
+    main()
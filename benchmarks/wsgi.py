@@ -0,0 +1,19 @@
+'''Instrumented app for the gunicorn workers of the benchmark, see `benchmarks/gunicorn_conf.py`.
+
+The upstream URLs are passed in the `CHRONOLOGIST_*` env vars, the latency of the fake Dialogflow in
+`BENCH_DIALOGFLOW_LATENCY` and the directory for the stage timings in `BENCH_STAGES_DIR`.
+'''
+import os
+
+import app as chronologist
+from benchmarks.stages import Stages, instrument
+
+
+stages = Stages()
+instrument(chronologist, stages, float(os.environ.get('BENCH_DIALOGFLOW_LATENCY', 0)))
+app = chronologist.app
+
+
+def dump_stages():
+    '''Writes the stage timings of this worker process, the runner merges the files of all the workers.'''
+    stages.dump(os.path.join(os.environ['BENCH_STAGES_DIR'], '{pid}.json'.format(pid=os.getpid())))
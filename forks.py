@@ -0,0 +1,57 @@
+from threading import Lock
+import os
+import weakref
+
+
+class PerProcess:
+    '''Value which belongs to the process which created it, e.g. a thread pool, a background thread or a connection.
+
+    The value is created by `factory()` on the first `get` in every process, so that its owner can be created before
+    gunicorn forks the workers.
+    '''
+
+    def __init__(self, factory):
+        self.factory = factory
+        self._value = None
+        self._pid = None
+        self._lock = Lock()
+        register(self)
+
+    def get(self):
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._value = self.factory()
+                    self._pid = os.getpid()
+        return self._value
+
+    def current(self):
+        '''Returns the value of this process, or `None` if it has not been created here.'''
+        return self._value if self._pid == os.getpid() else None
+
+    def clear(self):
+        '''Forgets the value of this process and returns it, e.g. to shut it down.'''
+        with self._lock:
+            value = self.current()
+            self._value, self._pid = None, None
+            return value
+
+    def _after_fork(self):
+        # The lock may have been held by another thread of the parent while forking.
+        self._lock = Lock()
+
+
+_instances = weakref.WeakSet()
+
+
+def register(instance):
+    '''Calls `instance._after_fork()` in the forked children, e.g. to drop the state of the threads of the parent.'''
+    _instances.add(instance)
+
+
+def _after_fork():
+    for instance in list(_instances):
+        instance._after_fork()
+
+
+os.register_at_fork(after_in_child=_after_fork)
@@ -0,0 +1,24 @@
+'''gunicorn settings of the app, every worker of the preloaded app starts its own background workers.'''
+
+
+def when_ready(server):
+    '''Stops the background workers of the app preloaded by the master, every worker starts its own.
+
+    The running warm-up is finished first, so that the workers are not forked in the middle of a fetch.
+    '''
+    if server.cfg.preload_app:
+        from app import dispatcher, history_warmer
+        if dispatcher is not None:
+            dispatcher.shutdown()
+        if history_warmer is not None:
+            history_warmer.stop()
+
+
+def post_fork(server, worker):
+    '''Starts the background workers of the preloaded app in the worker, the processes before it runs any threads.'''
+    if server.cfg.preload_app:
+        from app import dispatcher, history_warmer
+        if dispatcher is not None and dispatcher.mode == 'process':
+            dispatcher.start()
+        if history_warmer is not None:
+            history_warmer.start()
@@ -1,36 +1,140 @@
+from history.cache import SingleFlight
 from history.models import Results
-from history.utils import year_to_int
+from history.utils import loads, year_to_int
+from metrics import NullMetrics
+from resilience import NullBreaker
 
+from requests.adapters import HTTPAdapter
 from urllib.parse import urljoin
 import requests
+import time
 
 
 class API:
     '''Simple wrapper around http://history.muffinlabs.com/.'''
 
-    def __init__(self, base_url='http://history.muffinlabs.com'):
+    # Statuses of the responses which are retried like the failed connections.
+    RETRY_STATUSES = (500, 502, 503, 504)
+
+    def __init__(self, base_url='http://history.muffinlabs.com', cache=None, pool_size=10, connect_timeout=3.05,
+                 read_timeout=10, retries=2, backoff_factor=0.3, metrics=None, breaker=None, fallback=None):
         self.base_url = base_url
+        # Optional `history.cache.Cache` of the parsed results per endpoint.
+        self.cache = cache
+        # Optional `metrics.Metrics` which times the fetches.
+        self.metrics = metrics if metrics is not None else NullMetrics()
+        # Optional `resilience.CircuitBreaker` of the upstream.
+        self.breaker = breaker if breaker is not None else NullBreaker()
+        # Optional `API`, e.g. a `SnapshotAPI`, which answers when the upstream fails and nothing is cached.
+        self.fallback = fallback
+        self.fallbacks = {'cache': 0, 'fallback': 0}
+        self.timeout = (connect_timeout, read_timeout)
+        # The failed requests are retried by `_fetch_raw`, so that the retries are bounded by the deadline.
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        # Keep-alive connections are pooled by the session.
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        # The concurrent fetches of the same endpoint share one upstream request.
+        self.flights = SingleFlight()
 
-    def today(self):
+    def today(self, timeout=None, deadline=None):
         '''Get the todays events.'''
         endpoint = urljoin(self.base_url, 'date')
-        return self._fetch(endpoint)
+        try:
+            return self._fetch(endpoint, timeout, deadline)
+        except Exception as error:
+            return self._degrade(error, endpoint)
+
+    def date(self, month, day, year=None, year_range=None, timeout=None, deadline=None):
+        '''Get the events for the specific date, optionally only of the year or the inclusive range of years.
 
-    def date(self, month, day, year=None):
-        '''Get the events for the specific date.'''
+        The `timeout` limits the wait for the fetch of the same date started by another caller, then `TimeoutError`
+        is raised. The `resilience.Deadline` bounds the whole fetch. When the upstream fails or the deadline is
+        exceeded, the last cached results or the results of the fallback are returned if there are any.
+        '''
         assert 1 <= month <= 12
         assert 1 <= day <= 31
-        endpoint = urljoin(self.base_url, 'date/{month}/{day}'.format(month=month, day=day))
+        if year_range is not None:
+            start, end = year_range
+            assert isinstance(start, int) and isinstance(end, int)
+            assert start <= end
+            return self._day(month, day, timeout, deadline).search_range(start, end)
         if year is not None:
             assert isinstance(year, str)
             assert isinstance(year_to_int(year), int)
-            return self._fetch(endpoint).search(year)
-        return self._fetch(endpoint)
+            return self._day(month, day, timeout, deadline).search(year)
+        return self._day(month, day, timeout, deadline)
+
+    def _day(self, month, day, timeout=None, deadline=None):
+        '''Get all the results for the specific date.'''
+        endpoint = self._date_endpoint(month, day)
+        try:
+            return self._fetch(endpoint, timeout, deadline)
+        except Exception as error:
+            return self._degrade(error, endpoint, month, day)
+
+    def _date_endpoint(self, month, day):
+        return urljoin(self.base_url, 'date/{month}/{day}'.format(month=month, day=day))
 
-    def _fetch(self, endpoint):
+    def _fetch(self, endpoint, timeout=None, deadline=None):
         '''Helper method to communicate with the data provider.'''
-        r = requests.get(endpoint)
-        if r.status_code == requests.codes.ok:
-            return Results(r.json())
-        raise ValueError('Got invalid status code {status_code} when trying to access the endpoint {endpoint}'
-                         .format(endpoint=endpoint, status_code=r.status_code))
+        with self.metrics.track('history_fetch'):
+            if self.cache is not None:
+                # The stale results are refreshed in the background regardless of the budget of the caller.
+                return self.cache.get(endpoint, lambda: self._load(endpoint, timeout, deadline),
+                                      lambda: self._load(endpoint))
+            return self._load(endpoint, timeout, deadline)
+
+    def _load(self, endpoint, timeout=None, deadline=None):
+        if deadline is not None:
+            timeout = deadline.timeout(timeout)
+        return self.flights.do(endpoint, lambda: Results(self._fetch_raw(endpoint, deadline)), timeout)
+
+    def _fetch_raw(self, endpoint, deadline=None):
+        '''Fetches the endpoint and returns the decoded JSON payload.
+
+        The failed connections and the 5xx responses are retried with a backoff. With a `resilience.Deadline` every
+        attempt is bounded by the remaining budget, and no attempt is started once the budget is spent.
+        '''
+        with self.metrics.track('history_upstream'), self.breaker.protect(deadline=deadline):
+            error = None
+            for attempt in range(self.retries + 1):
+                if attempt:
+                    # The backoff of urllib3: no wait before the first retry, then doubled.
+                    backoff = self.backoff_factor * 2 ** (attempt - 1) if attempt > 1 else 0
+                    if deadline is not None and deadline.remaining() <= backoff:
+                        raise error
+                    time.sleep(backoff)
+                timeout = tuple(deadline.timeout(t) for t in self.timeout) if deadline is not None else self.timeout
+                try:
+                    r = self.session.get(endpoint, timeout=timeout)
+                except (requests.ConnectionError, requests.Timeout) as e:
+                    error = e
+                    continue
+                if r.status_code == requests.codes.ok:
+                    # The raw bytes are decoded at once, without guessing the encoding of the text.
+                    return loads(r.content)
+                error = ValueError('Got invalid status code {status_code} when trying to access the endpoint '
+                                   '{endpoint}'.format(endpoint=endpoint, status_code=r.status_code))
+                if r.status_code not in self.RETRY_STATUSES:
+                    break
+            raise error
+
+    def _degrade(self, error, endpoint, month=None, day=None):
+        '''Returns the last cached results or the results of the fallback, otherwise raises the error.'''
+        results = self.cache.peek(endpoint) if self.cache is not None else None
+        if results is not None:
+            self.fallbacks['cache'] += 1
+            return results
+        if self.fallback is not None and month is not None:
+            try:
+                results = self.fallback.date(month, day)
+            except Exception:
+                results = None
+            if results is not None:
+                self.fallbacks['fallback'] += 1
+                return results
+        raise error
@@ -0,0 +1,189 @@
+from collections import OrderedDict
+from threading import Event, Lock, Thread
+import time
+
+from forks import register
+
+
+class Cache:
+    '''Size-bounded LRU cache with a TTL.
+
+    Entries older than `ttl` but younger than `ttl + stale_ttl` are still served, while a single background
+    refresh per key reloads them. Entries older than that are reloaded synchronously. The forked processes inherit
+    the entries, but not the refreshes.
+    '''
+
+    def __init__(self, maxsize=64, ttl=3600, stale_ttl=86400, clock=time.monotonic):
+        assert maxsize > 0
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.clock = clock
+        self._items = OrderedDict()
+        self._refreshing = {}
+        self._lock = Lock()
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.refresh_errors = 0
+        register(self)
+
+    def get(self, key, loader, refresher=None):
+        '''Returns the cached value for the key, calls `loader()` to (re)load it if needed.
+
+        The background refreshes call `refresher()` instead if it is set, e.g. without the limits of the caller.
+        '''
+        with self._lock:
+            item = self._items.get(key)
+            if item is not None:
+                value, loaded_at = item
+                age = self.clock() - loaded_at
+                if age < self.ttl:
+                    self.hits += 1
+                    self._items.move_to_end(key)
+                    return value
+                if age < self.ttl + self.stale_ttl:
+                    self.stale_hits += 1
+                    self._items.move_to_end(key)
+                    if key not in self._refreshing:
+                        thread = Thread(target=self._refresh, args=(key, refresher or loader), daemon=True)
+                        self._refreshing[key] = thread
+                        thread.start()
+                    return value
+            self.misses += 1
+        value = loader()
+        self.set(key, value)
+        return value
+
+    def lookup(self, key):
+        '''Returns the cached value for the key if it is not expired, otherwise `None`.'''
+        with self._lock:
+            item = self._items.get(key)
+            if item is not None and self.clock() - item[1] < self.ttl:
+                self.hits += 1
+                self._items.move_to_end(key)
+                return item[0]
+            self.misses += 1
+            return None
+
+    def peek(self, key):
+        '''Returns the cached value for the key however old it is, otherwise `None`. The stats are not changed.'''
+        with self._lock:
+            item = self._items.get(key)
+            return item[0] if item is not None else None
+
+    def set(self, key, value):
+        with self._lock:
+            self._items[key] = (value, self.clock())
+            self._items.move_to_end(key)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def join(self, timeout=None):
+        '''Waits for the running background refreshes to finish.'''
+        with self._lock:
+            threads = list(self._refreshing.values())
+        for thread in threads:
+            thread.join(timeout)
+
+    def _refresh(self, key, loader):
+        try:
+            self.set(key, loader())
+        except Exception:
+            # Keep serving the stale value, the next stale hit will retry.
+            with self._lock:
+                self.refresh_errors += 1
+        finally:
+            with self._lock:
+                del self._refreshing[key]
+
+    def _after_fork(self):
+        # The refreshing threads don't exist in the child, the lock may have been held by one of them.
+        self._refreshing = {}
+        self._lock = Lock()
+
+    @property
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._items),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'stale_hits': self.stale_hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'refresh_errors': self.refresh_errors,
+            }
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+
+class SingleFlight:
+    '''Coalesces the concurrent calls with the same key into one call.
+
+    The first caller runs the function, the others wait for its result for up to their own timeout and raise
+    `TimeoutError` after it, while the call goes on for the rest. An error is raised in all the waiting callers and
+    is not remembered, the next call runs the function again. The calls in flight are not inherited by the forked
+    processes, which run the function themselves.
+    '''
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = Lock()
+        self.calls = 0
+        self.coalesced = 0
+        register(self)
+
+    def do(self, key, func, timeout=None):
+        with self._lock:
+            call = self._calls.get(key)
+            if call is None:
+                call = self._calls[key] = _Call()
+                self.calls += 1
+                leader = True
+            else:
+                self.coalesced += 1
+                leader = False
+        if leader:
+            try:
+                call.result = func()
+            except BaseException as e:
+                call.error = e
+                raise
+            finally:
+                with self._lock:
+                    del self._calls[key]
+                call.done.set()
+            return call.result
+        if not call.done.wait(timeout):
+            raise TimeoutError('Timed out waiting for {key}'.format(key=key))
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    @property
+    def stats(self):
+        with self._lock:
+            return {'calls': self.calls, 'coalesced': self.coalesced, 'in_flight': len(self._calls)}
+
+    def _after_fork(self):
+        # The leaders of the calls in flight are threads of the parent, nothing would complete the calls here.
+        self._calls = {}
+        self._lock = Lock()
+
+
+class _Call:
+    def __init__(self):
+        self.done = Event()
+        self.result = None
+        self.error = None
@@ -0,0 +1,173 @@
+'''Full-text inverted index over the entries of all the days in the local history store.
+
+The index is built offline from the store with:
+
+    python -m history.index build /path/to/store /path/to/index
+'''
+from array import array
+from collections import namedtuple
+import argparse
+import math
+import os
+import pickle
+import re
+import tempfile
+import zlib
+
+from history.models import Results
+from history.store import Store, days
+
+
+WORD_REGEXP = re.compile(r'\w+')
+CATEGORIES = ('events', 'births', 'deaths')
+# Question words which would match too many entries.
+STOPWORDS = frozenset((
+    'a', 'about', 'an', 'and', 'are', 'as', 'at', 'by', 'did', 'do', 'does', 'for', 'from', 'happen', 'happened',
+    'how', 'in', 'is', 'it', 'of', 'on', 'or', 'the', 'to', 'was', 'were', 'what', 'when', 'which', 'who', 'with',
+))
+# Words of the question which point to the category of the entry instead of its text.
+CATEGORY_HINTS = {'born': 'births', 'birth': 'births', 'birthday': 'births', 'died': 'deaths', 'death': 'deaths',
+                  'die': 'deaths', 'dead': 'deaths'}
+FORMAT_VERSION = 2
+
+Hit = namedtuple('Hit', ('score', 'month', 'day', 'category', 'index', 'checksum'))
+
+
+def tokenize(text):
+    return [word for word in WORD_REGEXP.findall(text.lower()) if len(word) > 1 and word not in STOPWORDS]
+
+
+def checksum(text):
+    return zlib.crc32((text or '').encode('utf-8'))
+
+
+class Index:
+    '''Inverted index with BM25 ranking.
+
+    The documents are the entries of the `Results` containers, referenced by the day, the category and the index
+    within the container, with the checksum of the entry text to recognize the entries which have changed since. The
+    postings of all the terms are kept in a few flat arrays.
+    '''
+
+    K1 = 1.2
+    B = 0.75
+
+    def __init__(self, terms, doc_ids, frequencies, months, days, categories, indices, lengths, checksums):
+        # Term -> `(start, stop)` range of its postings in `doc_ids` and `frequencies`.
+        self.terms = terms
+        self.doc_ids = doc_ids
+        self.frequencies = frequencies
+        self.months = months
+        self.days = days
+        self.categories = categories
+        self.indices = indices
+        self.lengths = lengths
+        self.checksums = checksums
+        self._average_length = sum(lengths) / len(lengths) if lengths else 0
+
+    @classmethod
+    def build(cls, results_per_day):
+        '''Builds the index from the `((month, day), Results)` pairs.'''
+        postings = {}
+        months, days_, categories, indices, lengths = array('B'), array('B'), array('B'), array('I'), array('H')
+        checksums = array('I')
+        for (month, day), results in results_per_day:
+            for category_id, category in enumerate(CATEGORIES):
+                for i, entry in enumerate(getattr(results, category)):
+                    words = tokenize(' '.join([entry.text or ''] + [link.title or '' for link in entry.links]))
+                    doc_id = len(lengths)
+                    months.append(month)
+                    days_.append(day)
+                    categories.append(category_id)
+                    indices.append(i)
+                    lengths.append(min(len(words), 0xffff))
+                    checksums.append(checksum(entry.text))
+                    counts = {}
+                    for word in words:
+                        counts[word] = counts.get(word, 0) + 1
+                    for word, count in counts.items():
+                        postings.setdefault(word, []).append((doc_id, count))
+        terms, doc_ids, frequencies = {}, array('I'), array('H')
+        for term in sorted(postings):
+            terms[term] = (len(doc_ids), len(doc_ids) + len(postings[term]))
+            for doc_id, count in postings[term]:
+                doc_ids.append(doc_id)
+                frequencies.append(min(count, 0xffff))
+        return cls(terms, doc_ids, frequencies, months, days_, categories, indices, lengths, checksums)
+
+    @classmethod
+    def build_from_store(cls, store):
+        return cls.build(((month, day), Results(store.load(month, day))) for month, day in days())
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as f:
+            data = pickle.load(f)
+        if data.pop('version') != FORMAT_VERSION:
+            raise ValueError('The index {path} has an unsupported format, rebuild it'.format(path=path))
+        return cls(**data)
+
+    def save(self, path):
+        '''Atomically writes the index to the file.'''
+        data = {name: getattr(self, name) for name in ('terms', 'doc_ids', 'frequencies', 'months', 'days',
+                                                         'categories', 'indices', 'lengths', 'checksums')}
+        data['version'] = FORMAT_VERSION
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    def search(self, query, limit=3):
+        '''Returns the best `Hit`s for the query, the entries of the hinted category (e.g. "born") rank higher.'''
+        words = WORD_REGEXP.findall(query.lower())
+        hinted = set(CATEGORIES.index(CATEGORY_HINTS[word]) for word in words if word in CATEGORY_HINTS)
+        scores = {}
+        total = len(self.lengths)
+        for term in set(tokenize(query)) - set(CATEGORY_HINTS):
+            if term not in self.terms:
+                continue
+            start, stop = self.terms[term]
+            idf = math.log(1 + (total - (stop - start) + 0.5) / (stop - start + 0.5))
+            for i in range(start, stop):
+                doc_id, frequency = self.doc_ids[i], self.frequencies[i]
+                norm = self.K1 * (1 - self.B + self.B * self.lengths[doc_id] / self._average_length)
+                scores[doc_id] = scores.get(doc_id, 0) + idf * frequency * (self.K1 + 1) / (frequency + norm)
+        if hinted:
+            for doc_id in scores:
+                if self.categories[doc_id] in hinted:
+                    scores[doc_id] *= 2
+        best = sorted(scores.items(), key=lambda item: (-item[1], item[0]))[:limit]
+        return [Hit(score, self.months[doc_id], self.days[doc_id], CATEGORIES[self.categories[doc_id]],
+                    self.indices[doc_id], self.checksums[doc_id]) for doc_id, score in best]
+
+    @staticmethod
+    def resolve(hit, results):
+        '''Returns the entry of the `Results` the hit points to, or `None` if the entry is not the indexed one.'''
+        entries = getattr(results, hit.category)
+        if hit.index < len(entries) and checksum(entries[hit.index].text) == hit.checksum:
+            return entries[hit.index]
+        return None
+
+    def __len__(self):
+        return len(self.lengths)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Manage the full-text history index.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    build_parser = subparsers.add_parser('build', help='index all the 366 days of the local store')
+    build_parser.add_argument('store', help='the store directory')
+    build_parser.add_argument('path', help='the index file')
+    args = parser.parse_args(argv)
+    if args.command == 'build':
+        index = Index.build_from_store(Store(args.store))
+        index.save(args.path)
+        print('Indexed {entries} entries into {path}'.format(entries=len(index), path=args.path))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,78 +1,173 @@
-from bisect import bisect_left
-from functools import partial
+from array import array
+from bisect import bisect_left, bisect_right
 
-from history.utils import birth_template, death_template, event_template, year_to_int
+from history import utils
+from history.utils import century_range, decade_range, year_to_int
 
 
-class Container(tuple):
-    '''Container class for the entries from http://history.muffinlabs.com/.'''
+def resolve_template(template):
+    '''Returns the template function, looks up the template by its name in `history.utils`.'''
+    return getattr(utils, template) if isinstance(template, str) else template
 
-    def __new__(cls, data, wrapper, key=None, key_converter=None):
+
+class Container:
+    '''Container class for the entries from http://history.muffinlabs.com/.
+
+    The entries are stored column-wise, one list per field of the wrapper, and the wrapper views are only created
+    when the entries are accessed. The template is a function or the name of a template in `history.utils`, which is
+    looked up when rendering, so that the replaced templates are used after `utils.invalidate_templates`.
+    '''
+
+    def __init__(self, data, wrapper, key=None, key_converter=None, template=None):
         assert bool(key) == bool(key_converter), \
             'Both `key` and `key_converter` have to be either set or unset'
-        if key is not None:
-            # Sanitize the data so that it is searchable.
-            data = filter(lambda entry: key in entry and key_converter(entry[key]), data)
-        return super(Container, cls).__new__(cls, tuple(data))
-
-    def __init__(self, data, wrapper, key=None, key_converter=None):
         self.wrapper = wrapper
         self.key = key
         self.key_converter = key_converter
-        if self.key is not None:
-            self._keys = [self._to_int(getattr(entry, self.key)) for entry in self]
+        self.template = template
+        if key is not None:
+            # Sanitize the data so that it is searchable.
+            keys = [(key_converter(entry[key]) if key in entry else None, entry) for entry in data]
+            keys = [(converted, entry) for converted, entry in keys if converted]
+            data = [entry for _, entry in keys]
+            self._keys = array('l', (converted for converted, _ in keys))
+            # The entries are sorted by the key, so the entries with the same key form a contiguous range.
+            self._index = {}
+            for i, converted in enumerate(self._keys):
+                start, stop = self._index.get(converted, (i, i))
+                if stop == i:
+                    self._index[converted] = (start, i + 1)
+        else:
+            data = list(data)
+        self.columns = {field: [entry.get(field) for entry in data] for field in wrapper.fields}
+        self._length = len(data)
+        self._rendered = None
+        self._rendered_generation = None
 
     def search(self, term):
         if self.key is not None:
-            _term = self._to_int(term)
-            i = 0
-            r = []
-            while i < len(self):
-                i += bisect_left(self._keys[i:], _term)
-                if i < len(self):
-                    key = getattr(self[i], self.key)
-                else:
-                    return r
-                if key == term:
-                    r.append(self[i])
-                else:
-                    return r
-                i += 1
-            return r
-        raise RuntimeError('Cannot perform the bisection - the key was not set')
+            start, stop = self._bounds(term)
+            return self[start:stop]
+        raise RuntimeError('Cannot perform the search - the key was not set')
+
+    def search_range(self, start, end):
+        '''Returns the entries with the integer key within the inclusive `[start, end]` range.'''
+        if self.key is not None:
+            return self[bisect_left(self._keys, start):bisect_right(self._keys, end)]
+        raise RuntimeError('Cannot perform the search - the key was not set')
+
+    def render(self, index):
+        '''Returns the text of the entry rendered with the template, memoized until the templates change.'''
+        if self._rendered_generation != utils.TEMPLATES_GENERATION:
+            self._rendered = [None] * self._length
+            self._rendered_generation = utils.TEMPLATES_GENERATION
+        text = self._rendered[index]
+        if text is None:
+            text = self._rendered[index] = resolve_template(self.template)(self.columns['year'][index],
+                                                                           self.columns['text'][index])
+        return text
+
+    def prerender(self):
+        '''Renders all the entries in advance.'''
+        for i in range(self._length):
+            self.render(i)
+
+    def _bounds(self, term):
+        '''Returns the `(start, stop)` index range of the entries with the key equal to the term.'''
+        return self._index.get(self._to_int(term), (0, 0))
 
     def _to_int(self, value):
         return self.key_converter(value)
 
     def __getitem__(self, key):
         if isinstance(key, slice):
-            return [self[i] for i in range(*key.indices(len(self)))]
-        return self.wrapper(super(Container, self).__getitem__(key))
+            return [self.wrapper(self, i) for i in range(*key.indices(self._length))]
+        if key < 0:
+            key += self._length
+        if not 0 <= key < self._length:
+            raise IndexError('Container index is out of range')
+        return self.wrapper(self, key)
 
     def __iter__(self):
-        for item in super(Container, self).__iter__():
-            yield self.wrapper(item)
+        for i in range(self._length):
+            yield self.wrapper(self, i)
+
+    def __len__(self):
+        return self._length
 
 
 class Results:
-    '''Data structure that represents the results from http://history.muffinlabs.com/.'''
+    '''Data structure that represents the results from http://history.muffinlabs.com/.
+
+    The categories are only wrapped into the containers when they are accessed, e.g. a lookup of an event never
+    touches the births and the deaths.
+    '''
+
+    CATEGORIES = {'events': ('Events', 'event_template'), 'births': ('Births', 'birth_template'),
+                  'deaths': ('Deaths', 'death_template')}
 
     def __init__(self, data, events=None, births=None, deaths=None):
-        self._raw = data
         self.date = data['date']
         self.url = data['url']
-        events_wrapper = partial(Entry, template=event_template)
-        births_wrapper = partial(Entry, template=birth_template)
-        deaths_wrapper = partial(Entry, template=death_template)
-        self.events = Container(data['data']['Events'], events_wrapper, 'year', year_to_int) if events is None else \
-            events
-        self.births = Container(data['data']['Births'], births_wrapper, 'year', year_to_int) if births is None else \
-            births
-        self.deaths = Container(data['data']['Deaths'], deaths_wrapper, 'year', year_to_int) if deaths is None else \
-            deaths
+        self._data = data.get('data')
+        self._events = events
+        self._births = births
+        self._deaths = deaths
+
+    @property
+    def events(self):
+        return self._events if self._events is not None else self._wrap('events')
+
+    @property
+    def births(self):
+        return self._births if self._births is not None else self._wrap('births')
+
+    @property
+    def deaths(self):
+        return self._deaths if self._deaths is not None else self._wrap('deaths')
+
+    def _wrap(self, name):
+        data = self._data
+        if data is None:
+            # All the categories were wrapped concurrently.
+            return getattr(self, '_' + name)
+        category, template = self.CATEGORIES[name]
+        container = Container(data[category], Entry, 'year', year_to_int, template)
+        # A concurrent access may wrap the category twice, both containers are equal.
+        setattr(self, '_' + name, container)
+        if self._events is not None and self._births is not None and self._deaths is not None:
+            # The raw payload is not needed anymore.
+            self._data = None
+        return container
 
     def search(self, term):
-        return Results(self._raw, self.events.search(term), self.births.search(term), self.deaths.search(term))
+        return self._derive(self.events.search(term), self.births.search(term), self.deaths.search(term))
+
+    def search_range(self, start, end):
+        '''Search the entries within the inclusive range of years, BC years are negative.'''
+        return self._derive(self.events.search_range(start, end), self.births.search_range(start, end),
+                            self.deaths.search_range(start, end))
+
+    def decade(self, year, bc=False):
+        '''Search the entries of the decade which starts with the year, e.g. 1940 for the 1940s.'''
+        return self.search_range(*decade_range(year, bc))
+
+    def century(self, century, bc=False):
+        '''Search the entries of the century, e.g. 17 for the 17th century.'''
+        return self.search_range(*century_range(century, bc))
+
+    def prerender(self):
+        '''Renders all the entries in advance, e.g. before the results are cached.'''
+        for container in (self.events, self.births, self.deaths):
+            if hasattr(container, 'prerender'):
+                container.prerender()
+            else:
+                for entry in container:
+                    str(entry)
+        return self
+
+    def _derive(self, events, births, deaths):
+        return Results({'date': self.date, 'url': self.url}, events, births, deaths)
 
     def __iter__(self):
         for event in self.events:
@@ -101,24 +196,53 @@ class Results:
 
 
 class Entry:
-    '''Data structure that represents a standalone entry - an event, a birth or a death.'''
+    '''Lightweight view of a standalone entry - an event, a birth or a death.'''
 
-    def __init__(self, entry, template):
-        self.year = entry['year']
-        self.text = entry['text']
-        self.template = template
-        self.links = Container(entry['links'], Link)
+    __slots__ = ('_container', '_index')
+    fields = ('year', 'text', 'links')
+
+    def __init__(self, container, index):
+        self._container = container
+        self._index = index
+
+    @property
+    def year(self):
+        return self._container.columns['year'][self._index]
+
+    @property
+    def text(self):
+        return self._container.columns['text'][self._index]
+
+    @property
+    def template(self):
+        return resolve_template(self._container.template)
+
+    @property
+    def links(self):
+        '''The links are kept raw until they are accessed.'''
+        return Container(self._container.columns['links'][self._index] or (), Link)
 
     def __str__(self):
-        return self.template(self.year, self.text)
+        return self._container.render(self._index)
 
     def __repr__(self):
         return self.__str__()
 
 
 class Link:
-    '''Data structure that represents a link.'''
+    '''Lightweight view of a link.'''
+
+    __slots__ = ('_container', '_index')
+    fields = ('title', 'link')
+
+    def __init__(self, container, index):
+        self._container = container
+        self._index = index
+
+    @property
+    def title(self):
+        return self._container.columns['title'][self._index]
 
-    def __init__(self, link):
-        self.title = link['title']
-        self.link = link['link']
+    @property
+    def link(self):
+        return self._container.columns['link'][self._index]
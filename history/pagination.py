@@ -0,0 +1,75 @@
+from collections import OrderedDict
+from threading import Lock
+import time
+
+
+class Pager:
+    '''Pages through the history results.
+
+    Only the entries of the requested page are rendered. The position is kept per user, so that the next page is
+    served without re-fetching and re-rendering the day. The positions are kept in the process, or in the shared
+    `store` (e.g. `ai.sessions.SQLiteSessionStore`) when the "more" can reach another gunicorn worker. The shared
+    position refers to the results by their key, `loader(*key, deadline=None)` loads them again.
+    '''
+
+    def __init__(self, page_size=3, maxsize=10000, ttl=3600, clock=time.monotonic, store=None, loader=None):
+        assert page_size > 0
+        assert store is None or loader is not None, 'The shared positions need the loader of the results'
+        self.page_size = page_size
+        self.maxsize = maxsize
+        self.ttl = ttl
+        # Has to be the wall clock when the positions are shared by the processes.
+        self.clock = clock
+        self.store = store
+        self.loader = loader
+        self._cursors = OrderedDict()
+        self._lock = Lock()
+
+    def first(self, user_id, results, key=None):
+        '''Returns the rendered texts of the first page and remembers the position for the user.'''
+        return self._page(user_id, results, key, 0)
+
+    def next(self, user_id, deadline=None):
+        '''Returns the rendered texts of the next page, or `None` if there is nothing more for the user.'''
+        cursor = self._cursor(user_id)
+        if cursor is None:
+            return None
+        results, key, offset, created_at = cursor
+        if self.clock() - created_at >= self.ttl:
+            self.reset(user_id)
+            return None
+        if results is None:
+            results = self.loader(*key, deadline=deadline)
+        return self._page(user_id, results, key, offset)
+
+    def reset(self, user_id):
+        if self.store is not None:
+            self.store.delete_cursor(user_id)
+            return
+        with self._lock:
+            self._cursors.pop(user_id, None)
+
+    def _cursor(self, user_id):
+        if self.store is not None:
+            cursor = self.store.get_cursor(user_id)
+            return (None,) + cursor if cursor is not None else None
+        with self._lock:
+            return self._cursors.get(user_id)
+
+    def _page(self, user_id, results, key, offset):
+        stop = offset + self.page_size
+        page = [str(entry) for entry in results[offset:stop]]
+        if stop >= len(results):
+            self.reset(user_id)
+        elif self.store is not None:
+            self.store.set_cursor(user_id, key, stop, self.clock())
+        else:
+            with self._lock:
+                self._cursors[user_id] = (results, key, stop, self.clock())
+                self._cursors.move_to_end(user_id)
+                while len(self._cursors) > self.maxsize:
+                    self._cursors.popitem(last=False)
+        return page
+
+    def __len__(self):
+        return len(self._cursors)
@@ -0,0 +1,287 @@
+'''Compact binary snapshot of all the 366 days of the local history store, shared by the processes with `mmap`.
+
+The snapshot is built offline from the store with:
+
+    python -m history.snapshot build /path/to/store /path/to/snapshot
+
+The file has a header, the fixed-size records of the days, the entries and the links, the year keys of the entries
+and a table of the UTF-8 strings, referenced by their offsets and lengths. The texts of the entries are rendered
+with the templates in advance. The header keeps the generation of the templates they were rendered with (see
+`history.utils.invalidate_templates`), with other templates the texts are rendered on access. The snapshot has to
+be rebuilt after the templates change in the code. All the integers are unsigned 32-bit in the native byte order,
+except for the 64-bit size of the string table and the signed year keys, so the snapshot has to be built on the
+same architecture.
+'''
+from array import array
+from bisect import bisect_left, bisect_right
+from datetime import datetime
+from threading import Lock
+import argparse
+import mmap
+import os
+import struct
+import tempfile
+import time
+
+from history import API, utils
+from history.models import Entry, resolve_template, Results
+from history.store import days, Store
+from history.utils import year_to_int
+
+
+MAGIC = b'CHRNSNAP'
+FORMAT_VERSION = 2
+HEADER = struct.Struct('=8sIIIIIQ')
+CATEGORIES = ('events', 'births', 'deaths')
+# The fields of the records, the strings are `(offset, length)` pairs.
+DAY_FIELDS = 10  # date, url, (start, count) of every category
+ENTRY_FIELDS = 8  # year, text, rendered text, (start, count) of the links
+LINK_FIELDS = 4  # title, link
+NONE = 0xffffffff
+
+
+class Snapshot:
+    '''Read-only view of the snapshot file, nothing is decoded until it is accessed.'''
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.stat = os.fstat(f.fileno())
+        buffer = memoryview(self._mmap)
+        magic, version, self.templates_generation, day_count, entry_count, link_count, strings_size = \
+            HEADER.unpack_from(buffer)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            raise ValueError('The snapshot {path} has an unsupported format, rebuild it'.format(path=path))
+        offset = HEADER.size
+        self.days, offset = _section(buffer, offset, 'I', day_count * DAY_FIELDS)
+        self.entries, offset = _section(buffer, offset, 'I', entry_count * ENTRY_FIELDS)
+        self.links, offset = _section(buffer, offset, 'I', link_count * LINK_FIELDS)
+        self.keys, offset = _section(buffer, offset, 'i', entry_count)
+        self.strings = buffer[offset:offset + strings_size]
+        self._days = {date: i for i, date in enumerate(days())}
+        # The texts rendered with the current templates when they differ from the ones of the build, per entry.
+        self._rendered = {}
+        self._rendered_generation = None
+
+    def string(self, offset, length):
+        return None if offset == NONE else str(self.strings[offset:offset + length], 'utf-8')
+
+    def render(self, entry, template):
+        '''Returns the text of the entry, rendered with the current template if the templates changed since the build.
+
+        The texts rendered on access are memoized until the templates change again.
+        '''
+        if self.templates_generation == utils.TEMPLATES_GENERATION:
+            record = entry * ENTRY_FIELDS
+            return self.string(self.entries[record + 4], self.entries[record + 5])
+        if self._rendered_generation != utils.TEMPLATES_GENERATION:
+            self._rendered, self._rendered_generation = {}, utils.TEMPLATES_GENERATION
+        text = self._rendered.get(entry)
+        if text is None:
+            record = entry * ENTRY_FIELDS
+            text = self._rendered[entry] = resolve_template(template)(
+                self.string(self.entries[record], self.entries[record + 1]),
+                self.string(self.entries[record + 2], self.entries[record + 3]))
+        return text
+
+    def day(self, month, day):
+        '''Returns the `Results` of the day, raises `ValueError` if the day is not in the snapshot.'''
+        try:
+            record = self._days[(month, day)] * DAY_FIELDS
+        except KeyError:
+            raise ValueError('The date {month}/{day} is missing in the snapshot {path}'
+                             .format(month=month, day=day, path=self.path))
+        fields = self.days[record:record + DAY_FIELDS]
+        containers = [SnapshotContainer(self, fields[4 + 2 * i], fields[5 + 2 * i], Results.CATEGORIES[category][1])
+                      for i, category in enumerate(CATEGORIES)]
+        return Results({'date': self.string(fields[0], fields[1]), 'url': self.string(fields[2], fields[3])},
+                       *containers)
+
+
+class SnapshotContainer:
+    '''`history.models.Container` compatible view of the entries of a category of a day in the snapshot.'''
+
+    def __init__(self, snapshot, start, count, template=None):
+        self.snapshot = snapshot
+        self.start = start
+        self.wrapper = Entry
+        self.key = 'year'
+        self.key_converter = year_to_int
+        self.template = template
+        self.columns = {'year': _Column(snapshot, start, 0), 'text': _Column(snapshot, start, 2),
+                        'links': _Links(snapshot, start)}
+        self._keys = snapshot.keys[start:start + count]
+        self._length = count
+
+    def search(self, term):
+        return self.search_range(year_to_int(term), year_to_int(term))
+
+    def search_range(self, start, end):
+        '''Returns the entries with the integer key within the inclusive `[start, end]` range.'''
+        if start is None or end is None:
+            return []
+        return self[bisect_left(self._keys, start):bisect_right(self._keys, end)]
+
+    def render(self, index):
+        '''Returns the text rendered when the snapshot was built, or with the current template once they changed.'''
+        return self.snapshot.render(self.start + index, self.template)
+
+    def prerender(self):
+        '''The texts are already rendered.'''
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return [self.wrapper(self, i) for i in range(*key.indices(self._length))]
+        if key < 0:
+            key += self._length
+        if not 0 <= key < self._length:
+            raise IndexError('Container index is out of range')
+        return self.wrapper(self, key)
+
+    def __iter__(self):
+        for i in range(self._length):
+            yield self.wrapper(self, i)
+
+    def __len__(self):
+        return self._length
+
+
+class _Column:
+    '''A string field of the entries, decoded on access.'''
+
+    def __init__(self, snapshot, start, field):
+        self.snapshot = snapshot
+        self.start = start
+        self.field = field
+
+    def __getitem__(self, index):
+        record = (self.start + index) * ENTRY_FIELDS + self.field
+        return self.snapshot.string(self.snapshot.entries[record], self.snapshot.entries[record + 1])
+
+
+class _Links:
+    '''The links of the entries, decoded into the raw dicts on access.'''
+
+    def __init__(self, snapshot, start):
+        self.snapshot = snapshot
+        self.start = start
+
+    def __getitem__(self, index):
+        snapshot = self.snapshot
+        record = (self.start + index) * ENTRY_FIELDS
+        start, count = snapshot.entries[record + 6], snapshot.entries[record + 7]
+        links = []
+        for i in range(start * LINK_FIELDS, (start + count) * LINK_FIELDS, LINK_FIELDS):
+            fields = snapshot.links[i:i + LINK_FIELDS]
+            links.append({'title': snapshot.string(fields[0], fields[1]),
+                          'link': snapshot.string(fields[2], fields[3])})
+        return links
+
+
+class SnapshotAPI(API):
+    '''`API` backend which answers from a snapshot and never calls the upstream.
+
+    The file is checked for changes at most every `check_interval` seconds, a rebuilt snapshot is swapped in without
+    a restart. The views of the old snapshot keep it mapped until they are released.
+    '''
+
+    def __init__(self, path, check_interval=10, metrics=None, clock=time.monotonic):
+        super().__init__(base_url=None, metrics=metrics)
+        self.path = path
+        self.check_interval = check_interval
+        self.clock = clock
+        self.snapshot = Snapshot(path)
+        self._checked_at = clock()
+        self._lock = Lock()
+
+    def today(self, timeout=None, deadline=None):
+        '''Get the todays events.'''
+        today = datetime.today()
+        return self.date(today.month, today.day, timeout=timeout, deadline=deadline)
+
+    def reload(self):
+        '''Swaps in the snapshot file if it was replaced, returns `True` if it was.'''
+        with self._lock:
+            self._checked_at = self.clock()
+            stat = os.stat(self.path)
+            current = self.snapshot.stat
+            if (stat.st_ino, stat.st_mtime_ns, stat.st_size) == \
+                    (current.st_ino, current.st_mtime_ns, current.st_size):
+                return False
+            self.snapshot = Snapshot(self.path)
+            return True
+
+    def _day(self, month, day, timeout=None, deadline=None):
+        with self.metrics.track('history_fetch'):
+            if self.clock() - self._checked_at >= self.check_interval:
+                self.reload()
+            return self.snapshot.day(month, day)
+
+
+def build(store, path):
+    '''Atomically writes the snapshot of all the 366 days of the store. Returns the number of entries.'''
+    days_, entries, links, keys = array('I'), array('I'), array('I'), array('i')
+    strings, offsets = bytearray(), {}
+
+    def string(value):
+        if value is None:
+            return NONE, 0
+        if value not in offsets:
+            encoded = value.encode('utf-8')
+            offsets[value] = (len(strings), len(encoded))
+            strings.extend(encoded)
+        return offsets[value]
+
+    for month, day in days():
+        results = Results(store.load(month, day))
+        days_.extend(string(results.date) + string(results.url))
+        for category in CATEGORIES:
+            container = getattr(results, category)
+            days_.extend((len(keys), len(container)))
+            for i, entry in enumerate(container):
+                try:
+                    rendered = str(entry)
+                except TypeError:
+                    # The corrupted entries without a text can't be rendered.
+                    rendered = None
+                entries.extend(string(entry.year) + string(entry.text) + string(rendered) +
+                               (len(links) // LINK_FIELDS, len(entry.links)))
+                keys.append(container._keys[i])
+                for link in entry.links:
+                    links.extend(string(link.title) + string(link.link))
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(HEADER.pack(MAGIC, FORMAT_VERSION, utils.TEMPLATES_GENERATION, len(days_) // DAY_FIELDS,
+                                len(keys), len(links) // LINK_FIELDS, len(strings)))
+            for section in (days_, entries, links, keys):
+                section.tofile(f)
+            f.write(strings)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+    return len(keys)
+
+
+def _section(buffer, offset, typecode, count):
+    '''Returns the typed view of the `count` items at the offset, and the offset of the next section.'''
+    size = struct.calcsize(typecode) * count
+    return buffer[offset:offset + size].cast(typecode), offset + size
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Manage the history snapshot.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    build_parser = subparsers.add_parser('build', help='snapshot all the 366 days of the local store')
+    build_parser.add_argument('store', help='the store directory')
+    build_parser.add_argument('path', help='the snapshot file')
+    args = parser.parse_args(argv)
+    if args.command == 'build':
+        entries = build(Store(args.store), args.path)
+        print('Wrote {entries} entries into {path}'.format(entries=entries, path=args.path))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+'''Local date-indexed store of the day payloads from http://history.muffinlabs.com/.
+
+The store is filled offline with:
+
+    python -m history.store build /path/to/store
+'''
+from datetime import date, datetime, timedelta
+import argparse
+import json
+import os
+import tempfile
+
+from history import API
+from history.cache import Cache
+from history.models import Results
+from history.utils import loads
+
+
+# A leap year, so that iterating over it yields all the 366 possible days.
+LEAP_YEAR = 2000
+
+
+def days():
+    '''Yields the `(month, day)` pairs of all the 366 possible days.'''
+    current = date(LEAP_YEAR, 1, 1)
+    while current.year == LEAP_YEAR:
+        yield current.month, current.day
+        current += timedelta(days=1)
+
+
+class Store:
+    '''File-based store which keeps one upstream JSON payload per day.'''
+
+    def __init__(self, path):
+        self.path = path
+
+    def filename(self, month, day):
+        return os.path.join(self.path, '{month:02d}-{day:02d}.json'.format(month=month, day=day))
+
+    def load(self, month, day):
+        '''Returns the decoded payload for the date, raises `ValueError` if the date is not stored.'''
+        try:
+            with open(self.filename(month, day), 'rb') as f:
+                return loads(f.read())
+        except FileNotFoundError:
+            raise ValueError('The date {month}/{day} is missing in the store {path}'
+                             .format(month=month, day=day, path=self.path))
+
+    def save(self, month, day, data):
+        '''Atomically writes the payload for the date, so that readers never see a partial file.'''
+        os.makedirs(self.path, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False)
+            os.replace(tmp, self.filename(month, day))
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    def missing(self):
+        '''Returns the `(month, day)` pairs which are not stored yet.'''
+        return [(month, day) for month, day in days() if not os.path.exists(self.filename(month, day))]
+
+
+class LocalAPI(API):
+    '''`API` backend which answers from a local `Store` and never calls the upstream.
+
+    The parsed results of every day are kept for `ttl` seconds, so that their rendered entries are memoized and the
+    days saved into the store meanwhile are picked up afterwards.
+    '''
+
+    def __init__(self, store, metrics=None, ttl=3600):
+        super().__init__(base_url=None, cache=Cache(maxsize=366, ttl=ttl, stale_ttl=0), metrics=metrics)
+        self.store = store if isinstance(store, Store) else Store(store)
+
+    def today(self, timeout=None, deadline=None):
+        '''Get the todays events.'''
+        today = datetime.today()
+        return self.date(today.month, today.day, timeout=timeout, deadline=deadline)
+
+    def _day(self, month, day, timeout=None, deadline=None):
+        with self.metrics.track('history_fetch'):
+            return self.cache.get((month, day), lambda: Results(self.store.load(month, day)))
+
+
+def build(store, api=None, skip_existing=False):
+    '''Fills the store with the payloads of all the 366 days. Returns the number of fetched days.'''
+    api = API() if api is None else api
+    todo = store.missing() if skip_existing else list(days())
+    for month, day in todo:
+        store.save(month, day, api._fetch_raw(api._date_endpoint(month, day)))
+    return len(todo)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Manage the local history store.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    build_parser = subparsers.add_parser('build', help='fetch all the 366 days from the upstream')
+    build_parser.add_argument('path', help='the store directory')
+    build_parser.add_argument('--base-url', default='http://history.muffinlabs.com', help='the upstream URL')
+    build_parser.add_argument('--skip-existing', action='store_true', help='only fetch the missing days')
+    args = parser.parse_args(argv)
+    if args.command == 'build':
+        fetched = build(Store(args.path), API(args.base_url), args.skip_existing)
+        print('Fetched {fetched} days into {path}'.format(fetched=fetched, path=args.path))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,27 @@
 from copy import deepcopy
-from json import load
-from unittest.mock import Mock, patch
+from datetime import datetime
+from json import dumps, load
+from threading import Event, Thread, Timer
+from unittest.mock import call, MagicMock, Mock, patch
+import multiprocessing
 import os
+import requests
+import tempfile
+import time
 import unittest
 
+from ai.sessions import SQLiteSessionStore
+from benchmarks import fakes
 from history import API
+from history.cache import Cache, SingleFlight
+from history.index import Index
+from history.pagination import Pager
 from history.models import Entry, Results
+from history.snapshot import build as build_snapshot, Snapshot, SnapshotAPI
+from history.store import LocalAPI, Store, build, days
+from history.utils import invalidate_templates, loads
+from history.warmup import upcoming_dates, Warmer
+from resilience import CircuitBreaker, CircuitOpenError, Deadline, DeadlineExceeded
 
 
 CURRENT_DIR = os.path.dirname(os.path.realpath(__file__))
@@ -34,6 +50,16 @@ class TestModels(unittest.TestCase):
         self.assertEqual('Death of Simeon I the Great, the first Bulgarian to be recognized as Emperor.',
                          self.results[0].text)
 
+    def test_categories_wrapped_lazily(self):
+        results = Results(loads(dumps(DATA).encode('utf-8')))
+        self.assertEqual('927', results.events[0].year)
+        self.assertIsNone(results._births)
+        self.assertIsNone(results._deaths)
+        self.assertEqual(DATA_LENGTH, len(results))
+        # The raw payload is released once all the categories are wrapped.
+        self.assertIsNone(results._data)
+        self.assertIs(results.births, results.births)
+
     def test_results_type(self):
         self.assertTrue(all(map(lambda entry: isinstance(entry, Entry), self.results)))
 
@@ -89,6 +115,19 @@ class TestModels(unittest.TestCase):
         self.assertEqual('Ordoño I of Asturias (b. 831)',
                          self.results.deaths[1].text)
 
+    def test_events_negative_index(self):
+        self.assertEqual('1153', self.results.events[-1].year)
+
+    def test_events_raises(self):
+        with self.assertRaises(IndexError):
+            self.results.events[EVENTS_LENGTH]
+
+    def test_entry_is_view(self):
+        self.assertFalse(hasattr(self.results.events[0], '__dict__'))
+
+    def test_links_kept_raw(self):
+        self.assertEqual(DATA['data']['Events'][2]['links'], self.results.events.columns['links'][2])
+
     def test_link_text(self):
         self.assertEqual('Malcolm IV of Scotland', self.results.events[2].links[0].title)
 
@@ -129,6 +168,44 @@ class TestModels(unittest.TestCase):
         results = Results(data)
         self.assertEqual(2, len(results.search(results.deaths[2].year)))
 
+    def test_search_many_duplicates(self):
+        data = deepcopy(DATA)
+        data['data']['Events'][1:1] = [data['data']['Events'][1]] * 1000
+        results = Results(data)
+        self.assertEqual(1001, len(results.events.search('1120')))
+        self.assertEqual('1153', results.events[1002].year)
+
+    def test_search_invalid_term(self):
+        self.assertEqual([], self.results.events.search('foo'))
+
+    def test_search_range(self):
+        self.assertEqual(4, len(self.results.search_range(900, 1200)))
+
+    def test_search_range_bounds_inclusive(self):
+        self.assertEqual(['927', '1120', '1153'], [entry.year for entry in self.results.events.search_range(927, 1153)])
+
+    def test_search_range_bc(self):
+        self.assertEqual('366 BC', self.results.search_range(-400, -300)[0].year)
+
+    def test_search_range_empty(self):
+        self.assertEqual(0, len(self.results.search_range(1200, 1400)))
+
+    def test_search_range_type(self):
+        self.assertTrue(isinstance(self.results.search_range(900, 1200), Results))
+
+    def test_decade(self):
+        self.assertEqual('1970', self.results.decade(1970)[0].year)
+
+    def test_century(self):
+        self.assertEqual(['1443', '1469'], [entry.year for entry in self.results.century(15)])
+
+    def test_century_bc(self):
+        self.assertEqual(['366 BC'], [entry.year for entry in self.results.century(4, bc=True)])
+
+    def test_search_range_links_raises(self):
+        with self.assertRaises(RuntimeError):
+            self.results.deaths[0].links.search_range(0, 1)
+
     def test_search_corrupted_data(self):
         results = Results(CORRUPTED)
         self.assertEqual(2, len(results.search('2003')))
@@ -148,6 +225,32 @@ class TestModels(unittest.TestCase):
                          '1865 this date (born in 1844) – Mary Surratt died in 1865 this date (born in 1823)',
                          str(results.search('1865')[0]))
 
+    def test_render_memoized(self):
+        template = Mock(return_value='text')
+        self.results.events.template = template
+        str(self.results.events[0])
+        str(self.results.search('927')[0])
+        self.assertEqual(template.call_count, 1)
+
+    def test_render_invalidated(self):
+        str(self.results.events[0])
+        template = Mock(return_value='text')
+        self.results.events.template = template
+        invalidate_templates()
+        self.assertEqual('text', str(self.results.events[0]))
+
+    def test_replaced_template_used(self):
+        with patch('history.utils.event_template', Mock(return_value='text')):
+            invalidate_templates()
+            self.assertEqual('text', str(Results(DATA).events[0]))
+
+    def test_prerender(self):
+        template = Mock(return_value='text')
+        self.results.deaths.template = template
+        self.results.prerender()
+        str(self.results.deaths[0])
+        self.assertEqual(template.call_count, DEATHS_LENGTH)
+
     def test_search_links_raises(self):
         with self.assertRaises(RuntimeError):
             self.results.deaths[0].links.search('foo')
@@ -166,9 +269,10 @@ class TestAPI(unittest.TestCase):
         self.api = API()
         r = Mock()
         r.status_code = 200
-        r.json.return_value = DATA
-        patcher = patch('requests.get', return_value=r)
+        r.content = dumps(DATA).encode('utf-8')
+        patcher = patch('requests.Session.get', return_value=r)
         patcher.start()
+        self.addCleanup(patcher.stop)
 
     def test_today_results(self):
         self.assertTrue(isinstance(self.api.today(), Results))
@@ -197,6 +301,13 @@ class TestAPI(unittest.TestCase):
     def test_date_results_year_entries(self):
         self.assertTrue(all(map(lambda entry: isinstance(entry, Entry), self.api.date(2, 4, '927'))))
 
+    def test_date_results_year_range(self):
+        self.assertEqual(len(self.api.date(2, 4, year_range=(900, 1200))), 4)
+
+    def test_date_raises_invalid_year_range(self):
+        with self.assertRaises(AssertionError):
+            self.api.date(2, 4, year_range=(1200, 900))
+
     def test_date_raises_invalid_month(self):
         with self.assertRaises(AssertionError):
             self.api.date(13, 4)
@@ -209,6 +320,11 @@ class TestAPI(unittest.TestCase):
         with self.assertRaises(AssertionError):
             self.api.date(2, 4, '927BC')
 
+    def test_metrics(self):
+        metrics = MagicMock()
+        API(metrics=metrics).date(2, 4)
+        self.assertEqual([call('history_fetch'), call('history_upstream')], metrics.track.call_args_list)
+
     def test_date_raises_type_month(self):
         with self.assertRaises(TypeError):
             self.api.date('2', 4)
@@ -224,18 +340,806 @@ class TestAPI(unittest.TestCase):
     def test_today_invalid_status_code(self):
         r = Mock()
         r.status_code = 500
-        patcher = patch('requests.get', return_value=r)
+        patcher = patch('requests.Session.get', return_value=r)
         patcher.start()
+        self.addCleanup(patcher.stop)
         with self.assertRaises(ValueError):
             self.api.today()
 
     def test_date_invalid_status_code(self):
         r = Mock()
         r.status_code = 500
-        patcher = patch('requests.get', return_value=r)
+        patcher = patch('requests.Session.get', return_value=r)
         patcher.start()
+        self.addCleanup(patcher.stop)
+        with self.assertRaises(ValueError):
+            self.api.date(2, 4)
+
+
+def in_fork(func):
+    '''Runs the function in a forked child process and returns its result.'''
+    context = multiprocessing.get_context('fork')
+    result = context.Queue()
+    process = context.Process(target=lambda: result.put(func()))
+    process.start()
+    try:
+        return result.get(timeout=10)
+    finally:
+        process.join(5)
+
+
+class TestCache(unittest.TestCase):
+    '''Test the LRU/TTL cache.'''
+
+    def setUp(self):
+        self.now = 0
+        self.cache = Cache(maxsize=2, ttl=10, stale_ttl=100, clock=lambda: self.now)
+        self.loader = Mock(return_value='value')
+
+    def test_miss_loads(self):
+        self.assertEqual(self.cache.get('a', self.loader), 'value')
+        self.assertEqual(self.cache.stats['misses'], 1)
+
+    def test_hit_does_not_load(self):
+        self.cache.get('a', self.loader)
+        self.cache.get('a', self.loader)
+        self.assertEqual(self.loader.call_count, 1)
+        self.assertEqual(self.cache.stats['hits'], 1)
+
+    def test_lru_eviction(self):
+        self.cache.get('a', self.loader)
+        self.cache.get('b', self.loader)
+        self.cache.get('a', self.loader)
+        self.cache.get('c', self.loader)
+        self.assertIn('a', self.cache)
+        self.assertNotIn('b', self.cache)
+        self.assertEqual(self.cache.stats['evictions'], 1)
+
+    def test_stale_served_while_refreshing(self):
+        self.cache.get('a', self.loader)
+        self.now = 20
+        self.assertEqual(self.cache.get('a', Mock(return_value='new')), 'value')
+        self.cache.join()
+        self.assertEqual(self.cache.get('a', self.loader), 'new')
+        self.assertEqual(self.cache.stats['stale_hits'], 1)
+
+    def test_single_refresh_per_key(self):
+        self.cache.get('a', self.loader)
+        self.now = 20
+        started, release = Event(), Event()
+
+        def slow_loader():
+            started.set()
+            release.wait(5)
+            return 'new'
+        refresh = Mock(side_effect=slow_loader)
+        self.cache.get('a', refresh)
+        started.wait(5)
+        self.cache.get('a', refresh)
+        release.set()
+        self.cache.join()
+        self.assertEqual(refresh.call_count, 1)
+
+    def test_refresh_not_inherited(self):
+        self.cache.get('a', self.loader)
+        self.now = 20
+        started, release = Event(), Event()
+        self.addCleanup(release.set)
+        self.cache.get('a', lambda: started.set() or release.wait(5) and 'parent')
+        started.wait(5)
+
+        def refresh_in_child():
+            self.cache.get('a', Mock(return_value='child'))
+            self.cache.join(5)
+            return self.cache.peek('a')
+        self.assertEqual('child', in_fork(refresh_in_child))
+
+    def test_refresh_error_keeps_stale(self):
+        self.cache.get('a', self.loader)
+        self.now = 20
+        self.cache.get('a', Mock(side_effect=ValueError))
+        self.cache.join()
+        self.assertEqual(self.cache.get('a', self.loader), 'value')
+        self.assertEqual(self.cache.stats['refresh_errors'], 1)
+
+    def test_expired_reloads(self):
+        self.cache.get('a', self.loader)
+        self.now = 200
+        self.assertEqual(self.cache.get('a', Mock(return_value='new')), 'new')
+        self.assertEqual(self.cache.stats['misses'], 2)
+
+
+class TestSingleFlight(unittest.TestCase):
+    '''Test the coalescing of the concurrent calls.'''
+
+    def setUp(self):
+        self.flights = SingleFlight()
+        self.started, self.release = Event(), Event()
+
+    def slow(self, result=None, error=None):
+        def func():
+            self.started.set()
+            self.release.wait(5)
+            if error is not None:
+                raise error
+            return result
+        return Mock(side_effect=func)
+
+    def call_in_thread(self, key, func, timeout=None):
+        outcome = {}
+
+        def run():
+            try:
+                outcome['result'] = self.flights.do(key, func, timeout)
+            except Exception as e:
+                outcome['error'] = e
+        thread = Thread(target=run)
+        thread.start()
+        return thread, outcome
+
+    def wait_for_waiters(self, count):
+        deadline = time.monotonic() + 5
+        while self.flights.stats['coalesced'] < count and time.monotonic() < deadline:
+            time.sleep(0.001)
+
+    def test_concurrent_calls_coalesced(self):
+        func = self.slow('value')
+        leader, first = self.call_in_thread('a', func)
+        self.started.wait(5)
+        waiters = [self.call_in_thread('a', func) for _ in range(3)]
+        self.wait_for_waiters(3)
+        self.release.set()
+        for thread, _ in [(leader, first)] + waiters:
+            thread.join(5)
+        self.assertEqual(func.call_count, 1)
+        self.assertTrue(all(outcome['result'] == 'value' for _, outcome in [(leader, first)] + waiters))
+        self.assertEqual(self.flights.stats, {'calls': 1, 'coalesced': 3, 'in_flight': 0})
+
+    def test_different_keys_not_coalesced(self):
+        self.assertEqual(self.flights.do('a', lambda: 1), 1)
+        self.assertEqual(self.flights.do('b', lambda: 2), 2)
+        self.assertEqual(self.flights.stats['coalesced'], 0)
+
+    def test_error_raised_in_waiters_and_not_remembered(self):
+        func = self.slow(error=ValueError('upstream'))
+        leader, first = self.call_in_thread('a', func)
+        self.started.wait(5)
+        waiter, second = self.call_in_thread('a', func)
+        self.wait_for_waiters(1)
+        self.release.set()
+        leader.join(5)
+        waiter.join(5)
+        self.assertIsInstance(first['error'], ValueError)
+        self.assertIs(second['error'], first['error'])
+        self.assertEqual(self.flights.do('a', lambda: 'value'), 'value')
+
+    def test_call_in_flight_not_inherited(self):
+        leader, first = self.call_in_thread('a', self.slow('parent'))
+        self.addCleanup(leader.join, 5)
+        self.addCleanup(self.release.set)
+        self.started.wait(5)
+        self.assertEqual(('child', 0), in_fork(lambda: (self.flights.do('a', lambda: 'child', timeout=3),
+                                                        self.flights.stats['in_flight'])))
+
+    def test_waiter_timeout(self):
+        func = self.slow('value')
+        leader, first = self.call_in_thread('a', func)
+        self.started.wait(5)
+        with self.assertRaises(TimeoutError):
+            self.flights.do('a', func, timeout=0.01)
+        self.release.set()
+        leader.join(5)
+        self.assertEqual(first['result'], 'value')
+        self.assertEqual(func.call_count, 1)
+
+
+class TestCachedAPI(unittest.TestCase):
+    '''Test the API with the cache.'''
+
+    def setUp(self):
+        self.api = API(cache=Cache())
+        r = Mock()
+        r.status_code = 200
+        r.content = dumps(DATA).encode('utf-8')
+        patcher = patch('requests.Session.get', return_value=r)
+        self.get = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_date_fetched_once(self):
+        self.api.date(2, 4)
+        self.api.date(2, 4, '927')
+        self.assertEqual(self.get.call_count, 1)
+
+    def test_date_results_year_valid(self):
+        self.api.date(2, 4)
+        self.assertEqual(len(self.api.date(2, 4, '927')), 2)
+
+    def test_dates_cached_separately(self):
+        self.api.date(2, 4)
+        self.api.date(2, 5)
+        self.assertEqual(self.get.call_count, 2)
+
+    def test_invalid_status_code_not_cached(self):
+        self.get.return_value = Mock(status_code=500)
         with self.assertRaises(ValueError):
             self.api.date(2, 4)
+        self.assertEqual(len(self.api.cache), 0)
+
+    def test_concurrent_misses_fetched_once(self):
+        started, release = Event(), Event()
+        r = self.get.return_value
+
+        def slow_get(*args, **kwargs):
+            started.set()
+            release.wait(5)
+            return r
+        self.get.side_effect = slow_get
+        threads = [Thread(target=self.api.date, args=(2, 4)) for _ in range(4)]
+        threads[0].start()
+        started.wait(5)
+        for thread in threads[1:]:
+            thread.start()
+        deadline = time.monotonic() + 5
+        while self.api.flights.stats['coalesced'] < 3 and time.monotonic() < deadline:
+            time.sleep(0.001)
+        release.set()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(self.get.call_count, 1)
+        self.assertEqual(self.api.flights.stats['coalesced'], 3)
+
+
+class TestDegradedAPI(unittest.TestCase):
+    '''Test the API when the upstream fails or is too slow.'''
+
+    def setUp(self):
+        self.now = 0
+        self.breaker = CircuitBreaker('history', threshold=2)
+        self.fallback = Mock()
+        self.api = API(cache=Cache(ttl=10, stale_ttl=0, clock=lambda: self.now), retries=0, breaker=self.breaker,
+                       fallback=self.fallback)
+        r = Mock()
+        r.status_code = 200
+        r.content = dumps(DATA).encode('utf-8')
+        patcher = patch('requests.Session.get', return_value=r)
+        self.get = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_expired_cache_served_when_upstream_fails(self):
+        self.api.date(2, 4)
+        self.now = 100
+        self.get.return_value = Mock(status_code=503)
+        self.assertEqual(len(self.api.date(2, 4)), DATA_LENGTH)
+        self.assertEqual(self.api.fallbacks, {'cache': 1, 'fallback': 0})
+        self.fallback.date.assert_not_called()
+
+    def test_fallback_when_nothing_cached(self):
+        self.get.return_value = Mock(status_code=503)
+        self.fallback.date.return_value = Results(DATA)
+        self.assertEqual(len(self.api.date(2, 4, '927')), 2)
+        self.fallback.date.assert_called_once_with(2, 4)
+        self.assertEqual(self.api.fallbacks, {'cache': 0, 'fallback': 1})
+
+    def test_error_without_fallback(self):
+        self.get.return_value = Mock(status_code=503)
+        self.fallback.date.side_effect = ValueError('missing')
+        with self.assertRaises(ValueError):
+            self.api.date(2, 4)
+
+    def test_circuit_opens(self):
+        self.api.fallback = None
+        self.get.return_value = Mock(status_code=503)
+        for day in (4, 5):
+            with self.assertRaises(ValueError):
+                self.api.date(2, day)
+        with self.assertRaises(CircuitOpenError):
+            self.api.date(2, 6)
+        self.assertEqual(self.get.call_count, 2)
+
+    def test_deadline_bounds_timeout(self):
+        self.api.date(2, 4, deadline=Deadline(1))
+        self.assertTrue(all(timeout <= 1 for timeout in self.get.call_args[1]['timeout']))
+
+    def test_exceeded_deadline(self):
+        self.api.fallback = None
+        with self.assertRaises(DeadlineExceeded):
+            self.api.date(2, 4, deadline=Deadline(0))
+        self.get.assert_not_called()
+        self.assertEqual(0, self.breaker.stats['failures'])
+
+    def test_timeout_of_spent_budget_not_counted(self):
+        self.api.fallback = None
+
+        def timeout(*args, **kwargs):
+            self.now = 1
+            raise requests.Timeout()
+        self.get.side_effect = timeout
+        for _ in range(3):
+            self.now = 0
+            with self.assertRaises(requests.Timeout):
+                self.api.date(2, 4, deadline=Deadline(1, clock=lambda: self.now))
+        self.assertEqual(CircuitBreaker.CLOSED, self.breaker.stats['state'])
+        self.assertEqual(0, self.breaker.stats['failures'])
+
+    def test_refresh_without_deadline(self):
+        self.api.cache = Cache(ttl=10, stale_ttl=100, clock=lambda: self.now)
+        self.api.date(2, 4)
+        self.now = 20
+        self.api.date(2, 4, deadline=Deadline(0.5))
+        self.api.cache.join()
+        self.assertEqual(2, self.get.call_count)
+        self.assertEqual(self.api.timeout, self.get.call_args[1]['timeout'])
+
+
+class TestPager(unittest.TestCase):
+    '''Test the paging through the results.'''
+
+    def setUp(self):
+        self.now = 0
+        self.pager = Pager(page_size=3, maxsize=2, ttl=10, clock=lambda: self.now)
+        self.results = Results(DATA)
+
+    def test_first_page(self):
+        self.assertEqual([str(entry) for entry in self.results[:3]], self.pager.first('user', self.results))
+
+    def test_next_page(self):
+        self.pager.first('user', self.results)
+        self.assertEqual([str(entry) for entry in self.results[3:6]], self.pager.next('user'))
+
+    def test_last_page(self):
+        self.pager.first('user', self.results)
+        for _ in range(3):
+            page = self.pager.next('user')
+        self.assertEqual(1, len(page))
+        self.assertIsNone(self.pager.next('user'))
+
+    def test_next_without_first(self):
+        self.assertIsNone(self.pager.next('user'))
+
+    def test_renders_only_page(self):
+        template = Mock(return_value='text')
+        self.results.events.template = template
+        self.results.births.template = template
+        self.pager.first('user', self.results)
+        self.assertEqual(3, template.call_count)
+
+    def test_cursor_expires(self):
+        self.pager.first('user', self.results)
+        self.now = 10
+        self.assertIsNone(self.pager.next('user'))
+
+    def test_cursors_bounded(self):
+        for user in ('a', 'b', 'c'):
+            self.pager.first(user, self.results)
+        self.assertEqual(2, len(self.pager))
+        self.assertIsNone(self.pager.next('a'))
+
+
+class TestSharedPager(unittest.TestCase):
+    '''Test the paging positions kept in the store shared by the workers.'''
+
+    def setUp(self):
+        self.now = 0
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.store = SQLiteSessionStore(os.path.join(tmp.name, 'sessions.db'), maxsize=2, clock=lambda: self.now)
+        self.results = Results(DATA)
+        self.loader = Mock(return_value=self.results)
+        self.pager = self.make_pager()
+
+    def make_pager(self):
+        return Pager(page_size=3, ttl=10, clock=lambda: self.now, store=self.store, loader=self.loader)
+
+    def test_next_page_in_other_worker(self):
+        self.pager.first('user', self.results, (5, 27, None))
+        self.assertEqual([str(entry) for entry in self.results[3:6]], self.make_pager().next('user'))
+        self.loader.assert_called_once_with(5, 27, None, deadline=None)
+        self.assertEqual([str(entry) for entry in self.results[6:9]], self.pager.next('user'))
+
+    def test_last_page(self):
+        self.pager.first('user', self.results, (5, 27, None))
+        for _ in range(3):
+            page = self.pager.next('user')
+        self.assertEqual(1, len(page))
+        self.assertIsNone(self.store.get_cursor('user'))
+        self.assertIsNone(self.pager.next('user'))
+
+    def test_cursor_expires(self):
+        self.pager.first('user', self.results, (5, 27, None))
+        self.now = 10
+        self.assertIsNone(self.pager.next('user'))
+        self.loader.assert_not_called()
+
+    def test_reset(self):
+        self.pager.first('user', self.results, (5, 27, None))
+        self.pager.reset('user')
+        self.assertIsNone(self.pager.next('user'))
+
+
+class Upstream(fakes.FakeHistory):
+    '''Local stand-in for http://history.muffinlabs.com/ which serves the fixture for every date.'''
+
+    def day(self, month, day):
+        return DATA
+
+
+def start_upstream(test_case, handler=Upstream, **attributes):
+    '''Starts the local upstream stand-in for the test case and returns the server and its base URL.'''
+    server, url = fakes.start(handler, **attributes)
+    test_case.addCleanup(server.server_close)
+    test_case.addCleanup(server.shutdown)
+    return server, url
+
+
+class FlakyUpstream(Upstream):
+    '''Upstream stand-in which fails the first `failures` requests.'''
+
+    def do_GET(self):
+        with self.server.lock:
+            failing = self.server.failures > 0
+            if failing:
+                self.server.failures -= 1
+        if failing:
+            self.respond(503, {'error': 'Service unavailable'})
+            return
+        super().do_GET()
+
+
+class TestSession(unittest.TestCase):
+    '''Test the pooled upstream session.'''
+
+    def setUp(self):
+        self.upstream, self.base_url = start_upstream(self, FlakyUpstream, failures=0)
+
+    def test_connection_reused(self):
+        api = API(self.base_url)
+        api.date(2, 4)
+        api.date(2, 5)
+        self.assertEqual(self.upstream.connections, 1)
+
+    def test_retries(self):
+        self.upstream.failures = 2
+        self.assertEqual(len(API(self.base_url, retries=2, backoff_factor=0).date(2, 4)), DATA_LENGTH)
+
+    def test_retries_exhausted(self):
+        self.upstream.failures = 2
+        with self.assertRaises(ValueError):
+            API(self.base_url, retries=1, backoff_factor=0).date(2, 4)
+
+    def test_not_found_not_retried(self):
+        with self.assertRaises(ValueError):
+            API(self.base_url + '/missing/', retries=2, backoff_factor=0).date(2, 4)
+        self.assertEqual(1, self.upstream.requests)
+
+    def test_retries_within_deadline(self):
+        self.upstream.failures = 2
+        self.assertEqual(len(API(self.base_url, retries=2, backoff_factor=0).date(2, 4, deadline=Deadline(5))),
+                         DATA_LENGTH)
+
+    def test_retries_bounded_by_deadline(self):
+        self.upstream.latency = 1
+        api = API(self.base_url, retries=2, backoff_factor=0)
+        started = time.monotonic()
+        with self.assertRaises(requests.Timeout):
+            api.date(2, 4, deadline=Deadline(0.3))
+        self.assertLess(time.monotonic() - started, 0.8)
+        self.assertEqual(1, self.upstream.connections)
+
+    @patch('requests.Session.get')
+    def test_timeout_passed(self, get):
+        get.return_value = Mock(status_code=200, content=dumps(DATA).encode('utf-8'))
+        API(self.base_url, connect_timeout=1, read_timeout=2).date(2, 4)
+        self.assertEqual(get.call_args[1]['timeout'], (1, 2))
+
+
+class TestStore(unittest.TestCase):
+    '''Test the local history store.'''
+
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.store = Store(tmp.name)
+        self.api = LocalAPI(self.store)
+
+    def when_store_is_built(self):
+        return build(self.store, API(start_upstream(self)[1]))
+
+    def test_build_fetches_all_days(self):
+        self.assertEqual(self.when_store_is_built(), 366)
+        self.assertEqual(self.store.missing(), [])
+
+    def test_build_skip_existing(self):
+        self.store.save(2, 29, DATA)
+        self.assertEqual(build(self.store, API(start_upstream(self)[1]), skip_existing=True), 365)
+
+    def test_build_invalid_status_code(self):
+        with self.assertRaises(ValueError):
+            build(self.store, API(start_upstream(self)[1] + '/missing/'))
+
+    def test_missing(self):
+        self.store.save(1, 1, DATA)
+        self.assertEqual(len(self.store.missing()), 365)
+        self.assertNotIn((1, 1), self.store.missing())
+
+    def test_date_results(self):
+        self.store.save(2, 29, DATA)
+        self.assertEqual(len(self.api.date(2, 29)), DATA_LENGTH)
+
+    def test_date_results_year(self):
+        self.store.save(5, 27, DATA)
+        self.assertEqual(len(self.api.date(5, 27, '927')), 2)
+
+    def test_date_memoized(self):
+        self.store.save(5, 27, DATA)
+        self.assertIs(self.api.date(5, 27), self.api.date(5, 27))
+        self.assertEqual(1, self.api.cache.stats['hits'])
+
+    def test_saved_date_reloaded_after_ttl(self):
+        api = LocalAPI(self.store, ttl=0)
+        self.store.save(5, 27, DATA)
+        api.date(5, 27)
+        self.store.save(5, 27, CORRUPTED)
+        self.assertEqual(len(Results(CORRUPTED)), len(api.date(5, 27)))
+
+    @patch('requests.Session.get')
+    def test_date_does_not_call_upstream(self, get):
+        self.store.save(5, 27, DATA)
+        self.api.date(5, 27)
+        get.assert_not_called()
+
+    def test_today_results(self):
+        self.when_store_is_built()
+        self.assertEqual(len(self.api.today()), DATA_LENGTH)
+
+    def test_date_missing_raises(self):
+        with self.assertRaises(ValueError):
+            self.api.date(2, 4)
+
+    def test_date_raises_invalid_day(self):
+        with self.assertRaises(AssertionError):
+            self.api.date(2, 32)
+
+    def test_api_state_initialized(self):
+        with self.assertRaises(ValueError):
+            self.api.date(2, 4)
+        self.assertEqual({'cache': 0, 'fallback': 0}, self.api.fallbacks)
+
+
+class TestSnapshot(unittest.TestCase):
+    '''Test the memory-mapped snapshot.'''
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp = tempfile.TemporaryDirectory()
+        cls.store = Store(cls.tmp.name)
+        for month, day in days():
+            cls.store.save(month, day, CORRUPTED if (month, day) == (7, 7) else DATA)
+        cls.path = os.path.join(cls.tmp.name, 'snapshot')
+        cls.entries = build_snapshot(cls.store, cls.path)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmp.cleanup()
+
+    def setUp(self):
+        self.results = Snapshot(self.path).day(5, 27)
+
+    def test_build(self):
+        self.assertEqual(365 * DATA_LENGTH + len(Results(CORRUPTED)), self.entries)
+
+    def test_same_as_results(self):
+        expected = Results(DATA)
+        self.assertEqual((expected.date, expected.url), (self.results.date, self.results.url))
+        self.assertEqual([(entry.year, entry.text, str(entry)) for entry in expected],
+                         [(entry.year, entry.text, str(entry)) for entry in self.results])
+
+    def test_corrupted(self):
+        self.assertEqual([str(entry) for entry in Results(CORRUPTED)],
+                         [str(entry) for entry in Snapshot(self.path).day(7, 7)])
+
+    def test_rendered_after_templates_invalidated(self):
+        with patch('history.utils.event_template', Mock(return_value='text')):
+            invalidate_templates()
+            self.assertEqual('text', str(self.results.events[0]))
+            self.assertEqual(str(Results(DATA).births[0]), str(self.results.births[0]))
+
+    def test_live_renders_memoized(self):
+        template = Mock(return_value='text')
+        with patch('history.utils.event_template', template):
+            invalidate_templates()
+            snapshot = Snapshot(self.path)
+            for _ in range(2):
+                self.assertEqual('text', str(snapshot.day(5, 27).events[0]))
+        self.assertEqual(1, template.call_count)
+
+    def test_swapped_after_templates_invalidated(self):
+        now = [0]
+        path, rebuilt = os.path.join(self.tmp.name, 'invalidated'), os.path.join(self.tmp.name, 'rebuilt')
+        build_snapshot(self.store, path)
+        build_snapshot(self.store, rebuilt)
+        api = SnapshotAPI(path, check_interval=10, clock=lambda: now[0])
+        with patch('history.utils.event_template', Mock(return_value='text')):
+            invalidate_templates()
+            os.replace(rebuilt, path)
+            now[0] = 10
+            self.assertEqual('text', str(api.date(5, 27).events[0]))
+
+    def test_links(self):
+        self.assertEqual([(link.title, link.link) for link in Results(DATA).events[2].links],
+                         [(link.title, link.link) for link in self.results.events[2].links])
+
+    def test_search(self):
+        self.assertEqual([str(entry) for entry in Results(DATA).search('927')],
+                         [str(entry) for entry in self.results.search('927')])
+        self.assertEqual(len(Results(DATA).search_range(900, 1200)), len(self.results.search_range(900, 1200)))
+        self.assertEqual(0, len(self.results.search('1')))
+
+    def test_indexing(self):
+        events = Results(DATA).events
+        self.assertEqual(str(events[-1]), str(self.results.events[-1]))
+        self.assertEqual([str(entry) for entry in events[1:3]], [str(entry) for entry in self.results.events[1:3]])
+        with self.assertRaises(IndexError):
+            self.results.events[len(events)]
+
+    def test_api(self):
+        api = SnapshotAPI(self.path)
+        self.assertEqual(2, len(api.date(5, 27, '927')))
+        self.assertEqual(DATA_LENGTH, len(api.today()))
+        self.assertEqual({'cache': 0, 'fallback': 0}, api.fallbacks)
+
+    def test_missing_date(self):
+        with self.assertRaises(ValueError):
+            Snapshot(self.path).day(2, 30)
+
+    def test_invalid_file(self):
+        path = os.path.join(self.tmp.name, 'invalid')
+        with open(path, 'wb') as f:
+            f.write(b'\0' * 64)
+        with self.assertRaises(ValueError):
+            Snapshot(path)
+
+    def test_swapped(self):
+        now = [0]
+        path = os.path.join(self.tmp.name, 'swapped')
+        build_snapshot(self.store, path)
+        api = SnapshotAPI(path, check_interval=10, clock=lambda: now[0])
+        old = api.date(5, 27)
+        store = Store(os.path.join(self.tmp.name, 'other'))
+        for month, day in days():
+            store.save(month, day, CORRUPTED)
+        build_snapshot(store, path)
+        self.assertEqual(DATA_LENGTH, len(api.date(5, 27)))
+        now[0] = 10
+        self.assertEqual(len(Results(CORRUPTED)), len(api.date(5, 27)))
+        # The views of the old snapshot are still valid.
+        self.assertEqual(str(Results(DATA)[0]), str(old[0]))
+
+
+class TestWarmer(unittest.TestCase):
+    def test_upcoming_dates(self):
+        self.assertEqual([(3, 20), (3, 21), (3, 22)], upcoming_dates(datetime(2020, 3, 20, 12)))
+        self.assertEqual([(3, 19), (3, 20), (3, 21), (3, 22)], upcoming_dates(datetime(2020, 3, 20, 11)))
+        self.assertEqual([(2, 28), (3, 1), (3, 2)], upcoming_dates(datetime(2021, 2, 28, 23)))
+
+    def test_warm(self):
+        api, results = Mock(), Mock()
+        api.date.side_effect = [results, ValueError(), results]
+        warmer = Warmer(api, logger=Mock(), clock=lambda: datetime(2020, 3, 20, 12))
+        warmer.warm()
+        self.assertEqual([call(3, 20), call(3, 21), call(3, 22)], api.date.call_args_list)
+        self.assertEqual(2, results.prerender.call_count)
+        self.assertEqual({'runs': 1, 'errors': 1}, {key: warmer.stats[key] for key in ('runs', 'errors')})
+        self.assertGreaterEqual(warmer.stats['last_duration'], 0)
+
+    def test_warm_cached(self):
+        api = API(cache=Cache())
+        with patch('requests.Session.get', return_value=Mock(status_code=200, content=dumps(DATA).encode('utf-8'))):
+            Warmer(api, clock=lambda: datetime(2020, 3, 20, 12)).warm()
+        self.assertEqual(3, len(api.cache))
+        results = api.date(3, 21)
+        self.assertTrue(all(text is not None for text in results.deaths._rendered))
+
+    def test_start(self):
+        api = Mock()
+        background_run_done = Event()
+
+        def date(month, day):
+            # The third run only starts after the first run in the background has finished.
+            if api.date.call_count > 6:
+                background_run_done.set()
+            return Mock()
+        api.date.side_effect = date
+        warmer = Warmer(api, interval=0.01, clock=lambda: datetime(2020, 3, 20, 12))
+        self.addCleanup(warmer.stop)
+        warmer.start(wait=True)
+        # Warmed up before returning, the background runs may have started since.
+        self.assertGreaterEqual(api.date.call_count, 3)
+        self.assertTrue(background_run_done.wait(5))
+        warmer.stop()
+        self.assertGreater(warmer.runs, 1)
+
+    def test_stop_waits_for_running_warm_up(self):
+        started, release = Event(), Event()
+        api = Mock()
+        api.date.side_effect = lambda month, day: started.set() or release.wait(5) and Mock()
+        warmer = Warmer(api, interval=3600, clock=lambda: datetime(2020, 3, 20, 12))
+        warmer.start()
+        self.assertTrue(started.wait(5))
+        Timer(0.05, release.set).start()
+        warmer.stop()
+        self.assertEqual(1, warmer.runs)
+
+    def test_thread_per_process(self):
+        api = Mock()
+        warmer = Warmer(api, interval=3600, clock=lambda: datetime(2020, 3, 20, 12))
+        self.addCleanup(warmer.stop)
+        warmer.start(wait=True)
+
+        def start_in_child():
+            inherited = warmer._thread.current()
+            warmer.start()
+            return inherited is None and warmer._thread.current() is not None and api.date.call_count == 3
+        # The warm-up inherited from the parent is not repeated at once.
+        self.assertTrue(in_fork(start_in_child))
+
+
+class TestIndex(unittest.TestCase):
+    '''Test the full-text index.'''
+
+    def setUp(self):
+        self.index = Index.build([((5, 27), Results(DATA)), ((7, 7), Results(CORRUPTED))])
+
+    def test_length(self):
+        self.assertEqual(DATA_LENGTH + 6, len(self.index))
+
+    def test_search(self):
+        hit = self.index.search('Simeon the Great')[0]
+        self.assertEqual((5, 27, 'events', 0), (hit.month, hit.day, hit.category, hit.index))
+
+    def test_search_link_titles(self):
+        hit = self.index.search('when was the assassination of Lincoln?')[0]
+        self.assertEqual((7, 7, 'deaths', 1), (hit.month, hit.day, hit.category, hit.index))
+
+    def test_search_ranked(self):
+        hits = self.index.search('Bulgarian', limit=10)
+        self.assertEqual(hits, sorted(hits, key=lambda hit: -hit.score))
+
+    def test_search_category_hint(self):
+        hits = self.index.search('Bulgarian died', limit=10)
+        self.assertEqual('deaths', hits[0].category)
+
+    def test_search_limit(self):
+        self.assertEqual(1, len(self.index.search('Bulgarian', limit=1)))
+
+    def test_search_unknown(self):
+        self.assertEqual([], self.index.search('Hastings'))
+
+    def test_resolve(self):
+        hit = self.index.search('Simeon the Great')[0]
+        self.assertEqual('Death of Simeon I the Great, the first Bulgarian to be recognized as Emperor.',
+                         Index.resolve(hit, Results(DATA)).text)
+
+    def test_resolve_changed_entry(self):
+        hit = self.index.search('Simeon the Great')[0]
+        changed = deepcopy(DATA)
+        changed['data']['Events'][0]['text'] = 'Death of Simeon I.'
+        self.assertIsNone(Index.resolve(hit, Results(changed)))
+        self.assertIsNone(Index.resolve(hit._replace(index=10), Results(DATA)))
+
+    def test_save_load(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        path = os.path.join(tmp.name, 'index')
+        self.index.save(path)
+        self.assertEqual(self.index.search('Simeon'), Index.load(path).search('Simeon'))
+
+    def test_build_from_store(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        store = Store(tmp.name)
+        with patch('history.index.days', return_value=[(5, 27)]):
+            store.save(5, 27, DATA)
+            self.assertEqual(DATA_LENGTH, len(Index.build_from_store(store)))
 
 
 if __name__ == '__main__':
@@ -1,8 +1,19 @@
 import re
 
+try:
+    # The faster JSON decoders are optional, they all accept bytes and raise `ValueError`.
+    from orjson import loads
+except ImportError:
+    try:
+        from ujson import loads
+    except ImportError:
+        from json import loads
+
 
 YEAR_REGEXP = re.compile('(\s\([bd]{1}\.\s(\w*?)\))')
 SANITIZE_REGEXP = re.compile('\s+')
+# Bumped by `invalidate_templates`, so that the memoized rendered entries are dropped.
+TEMPLATES_GENERATION = 0
 
 
 def year_to_int(value):
@@ -17,6 +28,19 @@ def year_to_int(value):
         pass
 
 
+def decade_range(year, bc=False):
+    '''Returns the inclusive `(start, end)` range of the decade, as integers from `year_to_int`.'''
+    start = year - year % 10
+    return (-(start + 9), -start) if bc else (start, start + 9)
+
+
+def century_range(century, bc=False):
+    '''Returns the inclusive `(start, end)` range of the century, as integers from `year_to_int`.'''
+    assert century >= 1
+    start, end = (century - 1) * 100 + 1, century * 100
+    return (-end, -start) if bc else (start, end)
+
+
 def event_template(year, text):
     '''Formats the event representation.'''
     text = SANITIZE_REGEXP.sub(' ', text)
@@ -41,5 +65,11 @@ def death_template(year, text):
     return add_ellipsis(message, 320)
 
 
+def invalidate_templates():
+    '''Drops the memoized rendered entries, has to be called when the templates change.'''
+    global TEMPLATES_GENERATION
+    TEMPLATES_GENERATION += 1
+
+
 def add_ellipsis(text, limit):
     return '{text}...'.format(text=text[:limit - 3]) if len(text) > limit else text
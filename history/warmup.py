@@ -0,0 +1,106 @@
+'''Prefetching of the dates which are about to be asked about.'''
+from datetime import datetime, timedelta
+from threading import Event, Lock, Thread
+import logging
+import time
+
+from forks import PerProcess, register
+from metrics import NullMetrics
+
+
+# The local time is between UTC-12:00 and UTC+14:00 everywhere on Earth.
+UTC_OFFSETS = (timedelta(hours=-12), timedelta(hours=14))
+
+
+def upcoming_dates(now=None):
+    '''Returns the `(month, day)` dates which are today or tomorrow somewhere on Earth at the UTC time.'''
+    now = now if now is not None else datetime.utcnow()
+    first, last = ((now + offset).date() for offset in UTC_OFFSETS)
+    last += timedelta(days=1)
+    return [((first + timedelta(days=i)).month, (first + timedelta(days=i)).day)
+            for i in range((last - first).days + 1)]
+
+
+class Warmer:
+    '''Fetches and renders the upcoming dates in advance, so that they are served from the cache of the API.
+
+    `warm` runs once, `start` runs it in a background thread of the process every `interval` seconds. The forked
+    processes inherit the warm cache but not the thread, they call `start` themselves, e.g. the gunicorn workers of
+    the preloaded app (see `gunicorn_conf`). The next warm-up is due `interval` seconds after the last one, also the
+    one inherited from the parent.
+    '''
+
+    def __init__(self, api, interval=600, logger=None, metrics=None, clock=datetime.utcnow):
+        assert interval > 0
+        self.api = api
+        self.interval = interval
+        self.logger = logger if logger is not None else logging.getLogger(__name__)
+        # Optional `metrics.Metrics` which times the warm-ups.
+        self.metrics = metrics if metrics is not None else NullMetrics()
+        self.clock = clock
+        self.runs = 0
+        self.errors = 0
+        self.last_duration = None
+        self._warmed_at = None
+        self._lock = Lock()
+        # The thread and its stop event.
+        self._thread = PerProcess(self._start_thread)
+        register(self)
+
+    def warm(self):
+        '''Fetches and renders the upcoming dates, returns the duration in seconds.'''
+        started = time.monotonic()
+        dates = upcoming_dates(self.clock())
+        errors = 0
+        with self.metrics.track('warmup'):
+            for month, day in dates:
+                try:
+                    self.api.date(month, day).prerender()
+                except Exception:
+                    errors += 1
+                    self.logger.exception('Failed to warm up the date %d/%d', month, day)
+        duration = time.monotonic() - started
+        with self._lock:
+            self._warmed_at = started
+            self.runs += 1
+            self.errors += errors
+            self.last_duration = duration
+        self.logger.info('Warmed up %d dates in %.3f s, %d failed', len(dates), duration, errors)
+        return duration
+
+    def start(self, wait=False):
+        '''Starts warming up in the background, `wait` warms up before returning, e.g. before gunicorn forks.'''
+        if wait:
+            self.warm()
+        self._thread.get()
+
+    def stop(self, timeout=None):
+        '''Stops the thread of this process, waits for the running warm-up to finish, e.g. before gunicorn forks.'''
+        running = self._thread.clear()
+        if running is not None:
+            thread, stop = running
+            stop.set()
+            thread.join(timeout)
+
+    def _after_fork(self):
+        # The lock may have been held by another thread of the parent while forking.
+        self._lock = Lock()
+
+    def _start_thread(self):
+        stop = Event()
+        thread = Thread(target=self._run, args=(stop,), daemon=True)
+        thread.start()
+        return thread, stop
+
+    def _run(self, stop):
+        while not stop.wait(self._until_next()):
+            self.warm()
+
+    def _until_next(self):
+        with self._lock:
+            return 0 if self._warmed_at is None else max(self._warmed_at + self.interval - time.monotonic(), 0)
+
+    @property
+    def stats(self):
+        with self._lock:
+            return {'runs': self.runs, 'errors': self.errors, 'last_duration': self.last_duration}
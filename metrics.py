@@ -0,0 +1,254 @@
+'''Counters, gauges and latency histograms in the Prometheus text format.'''
+from collections import defaultdict
+from contextlib import nullcontext
+from json import dump, load
+from threading import Lock, Thread
+import bisect
+import os
+import tempfile
+import time
+
+from forks import PerProcess
+
+
+# Upper bounds of the latency histogram buckets, in seconds.
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Metrics:
+    '''Thread-safe registry of the metrics of the process.
+
+    With a `directory` every process (e.g. gunicorn worker) periodically writes its metrics to a file there, and
+    `render` sums the metrics of all the live processes, so that any worker can answer the scrape. The values are
+    reset in the forked processes, so that they are not counted twice.
+
+    Besides the observed stages, the `collectors` are called on every snapshot and return the current
+    `(kind, name, labels, value)` samples of the components which keep their own counters, e.g. the caches. The
+    `shared_gauge` samples describe a resource shared by the processes, e.g. the size of a shared store, and are
+    rendered as a gauge with the largest value reported instead of the sum.
+    '''
+
+    def __init__(self, prefix='chronologist', directory=None, flush_interval=5, buckets=BUCKETS):
+        self.prefix = prefix
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.buckets = tuple(buckets)
+        self._collectors = []
+        self._lock = Lock()
+        # The values and the flushing thread are per process, so that the forked processes don't count them twice.
+        self._process = PerProcess(self._start_process)
+        self._reset()
+
+    def inc(self, name, value=1, **labels):
+        '''Increments the counter.'''
+        self._start()
+        with self._lock:
+            self._counters[(name, _key(labels))] += value
+
+    def add(self, name, value, **labels):
+        '''Adds the value to the gauge, it can be negative.'''
+        self._start()
+        with self._lock:
+            self._gauges[(name, _key(labels))] += value
+
+    def observe(self, name, value, **labels):
+        '''Adds the value to the histogram.'''
+        self._start()
+        with self._lock:
+            histogram = self._histograms.get((name, _key(labels)))
+            if histogram is None:
+                histogram = self._histograms[(name, _key(labels))] = [[0] * (len(self.buckets) + 1), 0.0]
+            histogram[0][bisect.bisect_left(self.buckets, value)] += 1
+            histogram[1] += value
+
+    def track(self, stage):
+        '''Context manager which times the stage, counts its errors and the calls in flight.'''
+        return _Tracker(self, stage)
+
+    def register(self, collector):
+        '''Adds the function which returns the current `(kind, name, labels, value)` samples.'''
+        self._collectors.append(collector)
+
+    def snapshot(self):
+        '''Returns the metrics of this process.'''
+        self._start()
+        with self._lock:
+            counters = dict(self._counters)
+            gauges = dict(self._gauges)
+            histograms = {key: [list(counts), total] for key, (counts, total) in self._histograms.items()}
+        shared = {}
+        for collector in self._collectors:
+            for kind, name, labels, value in collector():
+                {'counter': counters, 'shared_gauge': shared}.get(kind, gauges)[(name, _key(labels))] = value
+        return {
+            'counters': [[name, labels, value] for (name, labels), value in counters.items()],
+            'gauges': [[name, labels, value] for (name, labels), value in gauges.items()],
+            'shared_gauges': [[name, labels, value] for (name, labels), value in shared.items()],
+            'histograms': [[name, labels, counts, total] for (name, labels), (counts, total) in histograms.items()],
+        }
+
+    def flush(self):
+        '''Atomically writes the snapshot to the directory.'''
+        if self.directory is None:
+            return
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                dump(self.snapshot(), f)
+            os.replace(tmp, os.path.join(self.directory, '{pid}.json'.format(pid=os.getpid())))
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    def render(self):
+        '''Returns the metrics of all the processes in the Prometheus text format.'''
+        snapshots = [self.snapshot()]
+        if self.directory is not None:
+            self.flush()
+            snapshots = [snapshot for pid, snapshot in self._load() if pid != os.getpid()] + snapshots
+        counters, gauges = defaultdict(float), defaultdict(float)
+        shared, histograms = {}, {}
+        for snapshot in snapshots:
+            for name, labels, value in snapshot['counters']:
+                counters[(name, _key(labels))] += value
+            for name, labels, value in snapshot['gauges']:
+                gauges[(name, _key(labels))] += value
+            for name, labels, value in snapshot.get('shared_gauges', ()):
+                key = (name, _key(labels))
+                shared[key] = max(shared.get(key, value), value)
+            for name, labels, counts, total in snapshot['histograms']:
+                histogram = histograms.setdefault((name, _key(labels)), [[0] * len(counts), 0.0])
+                histogram[0] = [a + b for a, b in zip(histogram[0], counts)]
+                histogram[1] += total
+        gauges.update(shared)
+        lines = []
+        for kind, samples in (('counter', counters), ('gauge', gauges)):
+            for name in sorted(set(name for name, _ in samples)):
+                lines.append('# TYPE {prefix}_{name} {kind}'.format(prefix=self.prefix, name=name, kind=kind))
+                for (sample_name, labels), value in sorted(samples.items()):
+                    if sample_name == name:
+                        lines.append('{prefix}_{name}{labels} {value}'.format(
+                            prefix=self.prefix, name=name, labels=_format(labels), value=_number(value)))
+        for name in sorted(set(name for name, _ in histograms)):
+            lines.append('# TYPE {prefix}_{name} histogram'.format(prefix=self.prefix, name=name))
+            for (sample_name, labels), (counts, total) in sorted(histograms.items()):
+                if sample_name != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(self.buckets + ('+Inf',), counts):
+                    cumulative += count
+                    lines.append('{prefix}_{name}_bucket{labels} {value}'.format(
+                        prefix=self.prefix, name=name, labels=_format(labels + (('le', _number(bound)),)),
+                        value=cumulative))
+                lines.append('{prefix}_{name}_sum{labels} {value}'.format(
+                    prefix=self.prefix, name=name, labels=_format(labels), value=_number(total)))
+                lines.append('{prefix}_{name}_count{labels} {value}'.format(
+                    prefix=self.prefix, name=name, labels=_format(labels), value=cumulative))
+        return '\n'.join(lines) + '\n'
+
+    def _load(self):
+        '''Yields the `(pid, snapshot)` of the live processes, removes the files of the exited ones.'''
+        for filename in os.listdir(self.directory):
+            name, extension = os.path.splitext(filename)
+            if extension != '.json' or not name.isdigit():
+                continue
+            path = os.path.join(self.directory, filename)
+            if not _alive(int(name)):
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+                continue
+            try:
+                with open(path) as f:
+                    yield int(name), load(f)
+            except (FileNotFoundError, ValueError):
+                continue
+
+    def _reset(self):
+        self._counters = defaultdict(float)
+        self._gauges = defaultdict(float)
+        self._histograms = {}
+
+    def _start(self):
+        self._process.get()
+
+    def _start_process(self):
+        # The lock may have been held by another thread of the parent while forking.
+        self._lock = Lock()
+        self._reset()
+        if self.directory is not None:
+            os.makedirs(self.directory, exist_ok=True)
+            Thread(target=self._flush_periodically, daemon=True).start()
+        return os.getpid()
+
+    def _flush_periodically(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except OSError:
+                pass
+
+
+class NullMetrics:
+    '''Stand-in for `Metrics` in the components which are not measured.'''
+
+    def inc(self, name, value=1, **labels):
+        pass
+
+    def add(self, name, value, **labels):
+        pass
+
+    def observe(self, name, value, **labels):
+        pass
+
+    def track(self, stage):
+        return nullcontext()
+
+    def register(self, collector):
+        pass
+
+
+class _Tracker:
+    def __init__(self, metrics, stage):
+        self.metrics = metrics
+        self.stage = stage
+
+    def __enter__(self):
+        self.metrics.add('stage_in_flight', 1, stage=self.stage)
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.metrics.observe('stage_seconds', time.perf_counter() - self.started, stage=self.stage)
+        self.metrics.add('stage_in_flight', -1, stage=self.stage)
+        if exc_type is not None:
+            self.metrics.inc('stage_errors_total', stage=self.stage)
+        return False
+
+
+def _key(labels):
+    return tuple(sorted(labels.items())) if isinstance(labels, dict) else tuple(tuple(label) for label in labels)
+
+
+def _format(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('{name}="{value}"'.format(
+        name=name, value=str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n'))
+        for name, value in labels)
+
+
+def _number(value):
+    return str(int(value)) if isinstance(value, float) and value.is_integer() else str(value)
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
@@ -0,0 +1,121 @@
+from threading import Thread
+import hashlib
+import hmac
+import json
+import os
+import queue
+import time
+
+from forks import PerProcess
+
+
+class Recorder:
+    '''Appends the sanitized webhook payloads to a JSONL file, for `python -m benchmarks.replay`.
+
+    The payloads are sanitized and written by a background thread, `record` only enqueues them and drops them when
+    the queue is full. The user and page ids are replaced with their keyed hashes, so the same user keeps the same
+    id, and only the text of the messages is kept. The file can be shared by the gunicorn workers, every batch of
+    lines is appended with a single write.
+    '''
+
+    EVENTS = ('message', 'postback', 'delivery', 'read')
+
+    def __init__(self, path, salt=None, queue_size=10000, clock=time.time):
+        self.path = path
+        # The workers have to share the salt to map the same user to the same id.
+        self.salt = (salt if salt is not None else os.urandom(16).hex()).encode('utf-8')
+        self.queue_size = queue_size
+        self.clock = clock
+        self.recorded = 0
+        self.dropped = 0
+        # The thread is started in the process which records, so that the recorder can be created before forking.
+        self._writer = PerProcess(self._start)
+
+    def record(self, payload):
+        '''Enqueues the payload, returns `False` if it is dropped.'''
+        records, _ = self._writer.get()
+        try:
+            records.put_nowait((self.clock(), payload))
+        except queue.Full:
+            self.dropped += 1
+            return False
+        return True
+
+    def close(self, timeout=None):
+        '''Writes the already enqueued payloads and stops the background thread.'''
+        writer = self._writer.clear()
+        if writer is None:
+            return
+        records, thread = writer
+        records.put(None)
+        thread.join(timeout)
+
+    def sanitize(self, payload):
+        '''Returns the copy of the payload with the anonymized ids and without the data not needed for replays.'''
+        entries = []
+        for entry in payload.get('entry', []):
+            events = []
+            for event in entry.get('messaging', []):
+                sanitized = {
+                    'sender': {'id': self.anonymize(event.get('sender', {}).get('id'))},
+                    'recipient': {'id': self.anonymize(event.get('recipient', {}).get('id'))},
+                    'timestamp': event.get('timestamp'),
+                }
+                for name in self.EVENTS:
+                    if name in event:
+                        sanitized[name] = {}
+                message = event.get('message')
+                if message and message.get('text'):
+                    sanitized['message'] = {'text': message['text']}
+                events.append(sanitized)
+            entries.append({'id': self.anonymize(entry.get('id')), 'time': entry.get('time'), 'messaging': events})
+        return {'object': payload.get('object'), 'entry': entries}
+
+    def anonymize(self, value):
+        if value is None:
+            return None
+        return hmac.new(self.salt, str(value).encode('utf-8'), hashlib.sha256).hexdigest()[:16]
+
+    def _start(self):
+        records = queue.Queue(self.queue_size)
+        thread = Thread(target=self._run, args=(records,), daemon=True)
+        thread.start()
+        return records, thread
+
+    def _run(self, records):
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        try:
+            while True:
+                batch = [records.get()]
+                while len(batch) < 100:
+                    try:
+                        batch.append(records.get_nowait())
+                    except queue.Empty:
+                        break
+                stop = None in batch
+                lines = []
+                for record in batch:
+                    if record is None:
+                        continue
+                    recorded_at, payload = record
+                    try:
+                        lines.append(json.dumps({'time': recorded_at, 'payload': self.sanitize(payload)}) + '\n')
+                    except (AttributeError, TypeError):
+                        # Not a webhook payload.
+                        self.dropped += 1
+                if lines:
+                    os.write(fd, ''.join(lines).encode('utf-8'))
+                    self.recorded += len(lines)
+                if stop:
+                    return
+        finally:
+            os.close(fd)
+
+
+def load(path):
+    '''Yields the `(time, payload)` records of the file.'''
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                yield record['time'], record['payload']
@@ -0,0 +1,130 @@
+from contextlib import contextmanager, nullcontext
+from threading import Lock
+import time
+
+
+class DeadlineExceeded(TimeoutError):
+    pass
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class Deadline:
+    '''Time budget of the handling of one message, passed down to the calls of the upstreams.'''
+
+    def __init__(self, budget, clock=time.monotonic):
+        self.clock = clock
+        self.expires_at = clock() + budget
+
+    def remaining(self):
+        return max(self.expires_at - self.clock(), 0)
+
+    @property
+    def expired(self):
+        return self.remaining() <= 0
+
+    def timeout(self, limit=None):
+        '''Returns the remaining seconds capped by the limit, raises `DeadlineExceeded` if nothing remains.'''
+        remaining = self.remaining()
+        if remaining <= 0:
+            raise DeadlineExceeded('The time budget is exhausted')
+        return remaining if limit is None else min(limit, remaining)
+
+    def reserve(self, seconds):
+        '''Returns the deadline which expires the given seconds earlier, e.g. to keep some time for the reply.'''
+        deadline = Deadline(0, self.clock)
+        deadline.expires_at = self.expires_at - seconds
+        return deadline
+
+
+class CircuitBreaker:
+    '''Fails the calls of an upstream fast after `threshold` consecutive failures.
+
+    The circuit stays open for `reset_timeout` seconds, then a single trial call is let through. Its success closes
+    the circuit, its failure opens it again. The state is kept per process.
+    '''
+
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+
+    def __init__(self, name, threshold=5, reset_timeout=30, clock=time.monotonic):
+        assert threshold > 0
+        self.name = name
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened = 0
+        self.rejected = 0
+        self._opened_at = None
+        self._trial = False
+        self._lock = Lock()
+
+    @contextmanager
+    def protect(self, ignore=(), deadline=None):
+        '''Guards the call of the upstream, raises `CircuitOpenError` if the circuit is open.
+
+        The `ignore` errors are the answers of a healthy upstream, e.g. to an invalid request, and count as successes.
+        A failure after the `resilience.Deadline` of the call has expired is blamed on the spent budget and doesn't
+        count at all.
+        '''
+        self._before()
+        try:
+            yield
+        except ignore:
+            self._success()
+            raise
+        except BaseException:
+            if deadline is not None and deadline.expired:
+                self._release()
+            else:
+                self._failure()
+            raise
+        else:
+            self._success()
+
+    def _before(self):
+        with self._lock:
+            if self.state == self.CLOSED:
+                return
+            if self.state == self.OPEN and self.clock() - self._opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+            if self.state == self.HALF_OPEN and not self._trial:
+                self._trial = True
+                return
+            self.rejected += 1
+        raise CircuitOpenError('The circuit of {name} is open'.format(name=self.name))
+
+    def _success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+            self._trial = False
+
+    def _release(self):
+        with self._lock:
+            self._trial = False
+
+    def _failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.threshold:
+                if self.state != self.OPEN:
+                    self.opened += 1
+                self.state = self.OPEN
+                self._opened_at = self.clock()
+                self._trial = False
+
+    @property
+    def stats(self):
+        with self._lock:
+            return {'state': self.state, 'failures': self.failures, 'opened': self.opened, 'rejected': self.rejected}
+
+
+class NullBreaker:
+    '''Stand-in for `CircuitBreaker` of the upstreams which are always called.'''
+
+    def protect(self, ignore=(), deadline=None):
+        return nullcontext()
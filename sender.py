@@ -0,0 +1,133 @@
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+from forks import PerProcess
+from messengerbot import MessengerError
+from metrics import NullMetrics
+from resilience import NullBreaker
+from requests.adapters import HTTPAdapter
+from threading import Lock
+import requests
+import time
+
+
+class Sender:
+    '''Sends the messenger requests of the `messengerbot.MessengerClient` through a pooled keep-alive session.
+
+    The requests to different recipients are sent in parallel, the requests to the same recipient are sent one by
+    one in the given order.
+    '''
+
+    def __init__(self, client, workers=8, pool_size=10, connect_timeout=3.05, read_timeout=10, graph_api_url=None,
+                 window=1000, metrics=None, breaker=None):
+        assert workers > 0
+        self.client = client
+        # Optional `metrics.Metrics` which times the sends.
+        self.metrics = metrics if metrics is not None else NullMetrics()
+        # Optional `resilience.CircuitBreaker` of the Graph API.
+        self.breaker = breaker if breaker is not None else NullBreaker()
+        self.workers = workers
+        self.graph_api_url = graph_api_url if graph_api_url is not None else client.GRAPH_API_URL
+        self.timeout = (connect_timeout, read_timeout)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.sent = 0
+        self.errors = 0
+        # Latencies of the last sent requests, in seconds.
+        self._latencies = deque(maxlen=window)
+        self._lock = Lock()
+        self._executor = PerProcess(lambda: ThreadPoolExecutor(self.workers, thread_name_prefix='sender'))
+
+    def send(self, rqst, deadline=None):
+        '''Sends one request, raises `messengerbot.MessengerException` on failure.
+
+        The optional `resilience.Deadline` bounds the timeouts, `resilience.DeadlineExceeded` is raised when it is
+        exceeded.
+        '''
+        started = time.monotonic()
+        try:
+            with self.metrics.track('messenger_send'):
+                timeout = tuple(deadline.timeout(t) for t in self.timeout) if deadline is not None else self.timeout
+                # Only the server errors count against the Graph API, the rejected requests don't.
+                with self.breaker.protect(deadline=deadline):
+                    response = self.session.post('%s/messages' % self.graph_api_url,
+                                                 params={'access_token': self.client.access_token},
+                                                 json=rqst.to_dict(), timeout=timeout)
+                    if response.status_code >= 500:
+                        MessengerError(**response.json()['error']).raise_exception()
+                if response.status_code != 200:
+                    MessengerError(**response.json()['error']).raise_exception()
+        except Exception:
+            with self._lock:
+                self.errors += 1
+            raise
+        finally:
+            with self._lock:
+                self._latencies.append(time.monotonic() - started)
+        with self._lock:
+            self.sent += 1
+        return response.json()
+
+    def send_all(self, rqsts, deadline=None):
+        '''Sends the requests and waits for them, raises the first error after all the requests are done.'''
+        groups = OrderedDict()
+        for rqst in rqsts:
+            groups.setdefault(rqst.recipient.recipient_id or rqst.recipient.phone_number, []).append(rqst)
+        if len(groups) <= 1:
+            for group in groups.values():
+                self._send_group(group, deadline)
+            return
+        wait_all([self._pool().submit(self._send_group, group, deadline) for group in groups.values()])
+
+    def submit(self, rqsts, deadline=None, after=None):
+        '''Sends the requests in the background, returns their future.
+
+        The requests are sent one by one after the `after` future is done, e.g. the one of the previous requests to
+        the same recipient.
+        '''
+        return self._pool().submit(self._send_group, rqsts, deadline, after)
+
+    def _send_group(self, rqsts, deadline=None, after=None):
+        if after is not None:
+            # Submitted earlier, so it has already been taken by another thread of the pool.
+            wait([after])
+        for rqst in rqsts:
+            self.send(rqst, deadline)
+
+    def _pool(self):
+        return self._executor.get()
+
+    def shutdown(self):
+        executor = self._executor.clear()
+        if executor is not None:
+            executor.shutdown()
+
+    @property
+    def stats(self):
+        with self._lock:
+            latencies = sorted(self._latencies)
+            sent, errors = self.sent, self.errors
+        return {
+            'sent': sent,
+            'errors': errors,
+            'latency_p50': percentile(latencies, 50),
+            'latency_p99': percentile(latencies, 99),
+            'latency_max': latencies[-1] if latencies else None,
+        }
+
+
+def wait_all(futures):
+    '''Waits for the futures, raises the first error after all of them are done.'''
+    wait(futures)
+    for future in futures:
+        if future.exception() is not None:
+            raise future.exception()
+
+
+def percentile(values, percent):
+    '''Nearest-rank percentile of the sorted values.'''
+    if not values:
+        return None
+    rank = max(int(round(percent / 100 * len(values))), 1)
+    return values[rank - 1]
@@ -0,0 +1,658 @@
+from concurrent.futures import Future
+from copy import deepcopy
+from messengerbot import MessengerClient, MessengerException, messages
+from threading import Event, Timer
+from unittest.mock import ANY, Mock, patch
+import multiprocessing
+import os
+import queue
+import random
+import signal
+import tempfile
+import time
+import unittest
+
+from ai import Action
+from app import app
+from benchmarks import fakes, models as bench_models
+from benchmarks.replay import schedule
+from benchmarks.stages import Stages
+from benchmarks.webhook import webhook as bench_webhook
+from forks import PerProcess
+from history import API
+from history.index import Index
+from history.models import Results
+from history.store import LocalAPI, Store
+from history.tests import DATA
+from metrics import Metrics, NullMetrics
+from recorder import Recorder, load
+from resilience import CircuitBreaker, CircuitOpenError, Deadline, DeadlineExceeded
+from sender import Sender
+from workers import Dispatcher
+import gunicorn_conf
+
+
+def fork(check):
+    '''Runs the check in a forked child, returns its result.'''
+    pid = os.fork()
+    if pid == 0:
+        os._exit(0 if check() else 1)
+    _, status = os.waitpid(pid, 0)
+    return os.waitstatus_to_exitcode(status) == 0
+
+
+class TestPerProcess(unittest.TestCase):
+    '''Test the values which belong to a process.'''
+
+    def test_created_once_per_process(self):
+        factory = Mock(side_effect=lambda: object())
+        per_process = PerProcess(factory)
+        self.assertIs(per_process.get(), per_process.get())
+        self.assertEqual(1, factory.call_count)
+        self.assertTrue(fork(lambda: per_process.current() is None and per_process.get() is not None))
+
+    def test_clear(self):
+        per_process = PerProcess(object)
+        value = per_process.get()
+        self.assertIs(value, per_process.clear())
+        self.assertIsNone(per_process.current())
+        self.assertIsNot(value, per_process.get())
+
+
+class TestDispatcher(unittest.TestCase):
+    '''Test the background workers.'''
+
+    def when_dispatcher_started(self, handler, **kwargs):
+        dispatcher = Dispatcher(handler, **kwargs)
+        self.addCleanup(dispatcher.shutdown, 5)
+        return dispatcher
+
+    def test_jobs_handled(self):
+        handler = Mock()
+        dispatcher = self.when_dispatcher_started(handler, workers=2)
+        dispatcher.submit('a', 'a', 'hello')
+        dispatcher.shutdown(5)
+        handler.assert_called_once_with('a', 'hello')
+
+    def test_order_per_key(self):
+        handled = []
+        dispatcher = self.when_dispatcher_started(lambda key, i: handled.append((key, i)), workers=4)
+        for i in range(100):
+            for key in ('a', 'b', 'c'):
+                dispatcher.submit(key, key, i)
+        dispatcher.shutdown(5)
+        for key in ('a', 'b', 'c'):
+            self.assertEqual(list(range(100)), [i for k, i in handled if k == key])
+
+    def test_full_queue(self):
+        release = Event()
+        dispatcher = self.when_dispatcher_started(lambda: release.wait(5), workers=1, queue_size=1, submit_timeout=0.05)
+        self.addCleanup(release.set)
+        results = [dispatcher.submit('a') for _ in range(3)]
+        self.assertFalse(results[-1])
+
+    def test_submit_waits_for_full_queue(self):
+        release, handled = Event(), []
+        dispatcher = self.when_dispatcher_started(lambda i: release.wait(5) and handled.append(i), workers=1,
+                                                  queue_size=1, submit_timeout=5)
+        self.assertTrue(dispatcher.submit('a', 0))
+        self.assertTrue(dispatcher.submit('a', 1))
+        Timer(0.05, release.set).start()
+        self.assertTrue(dispatcher.submit('a', 2))
+        dispatcher.shutdown(5)
+        self.assertEqual([0, 1, 2], handled)
+
+    def test_handler_error(self):
+        handler = Mock(side_effect=[ValueError, None])
+        dispatcher = self.when_dispatcher_started(handler, workers=1, logger=Mock())
+        dispatcher.submit('a')
+        dispatcher.submit('a')
+        dispatcher.shutdown(5)
+        self.assertEqual(2, handler.call_count)
+
+    def test_process_mode(self):
+        handled = multiprocessing.get_context('fork').Queue()
+        dispatcher = self.when_dispatcher_started(handled.put, workers=2, mode='process')
+        dispatcher.submit('a', 'hello')
+        self.assertEqual('hello', handled.get(timeout=5))
+
+    def test_worker_process_stopped_with_gunicorn_handlers(self):
+        signal.signal(signal.SIGTERM, Mock())
+        self.addCleanup(signal.signal, signal.SIGTERM, signal.SIG_DFL)
+        handled = multiprocessing.get_context('fork').Event()
+        dispatcher = self.when_dispatcher_started(handled.set, workers=1, mode='process')
+        dispatcher.submit('a')
+        # The handlers are reset before the first job is handled.
+        self.assertTrue(handled.wait(5))
+        _, (worker,) = dispatcher._pool.current()
+        worker.terminate()
+        worker.join(5)
+        self.assertEqual(-signal.SIGTERM, worker.exitcode)
+
+    def test_started_per_gunicorn_worker(self):
+        dispatcher = Mock(mode='process')
+        with patch('app.dispatcher', dispatcher):
+            gunicorn_conf.when_ready(Mock(**{'cfg.preload_app': True}))
+            gunicorn_conf.post_fork(Mock(**{'cfg.preload_app': True}), Mock())
+        dispatcher.shutdown.assert_called_once_with()
+        dispatcher.start.assert_called_once_with()
+
+    def test_warmer_started_per_gunicorn_worker(self):
+        warmer = Mock()
+        with patch('app.dispatcher', None), patch('app.history_warmer', warmer):
+            gunicorn_conf.when_ready(Mock(**{'cfg.preload_app': True}))
+            gunicorn_conf.post_fork(Mock(**{'cfg.preload_app': True}), Mock())
+        warmer.stop.assert_called_once_with()
+        warmer.start.assert_called_once_with()
+
+    def test_started_on_load_without_preload(self):
+        dispatcher = Mock(mode='process')
+        with patch('app.dispatcher', dispatcher):
+            gunicorn_conf.when_ready(Mock(**{'cfg.preload_app': False}))
+            gunicorn_conf.post_fork(Mock(**{'cfg.preload_app': False}), Mock())
+        dispatcher.shutdown.assert_not_called()
+        dispatcher.start.assert_not_called()
+
+    def test_invalid_mode(self):
+        with self.assertRaises(AssertionError):
+            Dispatcher(Mock(), mode='coroutine')
+
+
+class FakeGraph(fakes.FakeGraph):
+    '''Fake Graph API which rejects the messages with the text "fail".'''
+
+    def reply(self, rqst):
+        if rqst['message']['text'] == 'fail':
+            return 400, {'error': {'message': 'Invalid message'}}
+        return super().reply(rqst)
+
+
+def start_fake_graph(test_case, handler=FakeGraph, **attributes):
+    '''Starts the fake Graph API for the test case and returns the server and its URL.'''
+    server, url = fakes.start(handler, **attributes)
+    test_case.addCleanup(server.server_close)
+    test_case.addCleanup(server.shutdown)
+    return server, url
+
+
+def message_request(recipient_id, text):
+    return messages.MessageRequest(messages.Recipient(recipient_id=recipient_id), messages.Message(text=text))
+
+
+class TestSender(unittest.TestCase):
+    '''Test sending the messages.'''
+
+    def setUp(self):
+        self.graph, url = start_fake_graph(self)
+        self.sender = Sender(MessengerClient('token'), workers=4, graph_api_url=url)
+        self.addCleanup(self.sender.shutdown)
+
+    def test_send(self):
+        self.assertEqual('1', self.sender.send(message_request('1', 'hello'))['recipient_id'])
+
+    def test_send_error(self):
+        with self.assertRaises(MessengerException):
+            self.sender.send(message_request('1', 'fail'))
+        self.assertEqual(1, self.sender.stats['errors'])
+
+    def test_order_per_recipient(self):
+        self.graph.latency = 0.01
+        self.sender.send_all([message_request(recipient, str(i)) for i in range(5) for recipient in ('1', '2')])
+        for recipient in ('1', '2'):
+            self.assertEqual([str(i) for i in range(5)], [rqst['message']['text'] for rqst in self.graph.received
+                                                          if rqst['recipient']['id'] == recipient])
+
+    def test_recipients_in_parallel(self):
+        self.graph.latency = 0.2
+        started = time.monotonic()
+        self.sender.send_all([message_request(recipient, 'hello') for recipient in ('1', '2', '3', '4')])
+        self.assertLess(time.monotonic() - started, 0.6)
+        self.assertEqual(4, len(self.graph.received))
+
+    def test_submit_after(self):
+        self.graph.latency = 0.05
+        first = self.sender.submit([message_request('1', 'first')])
+        second = self.sender.submit([message_request('1', 'second')], after=first)
+        second.result(5)
+        self.assertEqual(['first', 'second'], [rqst['message']['text'] for rqst in self.graph.received])
+
+    def test_send_all_error(self):
+        with self.assertRaises(MessengerException):
+            self.sender.send_all([message_request('1', 'fail'), message_request('2', 'hello')])
+        self.assertEqual(2, len(self.graph.received))
+
+    def test_connection_reused(self):
+        for _ in range(3):
+            self.sender.send(message_request('1', 'hello'))
+        self.assertEqual(1, self.graph.connections)
+
+    def test_rejected_requests_do_not_open_circuit(self):
+        self.sender.breaker = CircuitBreaker('messenger', threshold=1)
+        with self.assertRaises(MessengerException):
+            self.sender.send(message_request('1', 'fail'))
+        self.assertEqual(CircuitBreaker.CLOSED, self.sender.breaker.stats['state'])
+
+    def test_exceeded_deadline(self):
+        with self.assertRaises(DeadlineExceeded):
+            self.sender.send_all([message_request('1', 'hello')], Deadline(0))
+        self.assertEqual([], self.graph.received)
+
+    def test_stats(self):
+        self.sender.send_all([message_request('1', 'hello'), message_request('2', 'hello')])
+        stats = self.sender.stats
+        self.assertEqual(2, stats['sent'])
+        self.assertGreater(stats['latency_p99'], 0)
+
+
+def done(result=None):
+    '''Returns a completed future.'''
+    future = Future()
+    future.set_result(result)
+    return future
+
+
+def webhook(*entries):
+    '''Builds the webhook payload, every entry is a list of `(sender_id, text)` events.'''
+    return {'object': 'page', 'entry': [
+        {'id': 'page', 'time': 0, 'messaging': [
+            {'sender': {'id': sender_id}, 'recipient': {'id': 'page'}, 'message': {'mid': 'mid', 'text': text}}
+            for sender_id, text in events]}
+        for events in entries]}
+
+
+class TestResilience(unittest.TestCase):
+    '''Test the deadlines and the circuit breaker.'''
+
+    def setUp(self):
+        self.now = 0
+        self.breaker = CircuitBreaker('upstream', threshold=2, reset_timeout=10, clock=lambda: self.now)
+
+    def fail(self):
+        with self.assertRaises(ValueError):
+            with self.breaker.protect():
+                raise ValueError('failed')
+
+    def test_deadline(self):
+        deadline = Deadline(5, clock=lambda: self.now)
+        self.assertEqual(3, deadline.timeout(3))
+        self.assertEqual(4, deadline.reserve(1).remaining())
+        self.now = 4
+        self.assertEqual(1, deadline.timeout(3))
+        self.now = 5
+        self.assertTrue(deadline.expired)
+        with self.assertRaises(DeadlineExceeded):
+            deadline.timeout()
+
+    def test_opens_after_consecutive_failures(self):
+        self.fail()
+        with self.breaker.protect():
+            pass
+        self.fail()
+        self.assertEqual(CircuitBreaker.CLOSED, self.breaker.state)
+        self.fail()
+        self.assertEqual(CircuitBreaker.OPEN, self.breaker.state)
+        with self.assertRaises(CircuitOpenError):
+            with self.breaker.protect():
+                self.fail()
+        self.assertEqual({'state': 'open', 'failures': 2, 'opened': 1, 'rejected': 1}, self.breaker.stats)
+
+    def test_ignored_errors(self):
+        for _ in range(3):
+            with self.assertRaises(KeyError):
+                with self.breaker.protect(ignore=(KeyError,)):
+                    raise KeyError('invalid')
+        self.assertEqual(CircuitBreaker.CLOSED, self.breaker.state)
+
+    def test_failures_after_deadline_not_counted(self):
+        deadline = Deadline(1, clock=lambda: self.now)
+        self.now = 1
+        for _ in range(3):
+            with self.assertRaises(ValueError):
+                with self.breaker.protect(deadline=deadline):
+                    raise ValueError('timed out')
+        self.assertEqual(CircuitBreaker.CLOSED, self.breaker.state)
+
+    def test_single_trial_after_reset_timeout(self):
+        self.fail()
+        self.fail()
+        self.now = 10
+        with self.breaker.protect():
+            # The concurrent calls are rejected during the trial.
+            with self.assertRaises(CircuitOpenError):
+                with self.breaker.protect():
+                    pass
+        self.assertEqual(CircuitBreaker.CLOSED, self.breaker.state)
+
+    def test_failed_trial_opens_again(self):
+        self.fail()
+        self.fail()
+        self.now = 10
+        self.fail()
+        self.assertEqual(CircuitBreaker.OPEN, self.breaker.state)
+        self.now = 15
+        with self.assertRaises(CircuitOpenError):
+            with self.breaker.protect():
+                pass
+
+
+class TestMetrics(unittest.TestCase):
+    def test_null_metrics(self):
+        metrics = NullMetrics()
+        with self.assertRaises(ValueError):
+            with metrics.track('stage'):
+                raise ValueError()
+        metrics.inc('counter')
+        metrics.observe('histogram', 1)
+
+    def test_render(self):
+        metrics = Metrics(buckets=(0.1, 1))
+        metrics.inc('requests_total', stage='a')
+        metrics.inc('requests_total', 2, stage='a')
+        metrics.observe('latency_seconds', 0.5)
+        metrics.observe('latency_seconds', 5)
+        self.assertEqual('# TYPE chronologist_requests_total counter\n'
+                         'chronologist_requests_total{stage="a"} 3\n'
+                         '# TYPE chronologist_latency_seconds histogram\n'
+                         'chronologist_latency_seconds_bucket{le="0.1"} 0\n'
+                         'chronologist_latency_seconds_bucket{le="1"} 1\n'
+                         'chronologist_latency_seconds_bucket{le="+Inf"} 2\n'
+                         'chronologist_latency_seconds_sum 5.5\n'
+                         'chronologist_latency_seconds_count 2\n', metrics.render())
+
+    def test_track(self):
+        metrics = Metrics()
+        with metrics.track('fetch'):
+            self.assertIn('chronologist_stage_in_flight{stage="fetch"} 1\n', metrics.render())
+        with self.assertRaises(ValueError), metrics.track('fetch'):
+            raise ValueError()
+        rendered = metrics.render()
+        self.assertIn('chronologist_stage_in_flight{stage="fetch"} 0\n', rendered)
+        self.assertIn('chronologist_stage_errors_total{stage="fetch"} 1\n', rendered)
+        self.assertIn('chronologist_stage_seconds_count{stage="fetch"} 2\n', rendered)
+
+    def test_collectors(self):
+        metrics = Metrics()
+        metrics.register(lambda: [('counter', 'hits_total', {'cache': 'history'}, 7), ('gauge', 'size', {}, 3)])
+        rendered = metrics.render()
+        self.assertIn('chronologist_hits_total{cache="history"} 7\n', rendered)
+        self.assertIn('# TYPE chronologist_size gauge\nchronologist_size 3\n', rendered)
+
+    def test_shared_gauge(self):
+        directory = tempfile.mkdtemp()
+        metrics = Metrics(directory=directory, flush_interval=3600)
+        metrics.register(lambda: [('shared_gauge', 'store_size', {}, 3)])
+        done, exit = multiprocessing.Event(), multiprocessing.Event()
+        process = multiprocessing.get_context('fork').Process(target=self.child, args=(metrics, done, exit))
+        process.start()
+        self.addCleanup(process.join)
+        self.addCleanup(exit.set)
+        done.wait(10)
+        # Both processes report the same store, it is not counted twice.
+        self.assertIn('# TYPE chronologist_store_size gauge\nchronologist_store_size 3\n', metrics.render())
+
+    def test_aggregated_across_processes(self):
+        directory = tempfile.mkdtemp()
+        metrics = Metrics(directory=directory, flush_interval=3600)
+        metrics.inc('requests_total')
+        done, exit = multiprocessing.Event(), multiprocessing.Event()
+        process = multiprocessing.get_context('fork').Process(target=self.child, args=(metrics, done, exit))
+        process.start()
+        self.addCleanup(process.join)
+        self.addCleanup(exit.set)
+        done.wait(10)
+        # The value of the parent is not inherited by the child.
+        self.assertIn('chronologist_requests_total 3\n', metrics.render())
+        exit.set()
+        process.join()
+        self.assertIn('chronologist_requests_total 1\n', metrics.render())
+        self.assertEqual(['{pid}.json'.format(pid=os.getpid())], os.listdir(directory))
+
+    @staticmethod
+    def child(metrics, done, exit):
+        metrics.inc('requests_total', 2)
+        metrics.flush()
+        done.set()
+        exit.wait(10)
+
+
+class TestRecorder(unittest.TestCase):
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix='.jsonl')
+        os.close(fd)
+        self.addCleanup(os.unlink, self.path)
+
+    def test_sanitize(self):
+        recorder = Recorder(self.path, 'salt')
+        payload = webhook([('1', 'May 27'), ('2', 'Hi')])
+        payload['entry'][0]['messaging'][0]['message']['mid'] = 'mid.1'
+        payload['entry'][0]['messaging'].append({'sender': {'id': '1'}, 'recipient': {'id': 'page'},
+                                                 'delivery': {'mids': ['mid.1']}})
+        events = recorder.sanitize(payload)['entry'][0]['messaging']
+        self.assertEqual({'text': 'May 27'}, events[0]['message'])
+        self.assertEqual({}, events[2]['delivery'])
+        self.assertNotEqual('1', events[0]['sender']['id'])
+        self.assertEqual(events[0]['sender']['id'], events[2]['sender']['id'])
+        self.assertNotEqual(events[0]['sender']['id'], events[1]['sender']['id'])
+        self.assertNotEqual(events[0]['sender']['id'], Recorder(self.path, 'pepper').anonymize('1'))
+
+    def test_record(self):
+        clock = iter([10, 12.5, 13])
+        recorder = Recorder(self.path, 'salt', clock=lambda: next(clock))
+        for text in ('May 27', 'more', 'Hi'):
+            self.assertTrue(recorder.record(webhook([('1', text)])))
+        recorder.close()
+        records = list(load(self.path))
+        self.assertEqual([10, 12.5, 13], [recorded_at for recorded_at, _ in records])
+        self.assertEqual('more', records[1][1]['entry'][0]['messaging'][0]['message']['text'])
+        self.assertEqual([0, 1.25, 1.5], [offset for offset, _ in schedule(self.path, 2)])
+        self.assertEqual([None] * 3, [offset for offset, _ in schedule(self.path, None)])
+
+    def test_full_queue(self):
+        recorder = Recorder(self.path)
+        # Without the background thread nothing is taken from the queue.
+        recorder._writer = PerProcess(lambda: (queue.Queue(1), None))
+        self.assertTrue(recorder.record({}))
+        self.assertFalse(recorder.record({}))
+        self.assertEqual(1, recorder.dropped)
+
+    def test_webhook_recorded(self):
+        recorder = Mock()
+        with patch('app.recorder', recorder), patch('app.sender.submit', return_value=done()), \
+                patch('app.bot_ai.extract_action', return_value=Mock(fulfillment='Hello!')):
+            app.test_client().post('/bot', json=webhook([('1', 'Hi')]))
+        recorder.record.assert_called_once_with(webhook([('1', 'Hi')]))
+
+
+class TestBot(unittest.TestCase):
+    '''Test the webhook.'''
+
+    def setUp(self):
+        self.client = app.test_client()
+        for target, attribute in (('app.bot_ai.extract_action', 'extract_action'), ('app.history_api.date', 'date'),
+                                  ('app.sender.submit', 'submit')):
+            patcher = patch(target)
+            setattr(self, attribute, patcher.start())
+            self.addCleanup(patcher.stop)
+        self.extract_action.side_effect = lambda recipient_id, text, deadline=None: Action.history({'day': text})
+        self.date.return_value = Results(DATA)
+        self.futures = []
+        self.submit.side_effect = self.submitted
+
+    def submitted(self, rqsts, deadline=None, after=None):
+        self.futures.append(done())
+        return self.futures[-1]
+
+    def sent(self):
+        return [(rqst.recipient.recipient_id, rqst.message.text) for args, _ in self.submit.call_args_list
+                for rqst in args[0]]
+
+    def test_all_entries_handled(self):
+        self.client.post('/bot', json=webhook([('1', 'May 27')], [('2', 'May 28'), ('3', 'May 29')]))
+        self.assertEqual(['1', '2', '3'], sorted(set(recipient_id for recipient_id, _ in self.sent())))
+
+    def test_date_fetched_once_per_batch(self):
+        self.client.post('/bot', json=webhook([('1', 'May 27'), ('2', 'May 27')], [('3', 'May 27 1945')]))
+        self.date.assert_called_once_with(5, 27, deadline=ANY)
+        self.assertEqual([('3', 'Nothing special found in history for this date')],
+                         [rqst for rqst in self.sent() if rqst[0] == '3'])
+
+    def test_sent_per_message(self):
+        self.client.post('/bot', json=webhook([('1', 'May 27'), ('2', 'May 28')], [('1', 'May 29')]))
+        (_, first_deadline, first_after), (_, second_deadline, second_after), (_, _, third_after) = \
+            [args for args, _ in self.submit.call_args_list]
+        self.assertIsNot(first_deadline, second_deadline)
+        self.assertEqual((None, None, self.futures[0]), (first_after, second_after, third_after))
+        self.assertEqual(9, len(self.sent()))
+
+    def test_send_error_logged_after_all_sent(self):
+        failed = Future()
+        failed.set_exception(MessengerException('Blocked'))
+        self.submit.side_effect = [failed, done()]
+        with patch('app.app.logger') as logger:
+            response = self.client.post('/bot', json=webhook([('1', 'May 27'), ('2', 'May 28')]))
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(2, self.submit.call_count)
+        logger.error.assert_called_once_with('Could not send the reply to %s', '1', exc_info=failed.exception())
+
+    def test_non_text_events_skipped(self):
+        payload = webhook([('1', 'May 27')])
+        payload['entry'][0]['messaging'].append({'sender': {'id': '2'}, 'delivery': {'mids': ['mid']}})
+        self.client.post('/bot', json=payload)
+        self.assertEqual({'1'}, set(recipient_id for recipient_id, _ in self.sent()))
+
+    def test_lookup(self):
+        self.extract_action.side_effect = self.lookup_action
+        with patch('app.history_index', Index.build([((5, 27), Results(DATA))])):
+            self.client.post('/bot', json=webhook([('1', 'Simeon the Great')]))
+        self.assertEqual(('1', 'May 27: Year 927: Death of Simeon I the Great, the first Bulgarian to be recognized '
+                          'as Emperor.'), self.sent()[0])
+
+    def test_lookup_changed_entry_skipped(self):
+        self.extract_action.side_effect = self.lookup_action
+        changed = deepcopy(DATA)
+        changed['data']['Events'].reverse()
+        self.date.return_value = Results(changed)
+        with patch('app.history_index', Index.build([((5, 27), Results(DATA))])), \
+                self.assertLogs(app.logger, 'WARNING'):
+            self.client.post('/bot', json=webhook([('1', 'Malcolm Scotland')]))
+        self.assertEqual([('1', 'Nothing found in history for this question')], self.sent())
+
+    def test_lookup_date_fetched_once(self):
+        self.extract_action.side_effect = self.lookup_action
+        with patch('app.history_index', Index.build([((5, 27), Results(DATA))])):
+            self.client.post('/bot', json=webhook([('1', 'Simeon Bulgarian Scotland')]))
+        self.date.assert_called_once_with(5, 27, deadline=ANY)
+        self.assertLess(1, len(self.sent()))
+
+    def test_lookup_without_index(self):
+        self.extract_action.side_effect = self.lookup_action
+        self.client.post('/bot', json=webhook([('1', 'Simeon the Great')]))
+        self.assertEqual([('1', 'Nothing found in history for this question')], self.sent())
+
+    def test_dropped_when_queue_full(self):
+        dispatcher = Mock(**{'submit.return_value': False})
+        with patch('app.dispatcher', dispatcher), patch('app.metrics') as metrics:
+            self.client.post('/bot', json=webhook([('1', 'May 27')]))
+        dispatcher.submit.assert_called_once_with('1', '1', 'May 27')
+        self.date.assert_not_called()
+        metrics.inc.assert_any_call('webhook_dropped_total')
+
+    def test_metrics(self):
+        self.client.post('/bot', json=webhook([('1', 'May 27')]))
+        response = self.client.get('/metrics')
+        self.assertEqual(200, response.status_code)
+        self.assertTrue(response.content_type.startswith('text/plain'))
+        text = response.get_data(as_text=True)
+        self.assertIn('chronologist_stage_seconds_count{stage="webhook"}', text)
+        self.assertIn('chronologist_stage_seconds_count{stage="render"}', text)
+        self.assertIn('chronologist_cache_requests_total{cache="history",result="hits"}', text)
+        self.assertIn('chronologist_session_store_size ', text)
+        self.assertIn('chronologist_session_evictions_total ', text)
+
+    def test_metrics_of_local_history(self):
+        with tempfile.TemporaryDirectory() as directory, \
+                patch('app.history_api', LocalAPI(Store(directory))):
+            response = self.client.get('/metrics')
+        self.assertEqual(200, response.status_code)
+        text = response.get_data(as_text=True)
+        self.assertIn('chronologist_history_fetches_total{result="called"} 0', text)
+        self.assertIn('chronologist_history_fallbacks_total{source="cache"} 0', text)
+
+    def test_try_later_when_upstream_fails(self):
+        self.extract_action.side_effect = CircuitOpenError('dialogflow')
+        with patch('app.app.logger'):
+            self.client.post('/bot', json=webhook([('1', 'May 27')]))
+        self.assertEqual([('1', 'Sorry, I can\'t look into the history right now, please try again later')],
+                         self.sent())
+        self.assertIn('chronologist_degraded_replies_total 1', self.client.get('/metrics').get_data(as_text=True))
+
+    def test_try_later_when_next_page_fails(self):
+        with patch('app.history_pager.next', side_effect=CircuitOpenError('history')), patch('app.app.logger'), \
+                patch('app.metrics'):
+            self.client.post('/bot', json=webhook([('1', 'more')]))
+        self.assertEqual([('1', 'Sorry, I can\'t look into the history right now, please try again later')],
+                         self.sent())
+
+    def test_deadline_passed_down(self):
+        self.client.post('/bot', json=webhook([('1', 'May 27')]))
+        deadline = self.extract_action.call_args[0][2]
+        self.assertIs(deadline, self.date.call_args[1]['deadline'])
+        self.assertGreater(self.submit.call_args[0][1].remaining(), deadline.remaining())
+
+    def lookup_action(self, recipient_id, text, deadline=None):
+        action = Mock(fulfillment=None, query=text)
+        action.name = 'lookup'
+        return action
+
+
+class TestBenchmarks(unittest.TestCase):
+    def test_fake_history(self):
+        server, url = fakes.start(fakes.FakeHistory, entries=50)
+        self.addCleanup(server.shutdown)
+        results = API(url).date(5, 27)
+        self.assertEqual('May 27', results.date)
+        self.assertEqual(150, len(results))
+        self.assertEqual(1, server.requests)
+
+    def test_fake_dialogflow(self):
+        pool = fakes.FakeClientPool()
+        query_input = Mock()
+        query_input.text.text = 'what happened on 9 May 1945'
+        query_result = pool.get().detect_intent('session', query_input).query_result
+        self.assertEqual('history', query_result.action)
+        self.assertEqual('1945-05-09', query_result.parameters['date']['day'])
+        query_input.text.text = 'Hi'
+        self.assertTrue(pool.get().detect_intent('session', query_input).query_result.fulfillment_text)
+
+    def test_webhook(self):
+        payload = bench_webhook(random.Random(0), 3, 10)
+        self.assertEqual(3, len(payload['entry'][0]['messaging']))
+
+    def test_stages(self):
+        stages = Stages()
+        stages.timed('stage', lambda: None)()
+        stages.add('stage', 1)
+        summary = stages.summary()['stage']
+        self.assertEqual(2, summary['count'])
+        self.assertEqual(1, summary['max'])
+
+    def test_models(self):
+        timings = bench_models.measure(repeat=1, scale=0)
+        self.assertEqual(set(name for name, _, _ in bench_models.cases()), set(timings))
+        self.assertEqual([], bench_models.compare(timings, timings, 0.25))
+
+    def test_models_regression(self):
+        baselines = {'calibration': 1, 'search': 1, 'render': 1}
+        timings = {'calibration': 2, 'search': 2.2, 'render': 3, 'iterate': 1}
+        self.assertEqual([('render', 1.5)], bench_models.compare(timings, baselines, 0.25))
+
+    def test_models_noise_widens_threshold(self):
+        baselines = {'calibration': [1, 1, 1], 'render': [1, 1, 1]}
+        noisy = {'calibration': [1, 1, 1], 'render': [1.1, 1.4, 1.7]}
+        self.assertEqual([], bench_models.compare(noisy, baselines, 0.25))
+        slower = {'calibration': [1, 1, 1], 'render': [1.9, 2, 2.1]}
+        self.assertEqual([('render', 2)], bench_models.compare(slower, baselines, 0.25))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,91 @@
+from threading import Thread
+import logging
+import multiprocessing
+import queue
+import signal
+
+from forks import PerProcess
+
+
+class Dispatcher:
+    '''Bounded pool of workers which call the handler in the background.
+
+    The jobs with the same key (e.g. the sender id) always go to the same worker, so they are handled in the
+    submission order. The workers are either threads or processes and are started in the process which submits the
+    first job, so that the dispatcher can be created before gunicorn forks. The processes must not be forked from a
+    process which already runs threads, so in the process mode `start` has to be called before any are started.
+    '''
+
+    MODES = ('thread', 'process')
+
+    def __init__(self, handler, workers=4, queue_size=1000, mode='thread', logger=None, submit_timeout=1):
+        assert workers > 0
+        assert mode in self.MODES, 'The mode has to be one of {modes}'.format(modes=self.MODES)
+        self.handler = handler
+        self.workers = workers
+        self.queue_size = queue_size
+        self.mode = mode
+        self.logger = logger if logger is not None else logging.getLogger(__name__)
+        # Seconds `submit` waits while the queue of the worker is full.
+        self.submit_timeout = submit_timeout
+        self._pool = PerProcess(self._start)
+
+    def start(self):
+        '''Starts the workers of this process.'''
+        self._pool.get()
+
+    def submit(self, key, *args):
+        '''Enqueues the job, returns `False` if the queue of its worker stays full for `submit_timeout` seconds.'''
+        queues, _ = self._pool.get()
+        try:
+            queues[hash(key) % self.workers].put(args, timeout=self.submit_timeout)
+        except queue.Full:
+            return False
+        return True
+
+    def shutdown(self, timeout=None):
+        '''Lets the workers handle the already enqueued jobs and stops them.'''
+        pool = self._pool.clear()
+        if pool is None:
+            return
+        queues, workers = pool
+        for jobs in queues:
+            jobs.put(None)
+        for worker in workers:
+            worker.join(timeout)
+
+    def _start(self):
+        if self.mode == 'thread':
+            queues = [queue.Queue(self.queue_size) for _ in range(self.workers)]
+            workers = [Thread(target=self._run, args=(jobs,), daemon=True) for jobs in queues]
+        else:
+            # The worker processes inherit the already configured app.
+            context = multiprocessing.get_context('fork')
+            queues = [context.Queue(self.queue_size) for _ in range(self.workers)]
+            workers = [context.Process(target=self._run_process, args=(jobs,), daemon=True) for jobs in queues]
+        for worker in workers:
+            worker.start()
+        return queues, workers
+
+    def _run_process(self, jobs):
+        # The handlers inherited from the parent, e.g. the gunicorn arbiter's, would keep the worker from stopping.
+        for signum in signal.valid_signals():
+            if callable(signal.getsignal(signum)):
+                signal.signal(signum, signal.SIG_DFL)
+        self._run(jobs)
+
+    def _run(self, jobs):
+        while True:
+            args = jobs.get()
+            if args is None:
+                return
+            try:
+                self.handler(*args)
+            except Exception:
+                self.logger.exception('Failed to handle the job %s', args)
+
+    @property
+    def pending(self):
+        '''Approximate number of the enqueued jobs.'''
+        pool = self._pool.current()
+        return sum(jobs.qsize() for jobs in pool[0]) if pool is not None else 0